@@ -0,0 +1,34 @@
+"""Added chunked storage
+
+Revision ID: 3b9e2f4c7a1d
+Revises: 8a41555bc16b
+Create Date: 2026-10-18 09:12:41.508127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b9e2f4c7a1d'
+down_revision = '8a41555bc16b'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy import Column, Integer, BigInteger, String
+from sqlalchemy.types import LargeBinary
+
+
+
+def upgrade():
+    op.add_column('bigtable', Column('size', BigInteger))
+    op.add_column('bigtable', Column('chunks', Integer))
+    op.create_table('bigtable_chunks',
+        Column('key', String(255), primary_key=True),
+        Column('chunk_no', Integer, primary_key=True),
+        Column('value', LargeBinary),
+    )
+
+
+def downgrade():
+    op.drop_table('bigtable_chunks')
+    op.drop_column('bigtable', 'chunks')
+    op.drop_column('bigtable', 'size')
@@ -0,0 +1,31 @@
+"""Added content addressed storage
+
+Revision ID: 5d1c8a2e9f47
+Revises: 3b9e2f4c7a1d
+Create Date: 2026-10-18 11:03:17.294513
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d1c8a2e9f47'
+down_revision = '3b9e2f4c7a1d'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy import Column, String
+from sqlalchemy.types import LargeBinary
+
+
+
+def upgrade():
+    op.add_column('bigtable', Column('digest', String(64)))
+    op.create_table('bigtable_content',
+        Column('digest', String(64), primary_key=True),
+        Column('value', LargeBinary),
+    )
+
+
+def downgrade():
+    op.drop_table('bigtable_content')
+    op.drop_column('bigtable', 'digest')
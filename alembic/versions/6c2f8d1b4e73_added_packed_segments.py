@@ -0,0 +1,36 @@
+"""Added packed segments
+
+Revision ID: 6c2f8d1b4e73
+Revises: 9e4a6b3f0c25
+Create Date: 2026-10-18 21:02:13.480126
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c2f8d1b4e73'
+down_revision = '9e4a6b3f0c25'
+
+from alembic import op
+import sqlalchemy as sa
+
+                               
+
+
+def upgrade():
+    op.create_table('bigtable_segments',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('value', sa.LargeBinary()),
+                    sa.Column('index', sa.LargeBinary()),
+                    sa.Column('files', sa.Integer()),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('bigtable_packed',
+                    sa.Column('key', sa.String(255), nullable=False),
+                    sa.Column('segment', sa.BigInteger()),
+                    sa.Column('start', sa.BigInteger()),
+                    sa.Column('size', sa.BigInteger()),
+                    sa.PrimaryKeyConstraint('key'))
+
+
+def downgrade():
+    op.drop_table('bigtable_packed')
+    op.drop_table('bigtable_segments')
@@ -0,0 +1,26 @@
+"""Added codec column
+
+Revision ID: 9e4a6b3f0c25
+Revises: 5d1c8a2e9f47
+Create Date: 2026-10-18 12:41:55.817206
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e4a6b3f0c25'
+down_revision = '5d1c8a2e9f47'
+
+from alembic import op
+import sqlalchemy as sa
+
+                               
+
+
+def upgrade():
+    op.add_column('bigtable', sa.Column('codec', sa.String(16)))
+    op.add_column('bigtable_content', sa.Column('codec', sa.String(16)))
+
+
+def downgrade():
+    op.drop_column('bigtable_content', 'codec')
+    op.drop_column('bigtable', 'codec')
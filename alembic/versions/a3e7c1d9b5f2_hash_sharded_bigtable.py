@@ -0,0 +1,50 @@
+"""Hash sharded, pre-split bigtable
+
+Revision ID: a3e7c1d9b5f2
+Revises: 6c2f8d1b4e73
+Create Date: 2026-10-18 23:41:52.907314
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3e7c1d9b5f2'
+down_revision = '6c2f8d1b4e73'
+
+from alembic import op, context
+import sqlalchemy as sa
+import os
+import sys
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from ybload import sharding
+
+
+
+def _layout():
+    # BIGTABLE_SHARDING/BIGTABLE_TABLETS of the config; can be overridden with
+    # alembic -x sharding=range -x tablets=48 upgrade head
+    from ybload.tasks import app
+    layout, tablets = sharding.from_config(app.conf)
+    x = context.get_x_argument(as_dictionary=True)
+    return x.get('sharding', layout), int(x.get('tablets', tablets))
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not sharding.is_yugabyte(bind):
+        # plain PostgreSQL (local tests): the tables stay as they are
+        return
+    layout, tablets = _layout()
+    for name in sorted(sharding.TABLES):
+        sharding.rebuild(bind, name, layout, tablets)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if not sharding.is_yugabyte(bind):
+        return
+    for name in sorted(sharding.TABLES):
+        sharding.rebuild(bind, name, None)
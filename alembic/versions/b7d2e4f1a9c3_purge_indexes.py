@@ -0,0 +1,29 @@
+"""Indexes for the batched purge
+
+Revision ID: b7d2e4f1a9c3
+Revises: a3e7c1d9b5f2
+Create Date: 2026-10-19 00:12:37.118402
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f1a9c3'
+down_revision = 'a3e7c1d9b5f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+
+def upgrade():
+    # ASC makes the index ordered on yugabyte too (the first column of an
+    # index is hashed by default), the purge walks change_log by key
+    op.execute('CREATE INDEX ix_change_log_key ON change_log (key ASC, id ASC)')
+    op.create_index('ix_bigtable_digest', 'bigtable', ['digest'], postgresql_where=sa.text('digest IS NOT NULL'))
+    op.create_index('ix_bigtable_packed_segment', 'bigtable_packed', ['segment'])
+
+
+def downgrade():
+    op.drop_index('ix_bigtable_packed_segment', table_name='bigtable_packed')
+    op.drop_index('ix_bigtable_digest', table_name='bigtable')
+    op.drop_index('ix_change_log_key', table_name='change_log')
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""Ingest benchmark: generates a synthetic corpus (manifest + files) and runs
+`run.ingest_binary_files` over it for every combination of the commit sizes
+and writers given; throughput, commit latency and peak RSS of every run are
+written into a JSON file (that a later run can be compared against).
+
+By default a throw-away PostgreSQL is started through testing.postgresql;
+--db_url points the benchmark at an existing database instead (its bigtable
+tables are DROPPED and created again, empty, before every run).
+
+    python3 bench.py --distribution lognormal --files 5000 --output bench.json
+    python3 bench.py --compare bench.json --output bench-new.json
+
+--records N benchmarks reads of N records instead (get_record() through the
+ORM and through the Core path).
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import multiprocessing
+from queue import Empty
+
+DISTRIBUTIONS = ('tiny', 'lognormal', 'huge')
+
+
+# ============================= CORPUS ============================================ #
+
+def file_sizes(distribution, n, rng, median=32*1024, sigma=1.5, max_size=1024*1024*16,
+               huge=2, huge_size=1024*1024*100):
+    """Yields `n` file sizes drawn from the distribution:
+
+    tiny: 10 - 2000 bytes (uniform)
+    lognormal: log-normal around `median`, capped at `max_size`
+    huge: like lognormal, but the last `huge` files have `huge_size` bytes
+    """
+    mu = math.log(median)
+    for i in range(n):
+        if distribution == 'tiny':
+            yield rng.randint(10, 2000)
+        elif distribution == 'huge' and i >= n - huge:
+            yield huge_size
+        else:
+            yield max(1, min(max_size, int(rng.lognormvariate(mu, sigma))))
+
+
+def _write_payload(fo, size, rng, compressible):
+    # half of the files are text-like (compress well), the rest is noise
+    while size > 0:
+        n = min(size, 1024 * 1024)
+        if compressible:
+            line = ('line %d of the synthetic corpus\n' % rng.randint(0, 1000)).encode('utf8')
+            fo.write((line * (n // len(line) + 1))[:n])
+        else:
+            fo.write(rng.getrandbits(8 * n).to_bytes(n, 'little'))
+        size -= n
+
+
+def make_corpus(directory, n=1000, distribution='lognormal', seed=42, **kwargs):
+    """Writes `n` files into the directory and a manifest (key<tab>path)
+    describing them; the same seed produces the same corpus. Returns
+    (manifest, description)"""
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError('Unknown distribution: {}'.format(distribution))
+    rng = random.Random(seed)
+    files = os.path.join(directory, 'files')
+    if not os.path.exists(files):
+        os.makedirs(files)
+    manifest = os.path.join(directory, 'manifest.txt')
+    total = largest = 0
+    with open(manifest, 'w') as mf:
+        for i, size in enumerate(file_sizes(distribution, n, rng, **kwargs)):
+            path = os.path.join(files, '{:08d}'.format(i))
+            with open(path, 'wb') as fo:
+                _write_payload(fo, size, rng, i % 2 == 0)
+            mf.write('bench/{}/{:08d}\t{}\n'.format(distribution, i, path))
+            total += size
+            largest = max(largest, size)
+    return manifest, {'distribution': distribution, 'files': n, 'bytes': total,
+                      'largest': largest, 'seed': seed}
+
+
+# ============================= RUNS ============================================== #
+
+def peak_rss():
+    """Max resident set size (in bytes) of this process and its finished
+    children"""
+    scale = sys.platform == 'darwin' and 1 or 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _read_metrics(path):
+    """Last snapshot of every worker written by ybload.instrument"""
+    last = {}
+    if os.path.exists(path):
+        with open(path) as fi:
+            for line in fi:
+                snap = json.loads(line)
+                last[snap['worker']] = snap
+    return list(last.values())
+
+
+def _run_one(db_url, manifest, params, workdir, queue):
+    try:
+        import run
+        from ybload import app as app_module
+        run.app = app_module.YBLoader('bench', local_config={'SQLALCHEMY_URL': db_url,
+                                                              'SQLALCHEMY_ECHO': False})
+        run.truncate()
+        metrics_file = os.path.join(workdir, 'metrics.jsonl')
+        if os.path.exists(metrics_file):
+            os.remove(metrics_file)
+
+        start = time.time()
+        files = run.ingest_binary_files(manifest, metrics_file=metrics_file, report=0, **params)
+        elapsed = time.time() - start
+
+        snaps = _read_metrics(metrics_file)
+        size = sum(s['bytes'] for s in snaps)
+        latency = {}
+        for q in ('p50', 'p95', 'p99'):
+            values = [s['commit_latency'][q] for s in snaps if s['commit_latency'][q] is not None]
+            latency[q] = values and max(values) or None
+        stages = {}
+        for s in snaps:
+            for k, v in s['stages'].items():
+                stages[k] = stages.get(k, 0.0) + v['seconds']
+        run.app.close_app()
+        queue.put({'files': files, 'bytes': size, 'elapsed': elapsed,
+                   'files_per_sec': elapsed and files / elapsed or 0.0,
+                   'mb_per_sec': elapsed and size / elapsed / (1024 * 1024) or 0.0,
+                   'commits': sum(s['stages']['commit']['calls'] for s in snaps),
+                   'commit_latency': latency, 'stages': stages, 'peak_rss': peak_rss()})
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(e.__class__.__name__, e)})
+        raise
+
+
+def _result(p, queue, poll=1.0):
+    # waits for the result of the cell; a process that died without one
+    # (OOM, segfault, os._exit) makes a failed cell
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if not p.is_alive():
+                try:
+                    # it may have put the result right before exiting
+                    return queue.get(timeout=poll)
+                except Empty:
+                    return {'error': 'The benchmark process died (exit code {})'.format(p.exitcode)}
+
+
+def run_grid(db_url, manifest, commit_sizes, writers, workdir, repeat=1, **params):
+    """Runs the ingest for every (commit size, writer) pair; every run
+    happens in a fresh process so that its peak RSS is its own"""
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for commit_after, writer, attempt in itertools.product(commit_sizes, writers, range(repeat)):
+        cell = dict(params, commit_after=commit_after, writer=writer)
+        queue = ctx.Queue()
+        p = ctx.Process(target=_run_one, args=(db_url, manifest, cell, workdir, queue))
+        p.start()
+        result = _result(p, queue)
+        p.join()
+        result.update(cell)
+        result['attempt'] = attempt
+        print('{commit_after:>12} {writer:>7}: {0}'.format(
+            'error' in result and result['error'] or
+            '{files} files, {files_per_sec:.1f} files/s, {mb_per_sec:.2f} MB/s, '
+            'commit p99 {p99}, peak RSS {rss:.1f} MB'.format(
+                p99=result['commit_latency']['p99'], rss=result['peak_rss'] / (1024 * 1024.), **result),
+            **cell))
+        results.append(result)
+    return results
+
+
+def compare(old, new, tolerance=0.1):
+    """Pairs up runs of two reports (by commit size and writer) and returns
+    the ones whose files/s dropped by more than `tolerance`"""
+    def key(r):
+        return r['commit_after'], r['writer']
+
+    def best(results):
+        out = {}
+        for r in results:
+            if 'error' not in r and r['files_per_sec'] > out.get(key(r), {}).get('files_per_sec', -1):
+                out[key(r)] = r
+        return out
+
+    before, after = best(old['results']), best(new['results'])
+    regressions = []
+    for k in sorted(set(before) & set(after)):
+        ratio = before[k]['files_per_sec'] and after[k]['files_per_sec'] / before[k]['files_per_sec'] or 1.0
+        print('{:>12} {:>7}: {:.1f} -> {:.1f} files/s ({:+.0%})'.format(
+            k[0], k[1], before[k]['files_per_sec'], after[k]['files_per_sec'], ratio - 1))
+        if ratio < 1 - tolerance:
+            regressions.append({'commit_after': k[0], 'writer': k[1], 'ratio': ratio})
+    return regressions
+
+
+# ============================= RECORDS READS ===================================== #
+
+def _orm_records(app, bibcodes, load_only, chunk_size):
+    # the ORM read: Records instances and their toJSON()
+    from sqlalchemy.orm import load_only as _load_only
+    from ybload.models import Records
+    out = []
+    for i in range(0, len(bibcodes), chunk_size):
+        with app.session_scope() as session:
+            q = session.query(Records).filter(Records.bibcode.in_(bibcodes[i:i + chunk_size]))
+            if load_only:
+                q = q.options(_load_only(*load_only))
+            out.extend(r.toJSON(load_only=load_only) for r in q)
+    return out
+
+
+def bench_records(db_url, n=100000, projections=(None, ('bibcode', 'bib_data', 'status', 'processed')),
+                  chunk_size=1000, repeat=1):
+    """Reads `n` records (created first, the records table is emptied) in
+    chunks of `chunk_size` bibcodes through the ORM and through the Core
+    path of get_record() (ybload.records); both must give the same dicts"""
+    from ybload import app as app_module, purge
+    app = app_module.YBLoader('bench', local_config={'SQLALCHEMY_URL': db_url, 'SQLALCHEMY_ECHO': False})
+    purge.reset(app, ('records',))
+    bibcodes = ['{:04d}bench{:010d}'.format(2000 + i % 20, i) for i in range(n)]
+    for i in range(0, n, 10000):
+        batch = bibcodes[i:i + 10000]
+        app.update_storage_bulk([(b, 'bib_data', {'bibcode': b, 'title': 'Title of {}'.format(b),
+                                                  'author': ['Author, A.', 'Author, B.']}) for b in batch])
+        app.update_storage_bulk([(b, 'nonbib_data', {'citation_count': len(b)}) for b in batch])
+        app.mark_processed(batch, 'solr', checksums=[b[-8:] for b in batch], status='success')
+
+    results = []
+    for load_only, attempt in itertools.product(projections, range(repeat)):
+        start = time.time()
+        orm = _orm_records(app, bibcodes, load_only, chunk_size)
+        orm_seconds = time.time() - start
+        start = time.time()
+        core = list(app.iter_records(bibcodes, load_only, chunk_size=chunk_size))
+        core_seconds = time.time() - start
+        if sorted(orm, key=lambda r: r['bibcode']) != sorted(core, key=lambda r: r['bibcode']):
+            raise AssertionError('The ORM and Core reads differ ({})'.format(load_only))
+        result = {'projection': load_only and list(load_only) or None, 'rows': len(core), 'attempt': attempt,
+                  'orm_seconds': orm_seconds, 'core_seconds': core_seconds,
+                  'orm_rows_per_sec': orm_seconds and len(orm) / orm_seconds or 0.0,
+                  'core_rows_per_sec': core_seconds and len(core) / core_seconds or 0.0,
+                  'speedup': core_seconds and orm_seconds / core_seconds or 0.0}
+        print('{:>40}: {rows} rows, ORM {orm_rows_per_sec:.0f} rows/s, Core {core_rows_per_sec:.0f} rows/s '
+              '(x{speedup:.2f})'.format(','.join(load_only or ['all']), **result))
+        results.append(result)
+    app._engine.dispose()
+    app.close_app()
+    return results
+
+
+def _ints(value):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    out = []
+    for v in value.split(','):
+        v = v.strip().lower()
+        out.append(v[-1] in units and int(float(v[:-1]) * units[v[-1]]) or int(v))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ingest on a synthetic corpus.')
+    parser.add_argument('--distribution',
+                        dest='distribution',
+                        action='store',
+                        default='lognormal',
+                        choices=DISTRIBUTIONS,
+                        help='Sizes of the generated files: tiny, log-normal or log-normal plus a few huge ones')
+    parser.add_argument('--files',
+                        dest='files',
+                        action='store',
+                        default=1000,
+                        type=int,
+                        help='Number of files to generate')
+    parser.add_argument('--median',
+                        dest='median',
+                        action='store',
+                        default='32k',
+                        help='Median size of the log-normal distribution')
+    parser.add_argument('--huge_size',
+                        dest='huge_size',
+                        action='store',
+                        default='100m',
+                        help='Size of the huge files')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        action='store',
+                        default=42,
+                        type=int,
+                        help='Seed of the generator (the same seed gives the same corpus)')
+    parser.add_argument('--commit_sizes',
+                        dest='commit_sizes',
+                        action='store',
+                        default='1m,10m,100m',
+                        help='Comma separated commit sizes (bytes, k/m/g suffixes allowed)')
+    parser.add_argument('--writers',
+                        dest='writers',
+                        action='store',
+                        default='row,values,copy',
+                        help='Comma separated writers to try')
+    parser.add_argument('--batch_rows',
+                        dest='batch_rows',
+                        action='store',
+                        default=1000,
+                        type=int,
+                        help='Rows per statement of the values/copy writers')
+    parser.add_argument('--max_file_size',
+                        dest='max_file_size',
+                        action='store',
+                        default='60m',
+                        help='Files larger than this are stored in chunks')
+    parser.add_argument('-w',
+                        '--workers',
+                        dest='workers',
+                        action='store',
+                        default=1,
+                        type=int,
+                        help='Number of ingest processes')
+    parser.add_argument('--repeat',
+                        dest='repeat',
+                        action='store',
+                        default=1,
+                        type=int,
+                        help='Run every combination this many times')
+    parser.add_argument('--db_url',
+                        dest='db_url',
+                        action='store',
+                        default=None,
+                        help='Use this database (its bigtable tables are dropped and created again!) '
+                             'instead of a temporary PostgreSQL')
+    parser.add_argument('--sharding',
+                        dest='sharding',
+                        action='store',
+                        default=None,
+                        choices=('hash', 'range'),
+                        help='Layout of the bigtable tables on yugabyte (default: BIGTABLE_SHARDING of config.py); '
+                             'existing tables are rebuilt')
+    parser.add_argument('--tablets',
+                        dest='tablets',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='Pre-split hash sharded tables into this many tablets (default: BIGTABLE_TABLETS)')
+    parser.add_argument('--corpus',
+                        dest='corpus',
+                        action='store',
+                        default=None,
+                        help='Directory for the generated corpus (kept; a temporary one is removed)')
+    parser.add_argument('--records',
+                        dest='records',
+                        action='store',
+                        default=0,
+                        type=int,
+                        help='Instead of the ingest, benchmark reads of this many records (ORM vs Core, '
+                             'the records table is emptied!)')
+    parser.add_argument('-o',
+                        '--output',
+                        dest='output',
+                        action='store',
+                        default='bench.json',
+                        help='Write the results into this JSON file')
+    parser.add_argument('--compare',
+                        dest='compare',
+                        action='store',
+                        default=None,
+                        help='Results of an earlier run; report commit sizes/writers that got slower')
+    parser.add_argument('--tolerance',
+                        dest='tolerance',
+                        action='store',
+                        default=0.1,
+                        type=float,
+                        help='Slowdown (fraction of files/s) tolerated by --compare')
+    args = parser.parse_args(argv)
+    if args.records and args.compare:
+        parser.error('--compare works with the ingest results only')
+
+    workdir = args.corpus or tempfile.mkdtemp(prefix='ybload-bench-')
+    postgresql = None
+    corpus = None
+    try:
+        if not args.records:
+            print('Generating corpus in {}'.format(workdir))
+            manifest, corpus = make_corpus(workdir, args.files, args.distribution, args.seed,
+                                           median=_ints(args.median)[0], huge_size=_ints(args.huge_size)[0])
+            print('Corpus: {}'.format(json.dumps(corpus, sort_keys=True)))
+
+        db_url = args.db_url
+        if db_url is None:
+            import testing.postgresql
+            postgresql = testing.postgresql.Postgresql()
+            db_url = postgresql.url()
+
+        from sqlalchemy import create_engine
+        from adsputils import load_config
+        from ybload.models import Base
+        from ybload import sharding
+        layout, tablets = sharding.from_config(load_config(proj_home=os.path.dirname(os.path.abspath(__file__))))
+        layout = args.sharding or layout
+        tablets = tablets if args.tablets is None else args.tablets
+        engine = create_engine(db_url)
+        with engine.begin() as connection:
+            yugabyte = sharding.configure(connection, layout, tablets)
+            if yugabyte and args.sharding:
+                for name in sorted(sharding.TABLES):
+                    if engine.dialect.has_table(connection, name):
+                        sharding.rebuild(connection, name, layout, tablets)
+            Base.metadata.create_all(connection)
+        engine.dispose()
+
+        if args.records:
+            results = bench_records(db_url, args.records, repeat=args.repeat)
+        else:
+            results = run_grid(db_url, manifest, _ints(args.commit_sizes), args.writers.split(','), workdir,
+                               repeat=args.repeat, ignore=_ints(args.max_file_size)[0],
+                               batch_rows=args.batch_rows, workers=args.workers)
+    finally:
+        if postgresql is not None:
+            postgresql.stop()
+        if not args.corpus:
+            shutil.rmtree(workdir)
+
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'machine': platform.platform(), 'cpus': multiprocessing.cpu_count(),
+              'database': args.db_url and 'external' or 'testing.postgresql',
+              'layout': {'sharding': yugabyte and layout or None, 'tablets': yugabyte and tablets or None},
+              'corpus': corpus, 'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fi:
+            regressions = compare(json.load(fi), report, args.tolerance)
+        if regressions:
+            print('Slower than {}: {}'.format(args.compare, json.dumps(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,7 +7,7 @@ import argparse
 import warnings
 import json
 import time
-from ybload import tasks
+from ybload import tasks, ingest, writers, compression, export, purge
 from adsputils import setup_logging, get_date, load_config
 from ybload.models import KeyValue, Records,BigTable
 from sqlalchemy.orm import load_only
@@ -72,81 +72,217 @@ def print_kvs():
 
 
 
-def truncate():
-    with app.session_scope() as s:
-        s.execute('truncate table bigtable')
-        s.commit()
-    app.logger.info('Truncated tables: bigtable')
-
-def ingest_binary_files(location, commit_after=1024*1024*100, ignore=1024*1024*200):
+def get_value(key, output=None, offset=0, length=None, block_size=1024*1024):
+    """Writes the value (or `length` bytes of it from `offset`) into the
+    output file (stdout by default); it is fetched in blocks of
+    `block_size` bytes, so that no large value has to fit in memory.
+    Returns the number of bytes written (None if the key does not exist)"""
+    if app.value_info(key) is None:
+        return None
+    written = 0
+    fo = output and open(output, 'wb') or sys.stdout.buffer
+    try:
+        for block in app.iter_value(key, block_size, offset, length):
+            fo.write(block)
+            written += len(block)
+    finally:
+        if output:
+            fo.close()
+        else:
+            fo.flush()
+    return written
+
+
+def print_sizes(prefix='', limit=None):
+    """Prints key, size and the way the value is stored for all keys that
+    start with the prefix (the values are not read)"""
+    n = 0
+    for v in app.list_values(prefix, limit):
+        print('{}\t{}\t{}'.format(v['key'], v['size'], v['codec'] and '{}/{}'.format(v['storage'], v['codec'])
+                                  or v['storage']))
+        n += 1
+    return n
+
+
+def export_bigtable(output, workers=1, partition='hash', ranges=None, run_id=None, resume=None,
+                    itersize=100, report=0):
+    """Writes all bigtable values into the output directory (or a tar file)"""
+    summary = export.export(app, output, workers=workers, partition=partition, ranges=ranges,
+                            run_id=run_id, resume=resume, itersize=itersize, report=report)
+    print('Export run: {} (continue with --export {} --resume {})'.format(summary['run_id'], output,
+                                                                         summary['run_id']))
+    print('Summary: {}'.format(json.dumps(summary, sort_keys=True)))
+    if summary['collisions']:
+        print('Warning: {} keys were not exported, their paths are taken by other keys: {}'.format(
+            len(summary['collisions']), ', '.join(summary['collisions'][:10])))
+    app.logger.info('Done exporting %s values, total=%i, summary=%s', summary['files'], summary['bytes'], summary)
+    return summary['files']
+
+
+def truncate(tables=('bigtable',)):
+    """Empties the tables (drops and creates them again)"""
+    names = [t.name for g in tables for t in purge.RESET.get(g, ())]
+    msg = 'Warning: dropping and creating again the tables: {}'.format(', '.join(names))
+    print(msg)
+    app.logger.warning(msg)
+    names = purge.reset(app, tables)
+    app.logger.info('Truncated tables: %s', ', '.join(names))
+
+
+def purge_keys(tables=('bigtable',), prefix=None, keys=None, workers=4, batch=1000, report=0, orphans=False):
+    """Deletes the keys starting with the prefix (or listed in the file
+    `keys`, one per line) from the tables"""
+    purger = purge.Purger(app, tables, workers=workers, batch=batch, report=report)
+    if keys is not None:
+        with (keys == '-' and sys.stdin or open(keys)) as fi:
+            summary = purger.by_keys(line.rstrip('\r\n') for line in fi if line.strip())
+    else:
+        summary = purger.by_prefix(prefix or '')
+    if orphans:
+        summary['orphans'] = purger.orphans()
+    print('Summary: {}'.format(json.dumps(summary, sort_keys=True)))
+    app.logger.info('Done purging %s rows, summary=%s', summary['rows'], summary)
+    return summary['rows']
+
+def ingest_binary_files(location, commit_after=1024*1024*100, ignore=1024*1024*200,
+                        workers=1, partition='lines', report=0, writer='row', batch_rows=1000,
+                        chunk_size=1024*1024*8, readers=4, max_prefetch=1024*1024*256,
+                        run_id=None, resume=None, prefilter=5000, bloom=None, bloom_capacity=10000000,
+                        content_addressed=False, upsert=False, codec=None, min_ratio=0.9,
+                        metrics_file=None, prom_file=None, metrics_interval=10, adaptive=False,
+                        commit_rows=None, min_commit=1024*1024, max_commit=1024*1024*1024,
+                        min_rows=100, max_rows=100000, target_latency=1.0, retries=5, retry_delay=0.1,
+                        strip_components=0, strip_prefix='', key_prefix='', crawlers=8,
+                        pack=False, segment_size=1024*1024*4, pack_max=1024*64):
     """Will receive a list full of file locations; will read it, open each
     and insert the binary data into the database (as blob).
-    
-    We are going to use direct db cursor and no ORM (io order to abuse the
-    db as much as possible)
-    """
 
-    connection = cursor = None
-
-    sql = "INSERT INTO {} VALUES(%s, %s) ON CONFLICT DO NOTHING".format(BigTable.__tablename__)
-    batch = []
-    i = 0
-    size = 0
-    total_size = 0
+    `location` can also be a .tar(.gz/.bz2/.xz) or .zip archive: its
+    members are then streamed into the db without being extracted; their
+    keys are the member paths without `strip_prefix` and the first
+    `strip_components` directories, prefixed with `key_prefix`.
+
+    When `location` is a directory, no manifest is needed: the tree is
+    walked by `crawlers` threads and files are ingested as they are found
+    (keys are the paths relative to the directory, with `key_prefix`).
+
+    With `pack`, files of up to `pack_max` bytes are concatenated into
+    segments of about `segment_size` bytes (bigtable_segments) and only a
+    narrow lookup row (bigtable_packed) is written per file; app.open_value()
+    reads them back the same way as the other values.
+
+    With workers > 1 the manifest is split between that many processes
+    (each with its own connection); partition='hash' assigns keys to
+    workers by ranges of the hash the server places rows by (yb_hash_code(),
+    so that on yugabyte the workers hit distinct tablets of the hash sharded
+    bigtable) instead of round-robin by line. Progress is printed every `report`
+    seconds.
+
+    `writer` selects how rows travel to the db: 'row' (INSERT per file),
+    'values' (multi-row INSERT of up to `batch_rows` files) or 'copy'
+    (binary COPY through a staging table).
+
+    Files larger than `ignore` are stored in `chunk_size` pieces (see
+    ybload.blobs); with chunk_size=0 they are skipped.
+
+    `readers` threads read files ahead of the db writes, holding at most
+    `max_prefetch` bytes in memory (readers=0 turns prefetching off).
+
+    Every commit saves a checkpoint under `run_id` (generated when not
+    given) in the KeyValue table; `resume` takes the id of an interrupted
+    run and continues right behind its checkpoints.
+
+    Keys that are already stored are dropped before their files are read
+    (looked up in batches of `prefilter` keys, 0 turns it off); `bloom`
+    is a path to a bloom filter of the stored keys that saves the lookups
+    of new keys (it is built from the bigtable when missing; the keys are
+    added as they are committed and it is saved after the ingest).
+
+    With `content_addressed`, unique contents are stored only once (in
+    bigtable_content, keyed by sha256) and bigtable rows point at them;
+    `upsert` replaces values of stored keys whose checksum changed.
+
+    `codec` (zlib, lzma, bz2) compresses every value that shrinks at least
+    to `min_ratio` of its size; the codec is recorded next to the value.
+
+    Every `metrics_interval` seconds the live measurements (stage timings,
+    files/s and MB/s over sliding windows, commit latency percentiles) are
+    appended to `metrics_file` as JSON lines and/or written to `prom_file`
+    in the Prometheus text format (see ybload.instrument); the summary
+    carries the final stage timings and commit latencies.
+
+    Every worker keeps one connection for the whole run and commits after
+    `commit_after` bytes (or `commit_rows` files); with `adaptive` these
+    budgets grow while commits take less than half of `target_latency`
+    seconds and shrink when they take longer, staying within
+    [min_commit, max_commit] bytes and [min_rows, max_rows] files (the
+    chosen sizes are logged).
+
+    Transient db errors (serialization failures, leader moves, dropped
+    connections, see ybload.retry) roll back only the current transaction,
+    which is then replayed up to `retries` times with a jittered
+    exponential backoff starting at `retry_delay` seconds; the summary
+    counts the retries.
+
+    Returns the number of inserted files.
+    """
 
-    try:
-        with open(location, 'r') as fi:
-            for line in fi:
-                if cursor is None:
-                    connection = app._engine.raw_connection()
-                    #connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                    cursor = connection.cursor()
-                    batch = []
-                    total_size += size
-                    size = 0
-                    
-                    
-
-                l = line.strip().split(maxsplit=1)
-                if len(l) == 1:
-                    l.append(l[0])
-                
-                if os.path.exists(l[1]):
-                    s = os.path.getsize(l[1])
-                    if s > ignore:
-                        app.logger.warn('Ignoring {} because it is too large'.format(l[1]))
-                        print('ignoring large file: {}'.format(l[1]))
-                        continue
-                    
-                    batch.append((i, l[1]))
-                    size += s
-
-                    with open(l[1], 'rb') as input:
-                        # Perform the insertions
-                        cursor.execute(sql, (l[0], psycopg2.Binary(input.read())))
-                        i += 1
-                        if size > commit_after:
-                            print('Committing: {} files, size: {}, total: {}'.format(i, size, total_size))
-                            connection.commit()
-                            cursor.close()
-                            connection.close()
-                            cursor = connection = None
-                            app.logger.info('Wrote: {} files, size: {}, total: {}'.format(i, size, total_size))
-                            
-            else:
-                if connection:
-                    connection.commit()
-                    cursor.close()
-                    connection.close()
-    except:
-        print('Failed, size={}, total={}, batch={}'.format(size, total_size, batch))
-        app.logger.error('Failed: size={}, total={}, batch={}'.format(size, total_size, batch))
-        raise
-
-
-    app.logger.info('Done inserting %s binary files, total=%i', i, total_size)
-
-    return i
+    ingest.check_options(upsert=upsert, pack=pack, codec=codec, content_addressed=content_addressed)
+    checkpoints = {}
+    if resume:
+        run, checkpoints = ingest.load_run(app, resume)
+        if run is None:
+            raise ValueError('Unknown ingest run: {}'.format(resume))
+        if (run['workers'], run['partition']) != (workers, partition):
+            app.logger.warning('Resuming run {} with its original workers={}, partition={}'.format(
+                resume, run['workers'], run['partition']))
+            workers, partition = run['workers'], run['partition']
+        run_id = resume
+    else:
+        run_id = run_id or ingest.new_run_id()
+        ingest.save_run(app, run_id, {'location': os.path.abspath(location), 'workers': workers,
+                                      'partition': partition, 'started': get_date().isoformat()})
+    print('Ingest run: {} (continue with --resume {})'.format(run_id, run_id))
+
+    bloom_filter = None
+    if bloom and prefilter:
+        bloom_filter = ingest.load_bloom(app, bloom, bloom_capacity)
+
+    kwargs = dict(partition=partition, writer=writer, batch_rows=batch_rows, chunk_size=chunk_size,
+                  readers=readers, max_prefetch=max_prefetch, run_id=run_id,
+                  prefilter=prefilter, bloom=bloom_filter, content_addressed=content_addressed,
+                  upsert=upsert, codec=codec, min_ratio=min_ratio, metrics_file=metrics_file,
+                  prom_file=prom_file, metrics_interval=metrics_interval, adaptive=adaptive,
+                  commit_rows=commit_rows, min_commit=min_commit, max_commit=max_commit,
+                  min_rows=min_rows, max_rows=max_rows, target_latency=target_latency,
+                  retries=retries, retry_delay=retry_delay)
+    archive_options = dict(strip_components=strip_components, strip_prefix=strip_prefix,
+                           key_prefix=key_prefix)
+    kwargs.update(archive_options, crawlers=crawlers, pack=pack, segment_size=segment_size, pack_max=pack_max,
+                  bloom_file=bloom_filter is not None and bloom or None)
+    start = time.time()
+    if workers > 1:
+        try:
+            results = ingest.ingest_parallel(app, location, commit_after=commit_after, ignore=ignore,
+                                             workers=workers, report=report, checkpoints=checkpoints, **kwargs)
+        finally:
+            # the workers added the keys they committed to their own copies
+            if bloom_filter is not None:
+                ingest.merge_bloom(bloom_filter, bloom, workers)
+    else:
+        reporter = ingest.Reporter(app.logger, report)
+        results = [ingest.ingest_files(app, location, commit_after, ignore, progress=reporter,
+                                       checkpoint=checkpoints.get(0), **kwargs).toJSON()]
+
+    summary = ingest.summarize(results, time.time() - start)
+    summary['run_id'] = run_id
+    print('Summary: {}'.format(json.dumps(summary, sort_keys=True)))
+    if summary['unreadable']:
+        print('Warning: {} directories or files could not be read (see the log)'.format(summary['unreadable']))
+    app.logger.info('Done inserting %s binary files, total=%i, summary=%s',
+                    summary['files'], summary['bytes'], summary)
+
+    return summary['files']
 
 
 if __name__ == '__main__':
@@ -169,6 +305,70 @@ if __name__ == '__main__':
                         action='store_true',
                         default=False,
                         help='Show current values of KV store')
+    parser.add_argument('-g',
+                        '--get',
+                        dest='get',
+                        action='store',
+                        default=None,
+                        help='Write the bigtable value of this key to stdout (or --output)')
+    parser.add_argument('--offset',
+                        dest='offset',
+                        action='store',
+                        default=0,
+                        type=int,
+                        help='With --get: start at this byte of the value')
+    parser.add_argument('--length',
+                        dest='length',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='With --get: write only this many bytes')
+    parser.add_argument('--block_size',
+                        dest='block_size',
+                        action='store',
+                        default=1024*1024,
+                        type=int,
+                        help='With --get: fetch the value in blocks of this size')
+    parser.add_argument('--output',
+                        dest='output',
+                        action='store',
+                        default=None,
+                        help='With --get: write into this file')
+    parser.add_argument('--sizes',
+                        dest='sizes',
+                        action='store',
+                        default=None,
+                        help='List keys starting with this prefix with the sizes of their values (use "" for all)')
+    parser.add_argument('--limit',
+                        dest='limit',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='With --sizes: list at most this many keys')
+    parser.add_argument('--export',
+                        dest='export',
+                        action='store',
+                        default=None,
+                        help='Write all bigtable values into this directory (or .tar, .tar.gz file, "-" for a tar on stdout); '
+                             'uses -w threads, --run_id and --resume')
+    parser.add_argument('--export_partition',
+                        dest='export_partition',
+                        action='store',
+                        default='hash',
+                        choices=export.PARTITIONS,
+                        help='With --export: split the keys by their hash (tablets) or into contiguous key ranges')
+    parser.add_argument('--ranges',
+                        dest='ranges',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='With --export: number of ranges scanned in parallel (default 4 per worker)')
+    parser.add_argument('--itersize',
+                        dest='itersize',
+                        action='store',
+                        default=100,
+                        type=int,
+                        help='With --export: rows fetched from the server at a time')
     parser.add_argument('-e',
                         '--batch_size',
                         dest='batch_size',
@@ -176,11 +376,44 @@ if __name__ == '__main__':
                         default=100,
                         type=int,
                         help='How many records to process/index in one batch')
-    parser.add_argument('-i',
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('-i',
                         '--ingest_keyvalue',
                         dest='ingest_keyvalue',
                         action='store',
-                        help='File containing key\tlocation; location will be read in as binary and inserted into bigtable')
+                        help='File containing key\tlocation; location will be read in as binary and inserted into bigtable '
+                             '(or a .tar, .tar.gz, .zip archive whose members are inserted)')
+    source.add_argument('--from_dir',
+                        '--from-dir',
+                        dest='from_dir',
+                        action='store',
+                        default=None,
+                        help='Ingest all files under this directory (keys are the relative paths); no manifest needed '
+                             '(not with -i)')
+    parser.add_argument('--crawlers',
+                        dest='crawlers',
+                        action='store',
+                        default=8,
+                        type=int,
+                        help='Number of threads listing directories with --from_dir')
+    parser.add_argument('--pack',
+                        dest='pack',
+                        action='store_true',
+                        default=False,
+                        help='Pack small files into shared segments instead of giving each of them a row '
+                             '(not with --upsert, --codec, --content_addressed)')
+    parser.add_argument('--segment_size',
+                        dest='segment_size',
+                        action='store',
+                        default=1024*1024*4,
+                        type=int,
+                        help='With --pack: size of the segments')
+    parser.add_argument('--pack_max',
+                        dest='pack_max',
+                        action='store',
+                        default=1024*64,
+                        type=int,
+                        help='With --pack: files up to this size are packed, larger ones get their own row')
     parser.add_argument('-c',
                         '--max_commit_size',
                         dest='max_commit_size',
@@ -192,13 +425,233 @@ if __name__ == '__main__':
                         dest='max_file_size',
                         action='store',
                         default=1024*1024*60,
-                        help='Files larger than this will be ignored')
+                        help='Files larger than this will be stored in chunks (or ignored, with --chunk_size 0)')
+    parser.add_argument('--chunk_size',
+                        dest='chunk_size',
+                        action='store',
+                        default=1024*1024*8,
+                        type=int,
+                        help='Size of the pieces that large files are split into')
     parser.add_argument('-x',
                         '--truncate',
                         dest='truncate',
                         action='store_true',
                         default=False,
-                        help='Truncate database before commencing')
+                        help='Empty the bigtable tables before commencing: bigtable, bigtable_chunks, '
+                             'bigtable_content, bigtable_segments and bigtable_packed are dropped and '
+                             'created again (see --reset)')
+    parser.add_argument('--purge_prefix',
+                        dest='purge_prefix',
+                        action='store',
+                        default=None,
+                        help='Delete the keys that start with this prefix from the --purge_tables (use "" for all)')
+    parser.add_argument('--purge_keys',
+                        dest='purge_keys',
+                        action='store',
+                        default=None,
+                        help='Delete the keys listed in this file (one per line, "-" for stdin) from the --purge_tables')
+    parser.add_argument('--purge_tables',
+                        dest='purge_tables',
+                        action='store',
+                        default='bigtable',
+                        help='Comma separated tables for --purge_prefix/--purge_keys/--reset: {}'.format(
+                            ', '.join(sorted(purge.GROUPS))))
+    parser.add_argument('--purge_batch',
+                        dest='purge_batch',
+                        action='store',
+                        default=1000,
+                        type=int,
+                        help='Max number of rows deleted (and committed) at once; the deletes run in -w threads')
+    parser.add_argument('--orphans',
+                        dest='orphans',
+                        action='store_true',
+                        default=False,
+                        help='After a purge also delete the shared content and segments no key points to')
+    parser.add_argument('--reset',
+                        dest='reset',
+                        action='store_true',
+                        default=False,
+                        help='Drop the --purge_tables and create them again, empty')
+    parser.add_argument('-w',
+                        '--workers',
+                        dest='workers',
+                        action='store',
+                        default=1,
+                        type=int,
+                        help='Split the ingest between this many processes (each with its own connection)')
+    parser.add_argument('--partition',
+                        dest='partition',
+                        action='store',
+                        default='lines',
+                        choices=ingest.PARTITIONS,
+                        help='How to split the manifest between workers: round-robin by lines, or by ranges of the '
+                             'key hash (yb_hash_code(), every worker writes into its own tablets)')
+    parser.add_argument('-r',
+                        '--report',
+                        dest='report',
+                        action='store',
+                        default=60,
+                        type=int,
+                        help='Print ingest progress every this many seconds (0 to disable)')
+    parser.add_argument('--writer',
+                        dest='writer',
+                        action='store',
+                        default='row',
+                        choices=sorted(writers.WRITERS),
+                        help='How to send rows: INSERT per file (row), multi-row INSERT (values) or binary COPY (copy)')
+    parser.add_argument('--batch_rows',
+                        dest='batch_rows',
+                        action='store',
+                        default=1000,
+                        type=int,
+                        help='Max number of files sent in one statement by the values/copy writers')
+    parser.add_argument('--readers',
+                        dest='readers',
+                        action='store',
+                        default=4,
+                        type=int,
+                        help='Number of threads reading files ahead of the db writes (0 to read serially)')
+    parser.add_argument('--max_prefetch',
+                        dest='max_prefetch',
+                        action='store',
+                        default=1024*1024*256,
+                        type=int,
+                        help='Max bytes of file contents read ahead (per worker)')
+    parser.add_argument('--run_id',
+                        dest='run_id',
+                        action='store',
+                        default=None,
+                        help='Name of the ingest run (its checkpoints are saved under this name)')
+    parser.add_argument('--resume',
+                        dest='resume',
+                        action='store',
+                        default=None,
+                        help='Id of an interrupted ingest (or export) run; continue where it stopped '
+                             '(a resumed tar export goes into a new <name>.partN.tar)')
+    parser.add_argument('--prefilter',
+                        dest='prefilter',
+                        action='store',
+                        default=5000,
+                        type=int,
+                        help='Look up this many keys at once and skip files that are already stored (0 to disable)')
+    parser.add_argument('--bloom',
+                        dest='bloom',
+                        action='store',
+                        default=None,
+                        help='File with a bloom filter of stored keys (created from the bigtable when missing)')
+    parser.add_argument('--bloom_capacity',
+                        dest='bloom_capacity',
+                        action='store',
+                        default=10000000,
+                        type=int,
+                        help='Expected number of keys when creating a new bloom filter')
+    parser.add_argument('--content_addressed',
+                        dest='content_addressed',
+                        action='store_true',
+                        default=False,
+                        help='Store each unique content only once (keyed by its sha256)')
+    parser.add_argument('--upsert',
+                        dest='upsert',
+                        action='store_true',
+                        default=False,
+                        help='Update stored keys whose content changed (instead of leaving them alone)')
+    parser.add_argument('--codec',
+                        dest='codec',
+                        action='store',
+                        default='none',
+                        choices=compression.NAMES,
+                        help='Compress values with this codec (only when it pays off)')
+    parser.add_argument('--min_ratio',
+                        dest='min_ratio',
+                        action='store',
+                        default=0.9,
+                        type=float,
+                        help='Store a value compressed only if it shrinks to this fraction of its size')
+    parser.add_argument('--metrics_file',
+                        dest='metrics_file',
+                        action='store',
+                        default=None,
+                        help='Append live ingest metrics (stage timings, throughput, commit latency) to this JSON-lines file')
+    parser.add_argument('--prom_file',
+                        dest='prom_file',
+                        action='store',
+                        default=None,
+                        help='Keep live ingest metrics in this file in the Prometheus text format (for the node exporter textfile collector)')
+    parser.add_argument('--metrics_interval',
+                        dest='metrics_interval',
+                        action='store',
+                        default=10,
+                        type=int,
+                        help='Write the metrics every this many seconds')
+    parser.add_argument('--commit_rows',
+                        dest='commit_rows',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='Also commit after this many files')
+    parser.add_argument('--adaptive',
+                        dest='adaptive',
+                        action='store_true',
+                        default=False,
+                        help='Grow/shrink the commit size (bytes and files) according to the commit latency')
+    parser.add_argument('--target_latency',
+                        dest='target_latency',
+                        action='store',
+                        default=1.0,
+                        type=float,
+                        help='Adaptive commits: shrink the transactions when a commit takes longer than this (seconds)')
+    parser.add_argument('--min_commit',
+                        dest='min_commit',
+                        action='store',
+                        default=1024*1024,
+                        type=int,
+                        help='Adaptive commits: never commit fewer bytes than this')
+    parser.add_argument('--max_commit',
+                        dest='max_commit',
+                        action='store',
+                        default=1024*1024*1024,
+                        type=int,
+                        help='Adaptive commits: never commit more bytes than this')
+    parser.add_argument('--min_rows',
+                        dest='min_rows',
+                        action='store',
+                        default=100,
+                        type=int,
+                        help='Adaptive commits: lower bound of files per transaction')
+    parser.add_argument('--max_rows',
+                        dest='max_rows',
+                        action='store',
+                        default=100000,
+                        type=int,
+                        help='Adaptive commits: upper bound of files per transaction')
+    parser.add_argument('--retries',
+                        dest='retries',
+                        action='store',
+                        default=5,
+                        type=int,
+                        help='Replay a transaction that failed with a transient error at most this many times')
+    parser.add_argument('--retry_delay',
+                        dest='retry_delay',
+                        action='store',
+                        default=0.1,
+                        type=float,
+                        help='Base of the (jittered, exponential) backoff between retries, in seconds')
+    parser.add_argument('--strip_components',
+                        dest='strip_components',
+                        action='store',
+                        default=0,
+                        type=int,
+                        help='Archives: drop this many leading directories of the member paths to get the keys')
+    parser.add_argument('--strip_prefix',
+                        dest='strip_prefix',
+                        action='store',
+                        default='',
+                        help='Archives: remove this prefix from the member paths to get the keys')
+    parser.add_argument('--key_prefix',
+                        dest='key_prefix',
+                        action='store',
+                        default='',
+                        help='Archives: prepend this to the keys')
  
 
 
@@ -206,21 +659,75 @@ if __name__ == '__main__':
 
     logger.info('Executing run.py: %s', args)
 
+    purge_tables = [t.strip() for t in args.purge_tables.split(',') if t.strip()]
+
     if args.truncate:
         truncate()
 
+    if args.reset:
+        truncate(purge_tables)
+
+    if args.purge_prefix is not None or args.purge_keys:
+        print('Done purging {} rows'.format(purge_keys(purge_tables, prefix=args.purge_prefix, keys=args.purge_keys,
+                                                       workers=args.workers, batch=args.purge_batch,
+                                                       report=args.report, orphans=args.orphans)))
+
     if args.bibcodes:
         args.bibcodes = args.bibcodes.split(' ')
 
     if args.kv:
         print_kvs()
 
-    if args.ingest_keyvalue:
-        if os.path.exists(args.ingest_keyvalue):
+    if args.sizes is not None:
+        print_sizes(args.sizes, args.limit)
+
+    if args.get:
+        if get_value(args.get, args.output, args.offset, args.length, args.block_size) is None:
+            exit('The key {} does not exist'.format(args.get))
+
+    if args.export:
+        print('Done exporting {} objects'.format(export_bigtable(args.export, workers=args.workers,
+                                                                 partition=args.export_partition,
+                                                                 ranges=args.ranges, run_id=args.run_id,
+                                                                 resume=args.resume, itersize=args.itersize,
+                                                                 report=args.report)))
+
+    location = args.ingest_keyvalue or args.from_dir
+    if location:
+        if os.path.exists(location):
             print('Starting ingest')
-            print('Done ingesting {} objects'.format(ingest_binary_files(args.ingest_keyvalue, int(args.max_commit_size), int(args.max_file_size))))
+            print('Done ingesting {} objects'.format(ingest_binary_files(location, int(args.max_commit_size), int(args.max_file_size),
+                                                                         workers=args.workers, partition=args.partition,
+                                                                         report=args.report, writer=args.writer,
+                                                                         batch_rows=args.batch_rows, chunk_size=args.chunk_size,
+                                                                         readers=args.readers, max_prefetch=args.max_prefetch,
+                                                                         run_id=args.run_id, resume=args.resume,
+                                                                         prefilter=args.prefilter, bloom=args.bloom,
+                                                                         bloom_capacity=args.bloom_capacity,
+                                                                         content_addressed=args.content_addressed,
+                                                                         upsert=args.upsert, codec=args.codec,
+                                                                         min_ratio=args.min_ratio,
+                                                                         metrics_file=args.metrics_file,
+                                                                         prom_file=args.prom_file,
+                                                                         metrics_interval=args.metrics_interval,
+                                                                         adaptive=args.adaptive,
+                                                                         commit_rows=args.commit_rows,
+                                                                         min_commit=args.min_commit,
+                                                                         max_commit=args.max_commit,
+                                                                         min_rows=args.min_rows,
+                                                                         max_rows=args.max_rows,
+                                                                         target_latency=args.target_latency,
+                                                                         retries=args.retries,
+                                                                         retry_delay=args.retry_delay,
+                                                                         strip_components=args.strip_components,
+                                                                         strip_prefix=args.strip_prefix,
+                                                                         key_prefix=args.key_prefix,
+                                                                         crawlers=args.crawlers,
+                                                                         pack=args.pack,
+                                                                         segment_size=args.segment_size,
+                                                                         pack_max=args.pack_max)))
         else:
-            exit('The {} does not exist'.format(args.ingest_keyvalue))
+            exit('The {} does not exist'.format(location))
 
 
     if args.diagnostics:
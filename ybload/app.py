@@ -2,18 +2,88 @@
 from __future__ import absolute_import, unicode_literals
 from past.builtins import basestring
 from ybload.models import ChangeLog, IdentifierMapping, MetricsBase, MetricsModel, Records
+from ybload import blobs, coalesce, cache, records
 from adsputils import ADSCelery, create_engine, sessionmaker, scoped_session, contextmanager
-from sqlalchemy.orm import load_only as _load_only
 from sqlalchemy import Table, bindparam
 import adsputils
 import json
+import os
+import threading
+from itertools import islice
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
 from sqlalchemy import exc
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+# update_storage() types: (column, column with the time of the update,
+# whether the previous value goes into the change_log)
+STORAGE_TYPES = {
+    'metadata': ('bib_data', 'bib_data_updated', True),
+    'bib_data': ('bib_data', 'bib_data_updated', True),
+    'nonbib_data': ('nonbib_data', 'nonbib_data_updated', True),
+    'orcid_claims': ('orcid_claims', 'orcid_claims_updated', True),
+    'fulltext': ('fulltext', 'fulltext_updated', False),
+    'metrics': ('metrics', 'metrics_updated', False),
+    'augment': ('augments', 'augments_updated', False),
+}
+
+# mark_processed() types: (column with the time, column with the checksum)
+PROCESSED_TYPES = {
+    'solr': ('solr_processed', 'solr_checksum'),
+    'metrics': ('metrics_processed', 'metrics_checksum'),
+    'links': ('datalinks_processed', 'datalinks_checksum'),
+}
+
+_DATA = sorted(set((v[0], v[1]) for v in STORAGE_TYPES.values()))
+_LOGGED = sorted(set(v[0] for v in STORAGE_TYPES.values() if v[2]))
+
+# one statement for a batch of update_storage() items (with distinct
+# bibcodes): the previous values (for the change_log) are read in the same
+# snapshot the upsert starts from; a column is only touched by the items
+# that set it (they come with its *_updated time)
+_upsert_sql = (
+    'WITH v (bibcode, {data}, {updated}, created, updated) AS (VALUES %s), '
+    'old AS (SELECT r.bibcode, {old} FROM {t} r JOIN v ON v.bibcode = r.bibcode), '
+    'up AS (INSERT INTO {t} (bibcode, {data}, {updated}, created, updated) '
+    'SELECT bibcode, {data}, {updated}, created, updated FROM v '
+    'ON CONFLICT (bibcode) DO UPDATE SET {assign}, updated = EXCLUDED.updated RETURNING {t}.*) '
+    'SELECT up.*, {old_as} FROM up LEFT JOIN old ON old.bibcode = up.bibcode').format(
+        t=Records.__tablename__,
+        data=', '.join(d for d, _ in _DATA), updated=', '.join(u for _, u in _DATA),
+        old=', '.join('r.{}'.format(c) for c in _LOGGED),
+        old_as=', '.join('old.{c} AS old_{c}'.format(c=c) for c in _LOGGED),
+        assign=', '.join('{d} = CASE WHEN EXCLUDED.{u} IS NULL THEN {t}.{d} ELSE EXCLUDED.{d} END, '
+                         '{u} = coalesce(EXCLUDED.{u}, {t}.{u})'.format(d=d, u=u, t=Records.__tablename__)
+                         for d, u in _DATA))
+_upsert_template = '(%s, {}, {}, %s::timestamp, %s::timestamp)'.format(
+    ', '.join(['%s::text'] * len(_DATA)), ', '.join(['%s::timestamp'] * len(_DATA)))
+
+
+_MISSING = object()
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class YBLoader(ADSCelery):
     def __init__(self, app_name, *args, **kwargs):
         ADSCelery.__init__(self, app_name, *args, **kwargs)
         #self.create_database()
+        self._marks = None
+        self._marks_lock = threading.Lock()
+        # optional cache of get_record() (RECORD_CACHE_SIZE entries, 0 turns it off)
+        self.record_cache = None
+        if self._config.get('RECORD_CACHE_SIZE', 0):
+            self.record_cache = cache.RecordCache(self._config.get('RECORD_CACHE_SIZE'),
+                                                  self._config.get('RECORD_CACHE_TTL', 60))
         
 
     def update_storage(self, bibcode, type, payload):
@@ -66,40 +136,197 @@ class YBLoader(ADSCelery):
             out = r.toJSON()
             try:
                 session.commit()
+                self._invalidate([bibcode])
                 return out
             except exc.IntegrityError:
                 self.logger.exception('error in app.update_storage while updating database for bibcode {}, type {}'.format(bibcode, type))
                 session.rollback()
                 raise
     
+    def update_storage_bulk(self, items, batch_size=1000):
+        """Bulk variant of update_storage(): applies the (bibcode, type,
+        payload) items with one upsert and one multi-row change_log insert
+        per batch of `batch_size` items (a batch ends early when a bibcode
+        comes again), committing every batch.
+
+        returns the sql records (as json objects) after every item, in the
+        order of the items"""
+        out = []
+        batch = []
+        seen = set()
+        for bibcode, type, payload in items:
+            if type not in STORAGE_TYPES:
+                raise Exception('Unknown type: %s' % type)
+            if bibcode in seen or len(batch) >= batch_size:
+                out.extend(self._update_storage_batch(batch))
+                batch = []
+                seen = set()
+            if not isinstance(payload, basestring):
+                payload = json.dumps(payload)
+            batch.append((bibcode, type, payload))
+            seen.add(bibcode)
+        if batch:
+            out.extend(self._update_storage_batch(batch))
+        return out
+
+    def _update_storage_batch(self, batch):
+        now = adsputils.get_date()
+        rows = []
+        for bibcode, type, payload in batch:
+            column = STORAGE_TYPES[type][0]
+            rows.append([bibcode] + [payload if d == column else None for d, _ in _DATA] +
+                        [now if d == column else None for d, _ in _DATA] + [now, now])
+        connection = self._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            returned = execute_values(cursor, _upsert_sql, rows, template=_upsert_template,
+                                      page_size=len(rows), fetch=True)
+            names = [d[0] for d in cursor.description]
+            stored = {}
+            for row in returned:
+                row = dict(zip(names, row))
+                stored[row['bibcode']] = row
+
+            changes = []
+            for bibcode, type, payload in batch:
+                column, _, logged = STORAGE_TYPES[type]
+                oldval = 'not-stored'
+                if logged:
+                    oldval = stored[bibcode]['old_' + column]
+                changes.append((now, bibcode, type, oldval, False))
+            execute_values(cursor, 'INSERT INTO {} (created, key, type, oldvalue, permanent) VALUES %s'.format(
+                ChangeLog.__tablename__), changes, page_size=len(changes))
+            connection.commit()
+        except psycopg2.IntegrityError:
+            self.logger.exception('error in app.update_storage_bulk while updating database for {} bibcodes'.format(
+                len(batch)))
+            connection.rollback()
+            raise
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        self._invalidate([bibcode for bibcode, _, _ in batch])
+
+        columns = set(c.name for c in Records.__table__.columns)
+        out = []
+        for bibcode, type, payload in batch:
+            r = Records(**dict((k, v) for k, v in stored[bibcode].items() if k in columns))
+            out.append(r.toJSON())
+        return out
+
     def get_record(self, bibcode, load_only=None):
         if isinstance(bibcode, list):
-            out = []
-            with self.session_scope() as session:
-                q = session.query(Records).filter(Records.bibcode.in_(bibcode))
-                if load_only:
-                    q = q.options(_load_only(*load_only))
-                for r in q.all():
-                    out.append(r.toJSON(load_only=load_only))
-            return out
+            if self.record_cache is None or (load_only and 'bibcode' not in load_only):
+                return list(self.iter_records(bibcode, load_only))
+            return self._get_cached_records(bibcode, load_only)
         else:
-            with self.session_scope() as session:
-                q = session.query(Records).filter_by(bibcode=bibcode)
-                if load_only:
-                    q = q.options(_load_only(*load_only))
-                r = q.first()
-                if r is None:
-                    return None
-                return r.toJSON(load_only=load_only)
-
-    def mark_processed(self, bibcodes, type, checksums=None, status=None):
+            if self.record_cache is not None:
+                generation = self.record_cache.generation
+                r = self.record_cache.get(bibcode, load_only, _MISSING)
+                if r is not _MISSING:
+                    return r
+            r = records.read(self._engine, [bibcode], load_only)
+            r = r and r[0] or None
+            if self.record_cache is not None:
+                self.record_cache.put(bibcode, load_only, r, generation)
+            return r
+
+    def _get_cached_records(self, bibcodes, load_only=None):
+        # the cached records and the others fetched (and cached)
+        generation = self.record_cache.generation
+        out = []
+        misses = []
+        for bibcode in OrderedDict.fromkeys(bibcodes):
+            r = self.record_cache.get(bibcode, load_only, _MISSING)
+            if r is _MISSING:
+                misses.append(bibcode)
+            elif r is not None:
+                out.append(r)
+        found = set()
+        for r in self.iter_records(misses, load_only):
+            self.record_cache.put(r['bibcode'], load_only, r, generation)
+            found.add(r['bibcode'])
+            out.append(r)
+        for bibcode in misses:
+            if bibcode not in found:
+                self.record_cache.put(bibcode, load_only, None, generation)
+        return out
+
+    def _invalidate(self, bibcodes):
+        if self.record_cache is not None:
+            self.record_cache.invalidate(bibcodes)
+
+    def cache_stats(self):
+        """Counters of the record cache (None when it is off)"""
+        return self.record_cache is not None and self.record_cache.stats() or None
+
+    def iter_records(self, bibcodes, load_only=None, chunk_size=1000, threads=0):
+        """Yields toJSON() of the records of the bibcodes (any iterable, of
+        any length), querying `chunk_size` of them at a time. With threads
+        the chunks are fetched concurrently (every thread with its own
+        connection) and come out in the order they arrive; at most 2 * threads
+        chunks are held at once."""
+        chunks = _chunks(bibcodes, chunk_size)
+        if not threads:
+            for chunk in chunks:
+                for r in self._get_records(chunk, load_only):
+                    yield r
+            return
+        with ThreadPoolExecutor(threads) as pool:
+            pending = set()
+            for chunk in chunks:
+                pending.add(pool.submit(self._get_records, chunk, load_only))
+                if len(pending) >= threads * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        for r in f.result():
+                            yield r
+            for f in as_completed(pending):
+                for r in f.result():
+                    yield r
+
+    def _get_records(self, bibcodes, load_only=None):
+        # Core reads of the projection, see ybload.records
+        return records.read(self._engine, bibcodes, load_only)
+
+    def open_value(self, key):
+        """Returns a read-only stream over the bigtable value (chunked
+        values are reassembled piece by piece) or None if the key is not
+        there; the caller should close it."""
+        return blobs.open_value(self._engine, key)
+
+    def value_info(self, key):
+        """Size, storage, chunks and codec of the value (without reading
+        it) or None if the key is not there."""
+        return blobs.value_info(self._engine, key)
+
+    def read_range(self, key, start=0, length=None):
+        """Returns `length` bytes of the value from `start` (cut out by the
+        server) or None if the key is not there."""
+        return blobs.read_range(self._engine, key, start, length)
+
+    def iter_value(self, key, block_size=1024*1024, start=0, length=None):
+        """Yields the value (or its range) in blocks of `block_size` bytes."""
+        return blobs.iter_value(self._engine, key, block_size, start, length)
+
+    def list_values(self, prefix='', limit=None):
+        """Yields key, size, storage, chunks and codec of the values whose
+        keys start with the prefix; the values themselves are not read."""
+        return blobs.list_values(self._engine, prefix, limit)
+
+    def mark_processed(self, bibcodes, type, checksums=None, status=None, batch_size=1000):
         """
         Updates the timesstamp for all documents that match the bibcodes.
         Optionally also sets the status (which says what actually happened
         with the document) and the checksum.
         Parameters bibcodes and checksums are expected to be lists of equal
         size with correspondence one to one, except if checksum is None (in
-        this case, checksums are not updated).
+        this case, the checksums are set to NULL).
+
+        The documents are updated `batch_size` at a time, each batch with
+        one statement (in its own transaction).
         """
 
         # avoid updating whole database (when the set is empty)
@@ -107,25 +334,71 @@ class YBLoader(ADSCelery):
             return
 
         now = adsputils.get_date()
-        updt = {'processed': now}
-        if status:
-            updt['status'] = status
         self.logger.debug('Marking docs as processed: now=%s, num bibcodes=%s', now, len(bibcodes))
-        if type == 'solr':
-            timestamp_column = 'solr_processed'
-            checksum_column = 'solr_checksum'
-        elif type == 'metrics':
-            timestamp_column = 'metrics_processed'
-            checksum_column = 'metrics_checksum'
-        elif type == 'links':
-            timestamp_column = 'datalinks_processed'
-            checksum_column = 'datalinks_checksum'
-        else:
+        if type not in PROCESSED_TYPES:
+            raise ValueError('invalid type value of %s passed, must be solr, metrics or links' % type)
+        timestamp_column, checksum_column = PROCESSED_TYPES[type]
+
+        assign = ['processed = v.now', '{} = v.now'.format(timestamp_column),
+                  '{} = v.checksum'.format(checksum_column)]
+        if status:
+            assign.append('status = CAST(v.status AS status)')
+        sql = ('UPDATE {t} SET {assign} FROM (VALUES %s) AS v (bibcode, checksum, now, status) '
+               'WHERE {t}.bibcode = v.bibcode').format(t=Records.__tablename__, assign=', '.join(assign))
+
+        # one row per bibcode (the last checksum wins, like with one update after another)
+        rows = dict(zip(bibcodes, checksums or [None] * len(bibcodes)))
+        rows = [(bibcode, checksum, now, status) for bibcode, checksum in rows.items()]
+        connection = self._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for i in range(0, len(rows), batch_size):
+                chunk = rows[i:i + batch_size]
+                execute_values(cursor, sql, chunk, template='(%s, %s::text, %s::timestamp, %s::text)',
+                               page_size=len(chunk))
+                connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+            # also when only some of the batches went through
+            self._invalidate(bibcodes)
+
+    def mark_processed_coalesced(self, bibcodes, type, checksums=None, status=None, wait=True, timeout=None):
+        """Like mark_processed(), but the request is merged with the ones
+        made (by other threads) at about the same time into one bulk update,
+        see ybload.coalesce. Waits until it is committed and raises its
+        error; with wait=False returns a Future instead."""
+        if type not in PROCESSED_TYPES:
             raise ValueError('invalid type value of %s passed, must be solr, metrics or links' % type)
-        updt[timestamp_column] = now
-        checksums = checksums or [None] * len(bibcodes)
-        for bibcode, checksum in zip(bibcodes, checksums):
-            updt[checksum_column] = checksum
-            with self.session_scope() as session:
-                session.query(Records).filter_by(bibcode=bibcode).update(updt, synchronize_session=False)
-        session.commit()
\ No newline at end of file
+        future = self._mark_aggregator().submit(bibcodes, type, checksums, status)
+        if not wait:
+            return future
+        return future.result(timeout)
+
+    def _mark_aggregator(self):
+        # one per process (a forked worker starts its own)
+        with self._marks_lock:
+            if self._marks is None or self._marks.pid != os.getpid():
+                self._marks = coalesce.MarkAggregator(self.mark_processed,
+                                                      self._config.get('MARK_PROCESSED_BATCH', 5000),
+                                                      self._config.get('MARK_PROCESSED_DELAY', 1.0), self.logger)
+            return self._marks
+
+    def flush_marks(self):
+        """Sends the buffered mark_processed_coalesced() requests now"""
+        if self._marks is not None and self._marks.pid == os.getpid():
+            self._marks.flush()
+
+    def close_marks(self):
+        """Flushes the buffered mark_processed_coalesced() requests and
+        stops the aggregator"""
+        with self._marks_lock:
+            marks, self._marks = self._marks, None
+        if marks is not None and marks.pid == os.getpid():
+            marks.close()
+
+    def close_app(self):
+        self.close_marks()
+        ADSCelery.close_app(self)
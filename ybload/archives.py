@@ -0,0 +1,125 @@
+"""Ingest straight out of archives: members of tar (plain, gz, bz2, xz) and
+zip files are read one after another and go into the bigtable without
+being extracted to disk.
+
+Keys are derived from the member paths: `strip_prefix` is cut off the
+front, then `strip_components` leading directories are dropped (like tar
+--strip-components) and `key_prefix` is prepended. Only regular files are
+ingested; their position among the regular files of the archive plays the
+role of the manifest line number (for partitioning and resuming).
+
+The archive is read in one stream: the contents of the members come
+with their entries, read right when the stream gets to them, so nothing
+that buffers the entries later (ingest.Prefilter, ingest.HashPartition)
+makes the archive seek back.
+"""
+
+import time
+import tarfile
+import zipfile
+
+
+EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+
+
+def is_archive(location):
+    return location.lower().endswith(EXTENSIONS)
+
+
+def member_key(name, strip_components=0, strip_prefix='', key_prefix=''):
+    """Key of the member called `name`; None when nothing is left of it"""
+    while name.startswith('./'):
+        name = name[2:]
+    if strip_prefix and name.startswith(strip_prefix):
+        name = name[len(strip_prefix):]
+    parts = [p for p in name.split('/') if p]
+    parts = parts[strip_components:]
+    if not parts:
+        return None
+    return key_prefix + '/'.join(parts)
+
+
+class Archive(object):
+    """Reader of a tar or zip archive; members are listed in the archive
+    order. A member can also be opened later, but a compressed tar then
+    has to be decompressed from the start again (which only happens when
+    a file is read a second time: a replayed transaction or a large
+    member compared by upsert)"""
+
+    def __init__(self, location, strip_components=0, strip_prefix='', key_prefix=''):
+        self.location = location
+        self.strip_components = strip_components
+        self.strip_prefix = strip_prefix
+        self.key_prefix = key_prefix
+        if location.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(location)
+            self.tar = None
+        else:
+            self.tar = tarfile.open(location, 'r:*')
+            self.zip = None
+
+    def _members(self):
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if not info.filename.endswith('/'):
+                    yield info.filename, info
+        else:
+            while True:
+                info = self.tar.next()
+                if info is None:
+                    break
+                # the TarFile remembers every member it went through, we do not
+                # need that (and with millions of members can not afford it)
+                self.tar.members = []
+                if info.isfile():
+                    yield info.name, info
+
+    def entries(self, lineno=0, ignore=None, select=None, metrics=None):
+        """Yields (lineno, offset, key, member) like ingest.read_manifest();
+        members before `lineno` are skipped (offset is always 0).
+
+        With `ignore`, the members are read as the stream goes (the
+        counterpart of ingest.read_files()) and the entries are (lineno,
+        offset, key, member, size, data), data being None for members
+        larger than `ignore` - they have to be streamed by open() before
+        the next entry is asked for. Members whose line number `select`
+        turns down are neither yielded nor read."""
+        n = 0
+        for name, member in self._members():
+            key = member_key(name, self.strip_components, self.strip_prefix, self.key_prefix)
+            if key is None:
+                continue
+            if n >= lineno and (select is None or select(n)):
+                if ignore is None:
+                    yield n, 0, key, member
+                else:
+                    yield self._read(n, key, member, ignore, metrics)
+            n += 1
+
+    def _read(self, lineno, key, member, ignore, metrics=None):
+        size = self.size(member)
+        data = None
+        if size <= ignore:
+            t = time.time()
+            with self.open(member) as input:
+                data = input.read()
+            if metrics:
+                metrics.timed('read', time.time() - t)
+        return lineno, 0, key, member, size, data
+
+    def keys(self):
+        for _, _, key, _ in self.entries():
+            yield key
+
+    def size(self, member):
+        if self.zip is not None:
+            return member.file_size
+        return member.size
+
+    def open(self, member):
+        if self.zip is not None:
+            return self.zip.open(member)
+        return self.tar.extractfile(member)
+
+    def close(self):
+        (self.zip or self.tar).close()
@@ -0,0 +1,352 @@
+"""Values that are too large for one bigtable row are split into
+fixed-size pieces stored in `bigtable_chunks`, keyed by (key, chunk_no).
+The bigtable row then only serves as a manifest: its value is NULL and it
+records the total size and the number of chunks. The manifest row is
+written last, so a value is visible only once all of its pieces are in.
+"""
+
+import io
+import hashlib
+import psycopg2
+from sqlalchemy import text
+from ybload import compression
+from ybload.models import BigTable, BigTableChunk, BigTableContent, BigTablePacked, BigTableSegment
+
+
+def exists(cursor, key):
+    """True if the key is already stored in the bigtable"""
+    cursor.execute('SELECT 1 FROM {} WHERE key = %s'.format(BigTable.__tablename__), (key,))
+    return cursor.fetchone() is not None
+
+
+def stored_digest(cursor, key):
+    """(True, digest) if the key is stored in the bigtable, (False, None)
+    otherwise"""
+    cursor.execute('SELECT digest FROM {} WHERE key = %s'.format(BigTable.__tablename__), (key,))
+    row = cursor.fetchone()
+    return row is not None, row and row[0]
+
+
+def checksum(input, block_size=1024*1024):
+    """sha256 (hex) of what is left in the file object"""
+    h = hashlib.sha256()
+    while True:
+        block = input.read(block_size)
+        if not block:
+            return h.hexdigest()
+        h.update(block)
+
+
+def write_chunked(cursor, key, input, chunk_size, after_chunk=None, codec=None, min_ratio=0.9,
+                  digest=None, replace=False):
+    """Streams the file object into the chunk table and then writes the
+    manifest row; only one piece is held in memory at any time.
+
+    Every piece is compressed with the `codec`, unless the first one shows
+    that it does not pay off (then all pieces are stored as they are).
+    `after_chunk(nbytes)` is called after every piece was sent (the caller
+    may commit there). `digest` (of the whole value) goes into the manifest.
+
+    With `replace`, the manifest of a stored key is overwritten (whatever
+    the old value was) and the pieces of a longer old value are deleted;
+    otherwise a stored key keeps its manifest. Returns (size, chunks)
+    """
+    sql = ('INSERT INTO {} (key, chunk_no, value) VALUES (%s, %s, %s) '
+           'ON CONFLICT (key, chunk_no) DO UPDATE SET value = EXCLUDED.value').format(BigTableChunk.__tablename__)
+    size = chunks = 0
+    while True:
+        data = input.read(chunk_size)
+        if not data:
+            break
+        if chunks == 0:
+            stored, codec = compression.encode(data, codec, min_ratio)
+        else:
+            stored = compression.compress(data, codec)
+        cursor.execute(sql, (key, chunks, psycopg2.Binary(stored)))
+        chunks += 1
+        size += len(data)
+        if after_chunk:
+            after_chunk(len(stored))
+
+    conflict = 'ON CONFLICT DO NOTHING'
+    if replace:
+        cursor.execute('DELETE FROM {} WHERE key = %s AND chunk_no >= %s'.format(BigTableChunk.__tablename__),
+                       (key, chunks))
+        conflict = ('ON CONFLICT (key) DO UPDATE SET value = NULL, size = EXCLUDED.size, chunks = EXCLUDED.chunks, '
+                    'digest = EXCLUDED.digest, codec = EXCLUDED.codec')
+    cursor.execute('INSERT INTO {} (key, value, size, chunks, digest, codec) VALUES (%s, NULL, %s, %s, %s, %s) '
+                   '{}'.format(BigTable.__tablename__, conflict), (key, size, chunks, digest, codec))
+    return size, chunks
+
+
+def delete_chunks(cursor, keys):
+    """Deletes the pieces of the keys (their values are not chunked anymore)"""
+    cursor.execute('DELETE FROM {} WHERE key = ANY(%s)'.format(BigTableChunk.__tablename__), (list(keys),))
+
+
+class BlobReader(io.RawIOBase):
+    """Read-only stream over one bigtable value; chunked values are fetched
+    from the db one piece at a time (the connection is closed together
+    with the reader)"""
+
+    _chunk_sql = text('SELECT value FROM {} WHERE key = :key AND chunk_no = :chunk_no'.format(
+        BigTableChunk.__tablename__))
+
+    def __init__(self, connection, key, value=None, size=None, chunks=None, codec=None):
+        io.RawIOBase.__init__(self)
+        self.connection = connection
+        self.key = key
+        self.size = size
+        self.chunks = chunks
+        self.codec = codec
+        self._value = value
+        self._next = 0
+        self._buf = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _next_piece(self):
+        if self.chunks is None:
+            piece, self._value = self._value, None
+            return compression.decode(piece, self.codec)
+        if self._next >= self.chunks:
+            return None
+        piece = self.connection.execute(self._chunk_sql, key=self.key, chunk_no=self._next).scalar()
+        if piece is None:
+            raise IOError('Missing chunk {} of {}'.format(self._next, self.key))
+        self._next += 1
+        return compression.decode(piece, self.codec)
+
+    def readinto(self, b):
+        while self._pos >= len(self._buf):
+            piece = self._next_piece()
+            if piece is None:
+                return 0
+            self._buf, self._pos = bytes(piece), 0
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed and self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        io.RawIOBase.close(self)
+
+
+_value_sql = text(
+    'SELECT coalesce(b.value, c.value) AS value, b.size, b.chunks, '
+    'CASE WHEN b.value IS NULL AND b.chunks IS NULL THEN c.codec ELSE b.codec END AS codec FROM {} b '
+    'LEFT JOIN {} c ON c.digest = b.digest WHERE b.key = :key '
+    'UNION ALL '
+    'SELECT substring(s.value FROM (p.start + 1)::int FOR p.size::int), p.size, NULL, NULL FROM {} p '
+    'JOIN {} s ON s.id = p.segment WHERE p.key = :key LIMIT 1'.format(
+        BigTable.__tablename__, BigTableContent.__tablename__,
+        BigTablePacked.__tablename__, BigTableSegment.__tablename__))
+
+
+def open_value(engine, key):
+    """Returns a stream (BlobReader) over the stored value or None when
+    the key does not exist; content-addressed rows are resolved through
+    the content table, packed values come as the slice of their segment
+    (in the same round trip)"""
+    connection = engine.connect()
+    try:
+        row = connection.execute(_value_sql, key=key).first()
+    except:
+        connection.close()
+        raise
+    if row is None:
+        connection.close()
+        return None
+    return _reader(connection, key, row)
+
+
+def _reader(connection, key, row):
+    # the reader of the row of _value_sql; it closes the connection
+    if row.chunks is None:
+        connection.close()
+        size = row.size
+        if size is None:
+            size = row.value is not None and len(row.value) or 0
+        return BlobReader(None, key, value=row.value, size=size, codec=row.codec)
+    return BlobReader(connection, key, size=row.size, chunks=row.chunks, codec=row.codec)
+
+
+# bigtable rows resolved (through the content table) to their logical size,
+# codec and how they are stored; none of these transfers the value itself
+_CODEC = 'CASE WHEN b.value IS NULL AND b.chunks IS NULL THEN c.codec ELSE b.codec END'
+_SIZE = 'coalesce(b.size, octet_length(b.value), octet_length(c.value))'
+_STORAGE = ("CASE WHEN b.chunks IS NOT NULL THEN 'chunked' WHEN b.value IS NULL THEN 'content' "
+            "ELSE 'row' END")
+_MAX_INT = 2 ** 31 - 1
+
+_range_sql = text(
+    'SELECT {size} AS size, b.chunks, {codec} AS codec, '
+    'CASE WHEN b.chunks IS NULL AND {codec} IS NULL '
+    'THEN substring(coalesce(b.value, c.value) FROM :start + 1 FOR :length) END AS data FROM {} b '
+    'LEFT JOIN {} c ON c.digest = b.digest WHERE b.key = :key '
+    'UNION ALL '
+    'SELECT p.size, NULL, NULL, substring(s.value FROM (p.start + :start + 1)::int '
+    'FOR greatest(0, least(:length, p.size - :start))::int) FROM {} p '
+    'JOIN {} s ON s.id = p.segment WHERE p.key = :key LIMIT 1'.format(
+        BigTable.__tablename__, BigTableContent.__tablename__, BigTablePacked.__tablename__,
+        BigTableSegment.__tablename__, size=_SIZE, codec=_CODEC))
+
+_info_sql = (
+    'SELECT b.key, {size} AS size, {storage} AS storage, b.chunks, {codec} AS codec FROM {} b '
+    'LEFT JOIN {} c ON c.digest = b.digest WHERE {{where}} '
+    'UNION ALL '
+    "SELECT p.key, p.size, 'packed', NULL, NULL FROM {} p WHERE {{packed_where}}".format(
+        BigTable.__tablename__, BigTableContent.__tablename__, BigTablePacked.__tablename__,
+        size=_SIZE, storage=_STORAGE, codec=_CODEC))
+
+
+def value_info(engine, key):
+    """Size (logical), storage ('row', 'content', 'chunked', 'packed'),
+    chunks and codec of the value - without reading it; None when the key
+    does not exist"""
+    connection = engine.connect()
+    try:
+        row = connection.execute(text(_info_sql.format(
+            where='b.key = :key', packed_where='p.key = :key') + ' LIMIT 1'), key=key).first()
+    finally:
+        connection.close()
+    return row and dict(row) or None
+
+
+def like_prefix(prefix):
+    """LIKE pattern matching the strings that start with the prefix"""
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def list_values(engine, prefix='', limit=None):
+    """Yields value_info() of all keys starting with the prefix (in the key
+    order); only sizes travel, never the values"""
+    like = like_prefix(prefix)
+    sql = _info_sql.format(where='b.key LIKE :like', packed_where='p.key LIKE :like') + ' ORDER BY 1'
+    if limit:
+        sql += ' LIMIT {:d}'.format(limit)
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        for row in connection.execute(text(sql), like=like):
+            yield dict(row)
+    finally:
+        connection.close()
+
+
+_chunk_map_sql = text('SELECT chunk_no, octet_length(value) FROM {} WHERE key = :key ORDER BY chunk_no'.format(
+    BigTableChunk.__tablename__))
+_piece_sql = text('SELECT substring(value FROM :start FOR :length) FROM {} WHERE key = :key '
+                  'AND chunk_no = :chunk_no'.format(BigTableChunk.__tablename__))
+
+
+def _chunk_pieces(connection, key, start, end, block_size=None, sizes=None):
+    # yields the parts of the chunks that overlap [start, end), at most
+    # block_size bytes each, in order; `sizes` is the map of the chunks
+    # ((chunk_no, size) - fetched when not given)
+    if sizes is None:
+        sizes = connection.execute(_chunk_map_sql, key=key).fetchall()
+    pos = 0
+    for chunk_no, size in sizes:
+        lo, hi = max(start, pos), min(end, pos + size)
+        while lo < hi:
+            n = block_size and min(block_size, hi - lo) or hi - lo
+            yield bytes(connection.execute(_piece_sql, key=key, chunk_no=chunk_no, start=lo - pos + 1,
+                                           length=n).scalar())
+            lo += n
+        pos += size
+        if pos >= end:
+            break
+
+
+def _chunk_range(connection, key, start, length):
+    # only the pieces of the chunks that overlap the range are fetched
+    return b''.join(_chunk_pieces(connection, key, start, start + length))
+
+
+def read_range(engine, key, start=0, length=None):
+    """Returns `length` bytes of the value starting at `start` (less at the
+    end of the value; everything up to the end when length is None) or
+    None when the key does not exist.
+
+    The range is cut out by the server (substring), from the row, the
+    shared content, the segment of a packed value or just from the chunks
+    it overlaps. Compressed values have to be decompressed from their
+    beginning, that happens here."""
+    n = min(_MAX_INT, length is None and _MAX_INT or length)
+    connection = engine.connect()
+    try:
+        row = connection.execute(_range_sql, key=key, start=start, length=n).first()
+        if row is None:
+            return None
+        if row.codec is None:
+            if row.chunks is None:
+                return bytes(row.data or b'')
+            return _chunk_range(connection, key, start, n)
+    finally:
+        connection.close()
+
+    return b''.join(iter_value(engine, key, start=start, length=length))
+
+
+def _skip(stream, n, block_size=1024*1024):
+    while n > 0:
+        data = stream.read(min(n, block_size))
+        if not data:
+            break
+        n -= len(data)
+
+
+def iter_value(engine, key, block_size=1024*1024, start=0, length=None):
+    """Yields the value (or its range) in blocks of up to `block_size`
+    bytes, each block fetched separately, so that at most one block is
+    held in memory (compressed values: one stored piece). One connection
+    serves the whole stream; a chunked value's map of pieces is fetched
+    once and the pieces are read in order. Yields nothing when the key
+    does not exist"""
+    connection = engine.connect()
+    try:
+        info = connection.execute(text(_info_sql.format(
+            where='b.key = :key', packed_where='p.key = :key') + ' LIMIT 1'), key=key).first()
+        if info is None:
+            return
+        size = info.size or 0
+        end = size if length is None else min(size, start + length)
+        if info.codec is not None:
+            # decompressed from the beginning, by the reader (on this connection)
+            if info.chunks is None:
+                row = connection.execute(_value_sql, key=key).first()
+                if row is None:
+                    return
+                stream = _reader(connection, key, row)
+            else:
+                stream = BlobReader(connection, key, size=info.size, chunks=info.chunks, codec=info.codec)
+            try:
+                _skip(stream, start)
+                pos = start
+                while pos < end:
+                    data = stream.read(min(block_size, end - pos))
+                    if not data:
+                        break
+                    pos += len(data)
+                    yield data
+            finally:
+                stream.close()
+        elif info.chunks is not None:
+            for data in _chunk_pieces(connection, key, start, end, block_size):
+                yield data
+        else:
+            pos = start
+            while pos < end:
+                row = connection.execute(_range_sql, key=key, start=pos, length=min(block_size, end - pos)).first()
+                data = row is not None and bytes(row.data or b'')
+                if not data:
+                    break
+                pos += len(data)
+                yield data
+    finally:
+        connection.close()
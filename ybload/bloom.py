@@ -0,0 +1,67 @@
+"""A plain bloom filter that can be saved to (and loaded from) a file; the
+ingest keeps one with the keys of the bigtable so that it does not have to
+ask the db about keys that were certainly never stored."""
+
+import math
+import struct
+import hashlib
+
+
+class BloomFilter(object):
+
+    _magic = b'YBBLOOM1'
+    _header = struct.Struct('!QQQ')
+
+    def __init__(self, capacity=1000000, error_rate=0.01, nbits=None, nhashes=None, bits=None, count=0):
+        if nbits is None:
+            nbits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+            nbits = max(8, nbits)
+        if nhashes is None:
+            nhashes = max(1, int(round(nbits / float(max(1, capacity)) * math.log(2))))
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.bits = bits if bits is not None else bytearray((nbits + 7) // 8)
+        self.count = count
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf8')
+        d = hashlib.md5(key).digest()
+        h1, h2 = struct.unpack('!QQ', d)
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def merge(self, other):
+        """Adds the keys of the other filter (of the same size)"""
+        if (other.nbits, other.nhashes) != (self.nbits, self.nhashes):
+            raise ValueError('Bloom filters of different sizes can not be merged')
+        self.bits = bytearray(a | b for a, b in zip(self.bits, other.bits))
+
+    def save(self, path):
+        with open(path, 'wb') as fo:
+            fo.write(self._magic)
+            fo.write(self._header.pack(self.nbits, self.nhashes, self.count))
+            fo.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fi:
+            if fi.read(len(cls._magic)) != cls._magic:
+                raise ValueError('{} is not a bloom filter file'.format(path))
+            nbits, nhashes, count = cls._header.unpack(fi.read(cls._header.size))
+            bits = bytearray(fi.read())
+        if len(bits) != (nbits + 7) // 8:
+            raise ValueError('{} is truncated'.format(path))
+        return cls(nbits=nbits, nhashes=nhashes, bits=bits, count=count)
@@ -0,0 +1,100 @@
+"""Read-through cache of get_record() results: a bounded LRU whose entries
+also expire after `ttl` seconds (writes made by other processes are not
+seen any sooner). Entries are keyed by the bibcode and the load_only
+projection; writes through YBLoader (update_storage, mark_processed)
+invalidate all entries of their bibcodes.
+
+A read that started before an invalidation does not store what it read:
+every invalidation bumps a generation counter, and put() of a value
+fetched under an older generation is ignored.
+"""
+
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+
+def projection(load_only):
+    """Key of the load_only projection (None for whole records)"""
+    return load_only and tuple(sorted(set(load_only))) or None
+
+
+class RecordCache(object):
+    """At most `max_size` entries, each valid for `ttl` seconds (0: until
+    evicted or invalidated); thread safe. The values are copied in and out,
+    the callers may modify what they get."""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (bibcode, projection) -> (expires, value)
+        self.keys = {}  # bibcode -> set of projections
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, bibcode, load_only=None, default=None):
+        """The cached value, or `default` (which counts as a miss)"""
+        key = (bibcode, projection(load_only))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl and entry[0] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            value = entry[1]
+        return copy.deepcopy(value)
+
+    def put(self, bibcode, load_only, value, generation):
+        """Stores the value read while the cache was at `generation`"""
+        key = (bibcode, projection(load_only))
+        value = copy.deepcopy(value)
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            self.keys.setdefault(bibcode, set()).add(key[1])
+            while len(self.entries) > self.max_size:
+                old, _ = self.entries.popitem(last=False)
+                self._forget(old)
+                self.evictions += 1
+        return True
+
+    def _forget(self, key):
+        projections = self.keys.get(key[0])
+        if projections is not None:
+            projections.discard(key[1])
+            if not projections:
+                del self.keys[key[0]]
+
+    def _remove(self, key):
+        del self.entries[key]
+        self._forget(key)
+
+    def invalidate(self, bibcodes):
+        """Drops all entries of the bibcodes"""
+        with self.lock:
+            self.generation += 1
+            for bibcode in bibcodes:
+                for p in self.keys.pop(bibcode, ()):
+                    del self.entries[(bibcode, p)]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.keys.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations,
+                    'invalidations': self.invalidations}
@@ -0,0 +1,144 @@
+"""Coalescing of mark_processed() calls: many workers (threads of a celery
+worker) marking a few documents each would make as many tiny transactions,
+all of them on the same records tablets. MarkAggregator collects the
+requests per (type, status) and a background thread sends them as one
+bulk mark_processed() when a buffer has `max_items` bibcodes or its oldest
+request waited `max_delay` seconds.
+
+Every request gets a Future that is resolved when its batch is committed
+(or carries the error). When a batch fails, its requests are retried one
+by one, so only the requests that can not be applied get the error.
+Buffers are flushed in the order they were started; close() flushes
+everything left.
+"""
+
+import os
+import time
+import atexit
+import threading
+from concurrent.futures import Future
+
+
+class _Buffer(object):
+
+    def __init__(self, type, status, checksums):
+        self.type = type
+        self.status = status
+        self.checksums = checksums
+        self.requests = []
+        self.items = 0
+        self.started = time.time()
+
+
+class MarkAggregator(object):
+    """Buffers requests for `mark(bibcodes, type, checksums, status)` (the
+    bulk mark_processed())"""
+
+    def __init__(self, mark, max_items=5000, max_delay=1.0, logger=None):
+        self.mark = mark
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.logger = logger
+        self.buffers = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats = {'requests': 0, 'items': 0, 'flushes': 0, 'failed': 0}
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='mark-aggregator')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, bibcodes, type, checksums=None, status=None):
+        """Queues the request; returns a Future (its result is None once
+        the documents are marked)"""
+        if checksums is not None and len(checksums) != len(bibcodes):
+            raise ValueError('bibcodes and checksums must be of the same length')
+        future = Future()
+        # it can not be cancelled, the request may already be on its way
+        future.set_running_or_notify_cancel()
+        if not bibcodes:
+            future.set_result(None)
+            return future
+        key = (type, status, checksums is not None)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The mark aggregator is closed')
+            buf = self.buffers.get(key)
+            if buf is None:
+                buf = self.buffers[key] = _Buffer(type, status, checksums is not None)
+                # the flusher has a new deadline to wait for
+                self.condition.notify()
+            buf.requests.append((list(bibcodes), checksums and list(checksums), future))
+            buf.items += len(bibcodes)
+            self.stats['requests'] += 1
+            if buf.items >= self.max_items:
+                self.condition.notify()
+        return future
+
+    def _due(self, force):
+        # buffers to flush now (oldest first); called with the lock held
+        now = time.time()
+        due = [k for k, b in self.buffers.items()
+               if force or b.items >= self.max_items or now - b.started >= self.max_delay]
+        due.sort(key=lambda k: self.buffers[k].started)
+        return [self.buffers.pop(k) for k in due]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                due = self._due(self.closed)
+                while not due and not self.closed:
+                    if self.buffers:
+                        oldest = min(b.started for b in self.buffers.values())
+                        self.condition.wait(max(0.001, oldest + self.max_delay - time.time()))
+                    else:
+                        self.condition.wait()
+                    due = self._due(self.closed)
+                if not due and self.closed:
+                    return
+            for buf in due:
+                self._flush(buf)
+
+    def _flush(self, buf):
+        bibcodes = [b for r in buf.requests for b in r[0]]
+        checksums = buf.checksums and [c for r in buf.requests for c in r[1]] or None
+        try:
+            self.mark(bibcodes, buf.type, checksums, buf.status)
+        except Exception as e:
+            if self.logger:
+                self.logger.warning('Marking {} documents as processed failed, trying {} requests one by one: {}'.format(
+                    len(bibcodes), len(buf.requests), e))
+            for request_bibcodes, request_checksums, future in buf.requests:
+                try:
+                    self.mark(request_bibcodes, buf.type, request_checksums, buf.status)
+                except Exception as e:
+                    with self.condition:
+                        self.stats['failed'] += 1
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        else:
+            for _, _, future in buf.requests:
+                future.set_result(None)
+        with self.condition:
+            self.stats['items'] += len(bibcodes)
+            self.stats['flushes'] += 1
+
+    def flush(self):
+        """Sends everything buffered now; returns once it is done"""
+        with self.condition:
+            due = self._due(True)
+        for buf in due:
+            self._flush(buf)
+
+    def close(self, timeout=None):
+        """Flushes what is left and stops the background thread"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        if self.pid == os.getpid():
+            self.thread.join(timeout)
+        atexit.unregister(self.close)
@@ -0,0 +1,44 @@
+"""Codecs for the bigtable values. Compression is decided per value: when
+it does not save enough (the compressed size is above `min_ratio` of the
+original) the value is stored as it is. The codec used is recorded next
+to the value (NULL means uncompressed), readers decode transparently."""
+
+import bz2
+import lzma
+import zlib
+
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+NAMES = ['none'] + sorted(CODECS)
+
+
+def encode(data, codec, min_ratio=0.9):
+    """Returns (stored bytes, codec name or None if stored uncompressed)"""
+    if not codec or codec == 'none':
+        return data, None
+    if codec not in CODECS:
+        raise ValueError('Unknown codec: %s, must be one of %s' % (codec, NAMES))
+    packed = CODECS[codec][0](data)
+    if len(packed) > len(data) * min_ratio:
+        return data, None
+    return packed, codec
+
+
+def compress(data, codec):
+    """Compresses unconditionally (all pieces of a chunked value have to
+    share one codec)"""
+    if not codec:
+        return data
+    return CODECS[codec][0](data)
+
+
+def decode(data, codec):
+    if not codec or data is None:
+        return data
+    if codec not in CODECS:
+        raise ValueError('Unknown codec: %s' % codec)
+    return CODECS[codec][1](bytes(data))
@@ -0,0 +1,108 @@
+"""Ingest of a directory tree without a manifest: the tree is walked with
+os.scandir() by a pool of threads and the files go into the ingest as soon
+as they are found (together with their sizes, so they are not stat'ed
+again).
+
+The walk is depth first and sorted (files of a directory before its
+subdirectories), so the same tree always gives the same sequence - the
+position in it plays the role of the manifest line number. While a
+directory is being consumed, the listings of its subdirectories are
+already running in the pool. Keys are the paths relative to the root
+(with `key_prefix` prepended). Directories and files that can not be read
+are logged and counted (Crawler.errors), the walk goes on without them.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def list_dir(path):
+    """Returns ([(name, size)], [subdirectory], [error]) of the directory,
+    the first two sorted by name; entries that vanish (or can not be read)
+    are left out and their errors (str) reported"""
+    files, dirs, errors = [], [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append((entry.name, entry.stat().st_size))
+                except OSError as e:
+                    errors.append(str(e))
+    except OSError as e:
+        return [], [], [str(e)]
+    files.sort()
+    dirs.sort()
+    return files, dirs, errors
+
+
+class _Listed(object):
+    # listing that did not fit into the lookahead, it is done when needed
+
+    def __init__(self, path):
+        self.path = path
+
+    def result(self):
+        return list_dir(self.path)
+
+
+class Crawler(object):
+    """Walks the tree under `root` with `threads` threads listing up to
+    `lookahead` directories ahead of the consumer; `errors` counts what
+    could not be read (each of them is logged with the `logger`)"""
+
+    def __init__(self, root, threads=8, lookahead=1024, key_prefix='', logger=None):
+        self.root = root
+        self.threads = threads
+        self.lookahead = lookahead
+        self.key_prefix = key_prefix
+        self.logger = logger
+        self.pool = None
+        self.pending = 0
+        self.errors = 0
+
+    def _submit(self, path):
+        if self.pool is not None and self.pending < self.lookahead:
+            self.pending += 1
+            return self.pool.submit(list_dir, path)
+        return _Listed(path)
+
+    def _walk(self, rel, listing):
+        if not isinstance(listing, _Listed):
+            self.pending -= 1
+        files, dirs, errors = listing.result()
+        for error in errors:
+            self.errors += 1
+            if self.logger:
+                self.logger.error('Not ingested, can not be read: {}'.format(error))
+        subdirs = [(d, self._submit(os.path.join(self.root, rel, d))) for d in dirs]
+        for name, size in files:
+            yield os.path.join(rel, name), size
+        for d, sub in subdirs:
+            for x in self._walk(os.path.join(rel, d), sub):
+                yield x
+
+    def files(self):
+        """Yields (relative path, size) of every file of the tree"""
+        self.pool = self.threads and ThreadPoolExecutor(self.threads) or None
+        try:
+            for x in self._walk('', _Listed(self.root)):
+                yield x
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+
+    def entries(self, lineno=0):
+        """Yields (lineno, offset, key, path, size) like
+        ingest.read_manifest() (with the size added); files before
+        `lineno` are skipped (offset is always 0)"""
+        for n, (rel, size) in enumerate(self.files()):
+            if n >= lineno:
+                yield n, 0, self.key_prefix + rel.replace(os.sep, '/'), os.path.join(self.root, rel), size
+
+    def keys(self):
+        for _, _, key, _, _ in self.entries():
+            yield key
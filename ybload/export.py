@@ -0,0 +1,392 @@
+"""Bulk export of the bigtable (`run.py --export`): the key space is split
+into ranges - buckets of the key hash (yugabyte's yb_hash_code() when
+available, so that every range is served by one tablet) or contiguous key
+ranges - that are scanned concurrently, each with its own connection and
+a named (server side) cursor fetching `itersize` rows at a time.
+
+Values are written into a directory tree (one file per key) or into a tar
+stream. Every finished range is recorded in the KeyValue table (with the
+file it went into), an interrupted export continues with the ranges that
+were not finished. A tar file can not be appended to: a resumed tar export
+writes into a new part (<name>.partN.tar) and the export is the union of
+the parts; a tar stream on stdout can not be resumed.
+
+The scan only brings the keys, sizes and storage of the values, and the
+values themselves when they are small (up to `inline` bytes; packed ones
+as the slice of their segment); larger and chunked values are streamed
+block by block when they are written. Rows waiting for the tar writer
+hold at most `max_bytes` of values. Keys that can not be written into a
+directory (the file `a` where `a/b` needs a directory, or the other way
+round) are reported and left out.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import tarfile
+import threading
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from ybload import blobs, compression, ingest
+from ybload.models import KeyValue, BigTable, BigTableContent, BigTablePacked, BigTableSegment
+
+
+PARTITIONS = ('hash', 'range')
+
+# the value only when it is small (%s is the limit); the others are streamed
+_scan_sql = (
+    'SELECT b.key, CASE WHEN b.chunks IS NULL AND {size} <= %s THEN coalesce(b.value, c.value) END AS value, '
+    '{size} AS size, b.chunks, {codec} AS codec '
+    'FROM {} b LEFT JOIN {} c ON c.digest = b.digest WHERE {{where}} '
+    'UNION ALL '
+    'SELECT p.key, CASE WHEN p.size <= %s THEN substring(s.value FROM (p.start + 1)::int FOR p.size::int) END, '
+    'p.size, NULL, NULL '
+    'FROM {} p JOIN {} s ON s.id = p.segment WHERE {{packed_where}}').format(
+        BigTable.__tablename__, BigTableContent.__tablename__, BigTablePacked.__tablename__,
+        BigTableSegment.__tablename__, size=blobs._SIZE, codec=blobs._CODEC)
+
+
+def hash_ranges(n, yb_hash=True):
+    """Splits the 16-bit hash space into `n` buckets; returns a list of
+    (where clause template, params) - {col} stands for the key column"""
+    fn = ingest.hash_function(yb_hash)
+    out = []
+    for i in range(n):
+        lo, hi = i * ingest.HASH_SPACE // n, (i + 1) * ingest.HASH_SPACE // n
+        out.append(('{} >= %s AND {} < %s'.format(fn, fn), (lo, hi)))
+    return out
+
+
+def key_ranges(connection, n):
+    """Splits the keys into `n` contiguous ranges of about the same number
+    of keys (only the keys are scanned to find the boundaries)"""
+    cursor = connection.cursor()
+    cursor.execute('SELECT max(key) FROM (SELECT key, ntile(%s) OVER (ORDER BY key) AS t FROM ('
+                   'SELECT key FROM {} UNION ALL SELECT key FROM {}) k) x GROUP BY t ORDER BY 1'.format(
+                       BigTable.__tablename__, BigTablePacked.__tablename__), (n,))
+    bounds = [r[0] for r in cursor.fetchall()]
+    connection.commit()
+    out = []
+    low = None
+    for high in bounds[:-1] + [None]:
+        cond, params = [], []
+        if low is not None:
+            cond.append('{col} > %s')
+            params.append(low)
+        if high is not None:
+            cond.append('{col} <= %s')
+            params.append(high)
+        out.append((' AND '.join(cond) or 'TRUE', tuple(params)))
+        low = high
+    return out
+
+
+def safe_path(key):
+    """Relative path for the key: no absolute paths, no way out of the
+    export directory"""
+    parts = [p for p in key.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+    return '/'.join(parts) or '_'
+
+
+class DirectoryOutput(object):
+    """One file per key under `root` (keys with slashes make directories);
+    thread safe. A key whose path is taken (a file where a directory is
+    needed or the other way round) is not written, write() returns False
+    and the key is added to `collisions`"""
+
+    threaded = True
+
+    def __init__(self, root):
+        self.root = root
+        self.collisions = []
+
+    def write(self, key, size, blocks):
+        path = os.path.join(self.root, *safe_path(key).split('/'))
+        d = os.path.dirname(path)
+        try:
+            if not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+            fo = open(path, 'wb')
+        except (FileExistsError, NotADirectoryError, IsADirectoryError):
+            self.collisions.append(key)
+            return False
+        with fo:
+            for block in blocks:
+                fo.write(block)
+        return True
+
+    def close(self):
+        pass
+
+
+class _Blocks(io.RawIOBase):
+    # file object over an iterator of blocks (for tarfile.addfile)
+
+    def __init__(self, blocks):
+        io.RawIOBase.__init__(self)
+        self.blocks = iter(blocks)
+        self.buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.buf = memoryview(block).cast('B')
+        n = min(len(b), len(self.buf))
+        memoryview(b).cast('B')[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+class TarOutput(object):
+    """Writes the values as members of a tar stream (stdout for '-'); only
+    one thread may write, the scanners hand their rows over"""
+
+    threaded = False
+
+    def __init__(self, location):
+        mode = location.endswith(('.gz', '.tgz')) and 'w|gz' or 'w|'
+        if location == '-':
+            self.tar = tarfile.open(fileobj=sys.stdout.buffer, mode=mode)
+        else:
+            self.tar = tarfile.open(location, mode)
+        self.now = time.time()
+
+    def write(self, key, size, blocks):
+        info = tarfile.TarInfo(safe_path(key))
+        info.size = size
+        info.mtime = self.now
+        self.tar.addfile(info, io.BufferedReader(_Blocks(blocks)))
+        return True
+
+    def close(self):
+        self.tar.close()
+
+
+def is_tar(location):
+    return location == '-' or location.endswith(('.tar', '.tar.gz', '.tgz'))
+
+
+def part_path(location, n):
+    """Name of the n-th part of a tar export (<name>.partN.tar)"""
+    for ext in ('.tar.gz', '.tgz', '.tar'):
+        if location.endswith(ext):
+            return '{}.part{:d}{}'.format(location[:-len(ext)], n, ext)
+    raise ValueError('Not a tar file: {}'.format(location))
+
+
+def open_output(location):
+    if is_tar(location):
+        return TarOutput(location)
+    return DirectoryOutput(location)
+
+
+def _run_key(run_id, part=None):
+    if part is None:
+        return 'export:{}'.format(run_id)
+    return 'export:{}:{}'.format(run_id, part)
+
+
+def load_export(app, run_id):
+    """Returns (export parameters or None, set of finished ranges)"""
+    run = None
+    done = set()
+    with app.session_scope() as session:
+        for kv in session.query(KeyValue).filter(KeyValue.key.startswith(_run_key(run_id))).all():
+            if kv.key == _run_key(run_id):
+                run = json.loads(kv.value)
+            elif kv.key.rsplit(':', 1)[0] == _run_key(run_id):
+                done.add(int(kv.key.rsplit(':', 1)[1]))
+    return run, done
+
+
+def _save(app, key, value):
+    with app.session_scope() as session:
+        session.merge(KeyValue(key=key, value=json.dumps(value)))
+
+
+class Exporter(object):
+    """Scans the ranges with `workers` threads and writes the values into
+    the output; see export()"""
+
+    def __init__(self, app, output, ranges, run_id, workers=4, itersize=100, report=0, done=None, location=None,
+                 inline=1024*64, max_bytes=1024*1024*64):
+        self.app = app
+        self.output = output
+        self.location = location
+        self.ranges = ranges
+        self.run_id = run_id
+        self.workers = workers
+        self.itersize = itersize
+        self.reporter = ingest.Reporter(app.logger, report)
+        self.done = set(done or ())
+        self.inline = inline
+        self.files = self.bytes = 0
+        self.lock = threading.Lock()
+        self.queue = Queue(maxsize=workers * 4)
+        self.budget = ingest.ByteBudget(max_bytes)
+        self._stop = threading.Event()
+
+    def _value(self, row):
+        # blocks of the value: as it came with the row, or streamed (the scan
+        # did not bring large and chunked values)
+        if row[1] is not None:
+            yield compression.decode(row[1], row[4])
+        elif row[3] is not None or (row[2] or 0) > self.inline:
+            for block in blobs.iter_value(self.app._engine, row[0]):
+                yield block
+
+    def _emit(self, item):
+        if self.output.threaded:
+            self._write(item)
+            return
+        held = self._held(item)
+        self.budget.acquire(held)
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+        self.budget.release(held)
+        raise RuntimeError('Export stopped')
+
+    @staticmethod
+    def _held(item):
+        # bytes of the value that came with the row
+        return item[0] == 'row' and item[1][1] is not None and len(item[1][1]) or 0
+
+    def _write(self, item):
+        if item[0] == 'done':
+            _save(self.app, _run_key(self.run_id, item[1]), {'files': item[2], 'finished': time.time(),
+                                                             'output': self.location})
+            with self.lock:
+                self.done.add(item[1])
+            return
+        row = item[1]
+        if not self.output.write(row[0], row[2] or 0, self._value(row)):
+            self.app.logger.warning('Not exported, the path of {} is taken by another key'.format(row[0]))
+            return
+        with self.lock:
+            self.files += 1
+            self.bytes += row[2] or 0
+
+    def scan(self, part):
+        where, params = self.ranges[part]
+        connection = self.app._engine.raw_connection()
+        n = 0
+        try:
+            cursor = connection.cursor('ybload-export-{}'.format(part))
+            cursor.itersize = self.itersize
+            cursor.execute(_scan_sql.format(where=where.format(col='b.key'), packed_where=where.format(col='p.key')),
+                           (self.inline,) + params + (self.inline,) + params)
+            for row in cursor:
+                if self._stop.is_set():
+                    raise RuntimeError('Export stopped')
+                self._emit(('row', row))
+                n += 1
+            cursor.close()
+            connection.commit()
+        finally:
+            connection.close()
+        self._emit(('done', part, n))
+        return n
+
+    def run(self):
+        todo = [i for i in range(len(self.ranges)) if i not in self.done]
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            futures = [pool.submit(self.scan, part) for part in todo]
+            if self.output.threaded:
+                for f in futures:
+                    while True:
+                        try:
+                            f.result(timeout=self.reporter.report or None)
+                            break
+                        except TimeoutError:
+                            self.reporter(self.files, self.bytes)
+            else:
+                finished = 0
+                while finished < len(todo):
+                    try:
+                        item = self.queue.get(timeout=0.1)
+                    except Empty:
+                        for f in futures:
+                            if f.done() and f.exception():
+                                raise f.exception()
+                        continue
+                    try:
+                        self._write(item)
+                    finally:
+                        self.budget.release(self._held(item))
+                    if item[0] == 'done':
+                        finished += 1
+                    self.reporter(self.files, self.bytes)
+                for f in futures:
+                    f.result()
+        finally:
+            # scanners that are still running (after a failure) give up
+            self._stop.set()
+            self.budget.close()
+            pool.shutdown(wait=True)
+        self.reporter(self.files, self.bytes, force=True)
+        return self
+
+
+def export(app, output, workers=4, partition='hash', ranges=None, run_id=None, resume=None,
+           itersize=100, report=0, inline=1024*64, max_bytes=1024*1024*64):
+    """Writes the whole bigtable into the `output` (directory, or a .tar /
+    .tar.gz file, or '-' for a tar stream on stdout) scanning `ranges`
+    parts of the key space (hash buckets or key ranges) with `workers`
+    threads. `resume` continues an interrupted export (the ranges it
+    finished are skipped; a tar export continues in a new part file, see
+    part_path()). Values up to `inline` bytes come with the scan, larger
+    ones are streamed; the tar writer is handed at most `max_bytes` of
+    values at a time. Returns the summary (dict; `collisions` are the keys
+    that were left out of a directory)"""
+    done = set()
+    if resume:
+        if output == '-':
+            raise ValueError('A tar stream can not be resumed (export into a file or a directory)')
+        run, done = load_export(app, resume)
+        if run is None:
+            raise ValueError('Unknown export: {}'.format(resume))
+        run_id = resume
+        parts = [(where, tuple(params)) for where, params in run['ranges']]
+        if is_tar(output):
+            # the finished ranges stay in the files they were written into
+            outputs = run.get('outputs') or [run['output']]
+            output = part_path(output, len(outputs))
+            run['outputs'] = outputs + [output]
+            _save(app, _run_key(run_id), run)
+    else:
+        run_id = run_id or ingest.new_run_id()
+        connection = app._engine.raw_connection()
+        try:
+            if partition == 'hash':
+                parts = hash_ranges(ranges or workers * 4, ingest.has_yb_hash(connection))
+            else:
+                parts = key_ranges(connection, ranges or workers * 4)
+        finally:
+            connection.close()
+        _save(app, _run_key(run_id), {'output': output, 'partition': partition, 'ranges': parts,
+                                      'started': time.time()})
+
+    start = time.time()
+    out = open_output(output)
+    try:
+        exporter = Exporter(app, out, parts, run_id, workers, itersize, report, done, output, inline,
+                            max_bytes).run()
+    finally:
+        out.close()
+    elapsed = time.time() - start
+    return {'run_id': run_id, 'output': output, 'files': exporter.files, 'bytes': exporter.bytes, 'elapsed': elapsed,
+            'ranges': len(parts), 'skipped_ranges': len(done), 'collisions': sorted(getattr(out, 'collisions', [])),
+            'files_per_sec': elapsed and exporter.files / elapsed or 0.0,
+            'mb_per_sec': elapsed and exporter.bytes / elapsed / (1024 * 1024) or 0.0}
@@ -0,0 +1,957 @@
+"""Machinery behind `run.py -i`: reads the key/location manifest and pushes
+the files into the bigtable (as blobs), optionally from several processes
+at once.
+
+We are going to use direct db cursors and no ORM (in order to abuse the
+db as much as possible)
+"""
+
+import os
+import time
+import json
+import threading
+import multiprocessing
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, Future
+from ybload import writers, blobs, instrument, retry, archives, crawl, packing
+from ybload.bloom import BloomFilter
+from ybload.models import KeyValue, BigTable, BigTablePacked
+
+
+# size of the (16-bit) hash space that yugabyte uses to place rows of
+# hash-sharded tables into tablets
+HASH_SPACE = 65536
+PARTITIONS = ('lines', 'hash')
+
+
+def read_manifest(location, offset=0, lineno=0):
+    """Yields (lineno, offset, key, location) for every line of the manifest;
+    when only one column is present, the location doubles as the key.
+
+    The offset points right behind the line - that is where a resumed run
+    continues from (together with the line number, which the partitioning
+    depends on)."""
+    with open(location, 'rb') as fi:
+        fi.seek(offset)
+        for line in fi:
+            offset += len(line)
+            l = line.decode('utf8').strip().split(maxsplit=1)
+            if not l:
+                continue
+            if len(l) == 1:
+                l.append(l[0])
+            yield lineno, offset, l[0], l[1]
+            lineno += 1
+
+
+def has_yb_hash(connection):
+    """True when the server has yb_hash_code() (yugabyte)"""
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM pg_proc WHERE proname = 'yb_hash_code'")
+    found = cursor.fetchone() is not None
+    connection.commit()
+    return found
+
+
+def hash_function(yb_hash=True):
+    """SQL of the 16-bit key hash - {col} stands for the key: yb_hash_code()
+    is what yugabyte places the rows of hash sharded tables by; plain
+    PostgreSQL has no tablets, hashtext() only spreads the keys"""
+    return yb_hash and 'yb_hash_code({col})' or '(hashtext({col}) & 65535)'
+
+
+def hash_bucket(code, buckets):
+    """Which of `buckets` contiguous ranges of the hash space (the ones of
+    export.hash_ranges()) the hash code falls into"""
+    return ((code + 1) * buckets - 1) // HASH_SPACE
+
+
+def owns(worker, workers, lineno):
+    """True if the manifest line belongs to the given worker (round-robin,
+    see HashPartition for partition='hash')"""
+    if workers < 2:
+        return True
+    return lineno % workers == worker
+
+
+def batches(entries, size, max_bytes=None):
+    """Groups the entries into lists of at most `size` of them. Entries
+    that come with their data (archive members, see ybload.archives) also
+    end a list once it holds `max_bytes` of data, and right after a member
+    that has to be streamed from the archive (data None): it can only be
+    read before the archive moves on"""
+    pending = []
+    held = 0
+    for e in entries:
+        pending.append(e)
+        if len(e) > 5:
+            if e[5] is None:
+                held = None
+            else:
+                held += len(e[5])
+        if len(pending) >= size or held is None or max_bytes and held >= max_bytes:
+            yield pending
+            pending = []
+            held = 0
+    if pending:
+        yield pending
+
+
+class HashPartition(object):
+    """Keeps the manifest entries whose keys fall into the worker's range
+    of the hash space. The keys are hashed by the server, in batches, with
+    hash_function(): on yugabyte every worker therefore writes into its
+    own set of tablets (as long as the table is hash sharded)"""
+
+    def __init__(self, app, worker, workers, batch=5000, max_bytes=None):
+        self.app = app
+        self.worker = worker
+        self.workers = workers
+        self.batch = batch
+        self.max_bytes = max_bytes
+
+    def __call__(self, entries):
+        connection = self.app._engine.raw_connection()
+        try:
+            sql = 'SELECT {} FROM unnest(%s::varchar[]) WITH ORDINALITY AS t(k, i) ORDER BY i'.format(
+                hash_function(has_yb_hash(connection)).format(col='k'))
+            cursor = connection.cursor()
+            for pending in batches(entries, self.batch, self.max_bytes):
+                for x in self._check(cursor, sql, pending):
+                    yield x
+        finally:
+            connection.close()
+
+    def _check(self, cursor, sql, entries):
+        if not entries:
+            return
+        cursor.execute(sql, ([e[2] for e in entries],))
+        codes = [r[0] for r in cursor.fetchall()]
+        cursor.connection.commit()
+        for e, code in zip(entries, codes):
+            if hash_bucket(code, self.workers) == self.worker:
+                yield e
+
+
+def read_files(entries, ignore, metrics=None):
+    """Stats and reads the files one after another (no prefetching); yields
+    (lineno, offset, key, path, size, data) where size is None for missing
+    files and data is None for files larger than `ignore`. Entries that
+    come with their size (see ybload.crawl) are not stat'ed again"""
+    for e in entries:
+        yield _read(e[0], e[1], e[2], e[3], ignore, _size(e), metrics)
+
+
+def _size(entry):
+    # size known from the directory walk, -1 when it must be found out
+    return entry[4] if len(entry) > 4 else -1
+
+
+def _stat(path, metrics=None):
+    t = time.time()
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+    finally:
+        if metrics:
+            metrics.timed('stat', time.time() - t)
+
+
+def _read(lineno, offset, key, path, ignore, size=-1, metrics=None):
+    if size == -1:
+        size = _stat(path, metrics)
+        if size is None:
+            return lineno, offset, key, path, None, None
+    data = None
+    if size <= ignore:
+        t = time.time()
+        with open(path, 'rb') as input:
+            data = input.read()
+        if metrics:
+            metrics.timed('read', time.time() - t)
+    return lineno, offset, key, path, size, data
+
+
+class Prefilter(object):
+    """Drops the manifest entries whose keys are already in the bigtable,
+    so that their files are never read nor sent. Keys are looked up in
+    batches (key = ANY(...)); with a bloom filter of the stored keys, only
+    the keys that may have been stored are looked up at all (see batches()
+    for entries that carry their data)"""
+
+    def __init__(self, app, batch=5000, bloom=None, max_bytes=None):
+        self.app = app
+        self.batch = batch
+        self.bloom = bloom
+        self.max_bytes = max_bytes
+        self.existing = self.lookups = 0
+
+    def __call__(self, entries):
+        connection = self.app._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for pending in batches(entries, self.batch, self.max_bytes):
+                for x in self._check(cursor, pending):
+                    yield x
+        finally:
+            connection.close()
+
+    def _check(self, cursor, entries):
+        keys = [e[2] for e in entries if self.bloom is None or e[2] in self.bloom]
+        found = set()
+        if keys:
+            cursor.execute('SELECT key FROM {} WHERE key = ANY(%s) UNION ALL '
+                           'SELECT key FROM {} WHERE key = ANY(%s)'.format(
+                               BigTable.__tablename__, BigTablePacked.__tablename__), (keys, keys))
+            found = set(r[0] for r in cursor.fetchall())
+            # do not keep the transaction (and its snapshot) open
+            cursor.connection.commit()
+            self.lookups += 1
+        for e in entries:
+            if e[2] in found:
+                self.existing += 1
+            else:
+                yield e
+
+
+def load_bloom(app, path, capacity=10000000):
+    """Loads the bloom filter of the stored keys; when the file does not
+    exist yet, the filter is built from the keys found in the bigtable"""
+    if os.path.exists(path):
+        return BloomFilter.load(path)
+    bloom = BloomFilter(capacity)
+    connection = app._engine.raw_connection()
+    try:
+        # named (server side) cursor, we don't want all keys in memory
+        cursor = connection.cursor('ybload-bloom')
+        cursor.itersize = 10000
+        cursor.execute('SELECT key FROM {} UNION ALL SELECT key FROM {}'.format(
+            BigTable.__tablename__, BigTablePacked.__tablename__))
+        for (key,) in cursor:
+            bloom.add(key)
+    finally:
+        connection.close()
+    return bloom
+
+
+def read_keys(location, **archive_options):
+    """Keys of the manifest (or of the archive, see ybload.archives, or of
+    the directory tree, see ybload.crawl)"""
+    if os.path.isdir(location):
+        for key in crawl.Crawler(location, key_prefix=archive_options.get('key_prefix', '')).keys():
+            yield key
+    elif archives.is_archive(location):
+        archive = archives.Archive(location, **archive_options)
+        try:
+            for key in archive.keys():
+                yield key
+        finally:
+            archive.close()
+    else:
+        for _, _, key, _ in read_manifest(location):
+            yield key
+
+
+def merge_bloom(bloom, path, workers):
+    """Adds the keys that the ingest workers put into their copies of the
+    filter (saved in <path>.<worker>, which are removed) and saves it"""
+    added = 0
+    for worker in range(workers):
+        part = '{}.{}'.format(path, worker)
+        if os.path.exists(part):
+            other = BloomFilter.load(part)
+            bloom.merge(other)
+            added += other.count - bloom.count
+            os.remove(part)
+    bloom.count += added
+    bloom.save(path)
+
+
+class ByteBudget(object):
+    """Blocks acquire() while more than `limit` bytes are in flight; a
+    single oversized item is let through when nothing else is held"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        with self._cond:
+            while not self.closed and self.used and self.used + n > self.limit:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class CommitBudget(object):
+    """How much one transaction may carry: at most `bytes` (and `rows`
+    files, when given). With adaptive=True both grow while the commits take
+    less than half of the `target` seconds and shrink when a commit takes
+    longer than that (or fails), always staying within [min_bytes,
+    max_bytes] and [min_rows, max_rows]; every change is logged"""
+
+    grow = 1.5
+    shrink = 0.5
+
+    def __init__(self, bytes, rows=None, adaptive=False, target=1.0, min_bytes=1024*1024,
+                 max_bytes=1024*1024*1024, min_rows=100, max_rows=100000, logger=None, prefix=''):
+        self.adaptive = adaptive
+        self.target = target
+        self.min_bytes, self.max_bytes = min_bytes, max_bytes
+        self.min_rows, self.max_rows = min_rows, max_rows
+        if adaptive and rows is None:
+            rows = max_rows
+        self.bytes = adaptive and self._clamp(bytes, min_bytes, max_bytes) or bytes
+        self.rows = rows and adaptive and self._clamp(rows, min_rows, max_rows) or rows
+        self.logger = logger
+        self.prefix = prefix
+        self.commits = self.errors = 0
+
+    @staticmethod
+    def _clamp(value, low, high):
+        return int(max(low, min(high, value)))
+
+    def full(self, size, rows):
+        return size > self.bytes or bool(self.rows and rows >= self.rows)
+
+    def committed(self, seconds, size, rows):
+        """Adjusts the budget after a commit of `size` bytes and `rows`
+        files that took `seconds`"""
+        self.commits += 1
+        if not self.adaptive:
+            return
+        if seconds > self.target:
+            self._scale(self.shrink, 'commit of {} bytes, {} rows took {:.3f}s'.format(size, rows, seconds))
+        elif seconds < self.target / 2 and self.full(size, rows):
+            # only transactions that used up the budget tell us it is too small
+            self._scale(self.grow, 'commit of {} bytes, {} rows took {:.3f}s'.format(size, rows, seconds))
+
+    def failed(self):
+        self.errors += 1
+        if self.adaptive:
+            self._scale(self.shrink, 'transaction failed ({} of {})'.format(self.errors, self.commits + self.errors))
+
+    def error_rate(self):
+        return self.errors and self.errors / float(self.commits + self.errors) or 0.0
+
+    def _scale(self, factor, reason):
+        old = (self.bytes, self.rows)
+        self.bytes = self._clamp(self.bytes * factor, self.min_bytes, self.max_bytes)
+        if self.rows:
+            self.rows = self._clamp(self.rows * factor, self.min_rows, self.max_rows)
+        if (self.bytes, self.rows) != old and self.logger:
+            self.logger.info('{}Commit budget: {} bytes, {} rows ({})'.format(
+                self.prefix, self.bytes, self.rows, reason))
+
+
+class Prefetcher(object):
+    """Reads files ahead of the writer with a pool of threads, so that the
+    disk keeps working while the db is busy (and vice versa).
+
+    Items come out in the manifest order (same as read_files()); at most
+    `max_bytes` of file contents wait in the queue, a slow db therefore
+    stalls the readers instead of growing the memory.
+    """
+
+    _done = object()
+
+    def __init__(self, entries, ignore, readers=4, max_bytes=1024*1024*256, metrics=None):
+        self.ignore = ignore
+        self.metrics = metrics
+        self.budget = ByteBudget(max_bytes)
+        self.queue = Queue(maxsize=readers * 64)
+        self.pool = ThreadPoolExecutor(readers)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._feed, args=(entries,), name='ybload-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _feed(self, entries):
+        # the stat and the budget are taken here, in the manifest order, so
+        # that the item the writer waits for never waits for the budget
+        try:
+            for e in entries:
+                lineno, offset, key, path = e[:4]
+                if self._stop.is_set():
+                    return
+                size = _size(e)
+                if size == -1:
+                    size = _stat(path, self.metrics)
+                if size is None or size > self.ignore:
+                    self._put((lineno, offset, key, path, size, None))
+                    continue
+                self.budget.acquire(size)
+                self._put(self.pool.submit(_read, lineno, offset, key, path, self.ignore, size,
+                                          self.metrics))
+            self._put(self._done)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        held = 0
+        while True:
+            self.budget.release(held)
+            held = 0
+            item = self.queue.get()
+            if item is self._done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, Future):
+                item = item.result()
+                held = item[4]
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self.budget.close()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if isinstance(item, Future):
+                item.cancel()
+        self._thread.join()
+        self.pool.shutdown(wait=True)
+
+
+class IngestStats(object):
+    """Counters collected by one ingest worker."""
+
+    _fields = ('files', 'bytes', 'skipped', 'missing', 'existing', 'chunked',
+               'deduplicated', 'unchanged', 'compressed', 'packed', 'commits', 'retries', 'unreadable')
+
+    def __init__(self, worker=0):
+        self.worker = worker
+        self.files = self.bytes = self.skipped = self.missing = self.existing = 0
+        self.chunked = self.deduplicated = self.unchanged = self.compressed = self.commits = 0
+        self.retries = self.packed = self.unreadable = 0
+        self.start = time.time()
+        self.elapsed = 0.0
+        self.instruments = None
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+        return self
+
+    def toJSON(self):
+        out = dict((f, getattr(self, f)) for f in IngestStats._fields)
+        out['worker'] = self.worker
+        out['elapsed'] = self.elapsed
+        if self.instruments:
+            out['instruments'] = self.instruments.toJSON()
+        return out
+
+
+def summarize(results, elapsed):
+    """Combines the stats of individual workers into one report."""
+    out = dict((f, 0) for f in IngestStats._fields)
+    for r in results:
+        for f in IngestStats._fields:
+            out[f] += r[f]
+    out['workers'] = len(results)
+    out['elapsed'] = elapsed
+    out['files_per_sec'] = elapsed and out['files'] / elapsed or 0.0
+    out['mb_per_sec'] = elapsed and out['bytes'] / elapsed / (1024 * 1024) or 0.0
+    out.update(instrument.merge([r['instruments'] for r in results if 'instruments' in r]))
+    return out
+
+
+def format_progress(files, size, elapsed):
+    return 'Progress: {} files, {} bytes, {:.1f} files/s, {:.2f} MB/s, elapsed {:.0f}s'.format(
+        files, size, elapsed and files / elapsed or 0.0,
+        elapsed and size / elapsed / (1024 * 1024) or 0.0, elapsed)
+
+
+class Reporter(object):
+    """Prints progress at most once every `report` seconds (0 turns it off)."""
+
+    def __init__(self, logger, report=0):
+        self.logger = logger
+        self.report = report
+        self.start = self.last = time.time()
+
+    def due(self):
+        return self.report and time.time() - self.last >= self.report
+
+    def __call__(self, files, size, force=False):
+        if not (force or self.due()):
+            return
+        self.last = time.time()
+        msg = format_progress(files, size, self.last - self.start)
+        print(msg)
+        self.logger.info(msg)
+
+
+class SharedProgress(object):
+    """Per-worker (files, bytes) counters living in shared memory; workers
+    write into their own slot and the parent sums them up."""
+
+    def __init__(self, ctx, workers):
+        self.values = ctx.Array('d', workers * 2, lock=False)
+
+    def slot(self, worker):
+        values = self.values
+
+        def update(files, size, force=False):
+            values[worker * 2] = files
+            values[worker * 2 + 1] = size
+        return update
+
+    def totals(self):
+        v = self.values[:]
+        return int(sum(v[0::2])), int(sum(v[1::2]))
+
+
+def new_run_id():
+    return '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+
+def _run_key(run_id, worker=None):
+    if worker is None:
+        return 'ingest:{}'.format(run_id)
+    return 'ingest:{}:{}'.format(run_id, worker)
+
+
+def save_run(app, run_id, info):
+    """Records the parameters of the ingest run (in the KeyValue table)"""
+    with app.session_scope() as session:
+        session.merge(KeyValue(key=_run_key(run_id), value=json.dumps(info)))
+
+
+def load_run(app, run_id):
+    """Returns (run parameters, {worker: checkpoint}); run parameters
+    are None when the run is not known"""
+    run = None
+    checkpoints = {}
+    with app.session_scope() as session:
+        for kv in session.query(KeyValue).filter(KeyValue.key.startswith(_run_key(run_id))).all():
+            if kv.key == _run_key(run_id):
+                run = json.loads(kv.value)
+            elif kv.key.rsplit(':', 1)[0] == _run_key(run_id):
+                checkpoints[int(kv.key.rsplit(':', 1)[1])] = json.loads(kv.value)
+    return run, checkpoints
+
+
+def save_checkpoint(cursor, run_id, worker, state):
+    """Stores the worker's progress; it is executed on the ingest cursor so
+    it becomes durable together with the data it describes"""
+    cursor.execute('INSERT INTO {} (key, value) VALUES (%s, %s) '
+                   'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value'.format(KeyValue.__tablename__),
+                   (_run_key(run_id, worker), json.dumps(state)))
+
+
+def check_options(upsert=False, pack=False, codec=None, content_addressed=False):
+    """Raises ValueError for options that do not go together (before
+    anything is opened or saved)"""
+    if upsert and pack:
+        raise ValueError('Packed values can not be updated (upsert)')
+    if pack and (content_addressed or codec not in (None, 'none')):
+        raise ValueError('Packed values can not be compressed nor content addressed')
+
+
+def ingest_files(app, location, commit_after=1024*1024*100, ignore=1024*1024*200,
+                 worker=0, workers=1, partition='lines', progress=None,
+                 writer='row', batch_rows=1000, chunk_size=1024*1024*8,
+                 readers=4, max_prefetch=1024*1024*256, run_id=None, checkpoint=None,
+                 prefilter=5000, bloom=None, content_addressed=False, upsert=False,
+                 codec=None, min_ratio=0.9, metrics_file=None, prom_file=None, metrics_interval=10,
+                 adaptive=False, commit_rows=None, min_commit=1024*1024, max_commit=1024*1024*1024,
+                 min_rows=100, max_rows=100000, target_latency=1.0, retries=5, retry_delay=0.1,
+                 strip_components=0, strip_prefix='', key_prefix='', crawlers=8,
+                 pack=False, segment_size=1024*1024*4, pack_max=1024*64, bloom_file=None):
+    """Reads the manifest and inserts the files that belong to this worker;
+    `writer` names the write engine (see ybload.writers) that sends up to
+    `batch_rows` rows per round trip. Files larger than `ignore` are
+    streamed into the chunk table in `chunk_size` pieces (or skipped when
+    chunk_size is 0).
+
+    With readers > 0, that many threads read the files ahead of the writer
+    (holding at most `max_prefetch` bytes); readers=0 reads each file only
+    when the writer asks for it.
+
+    With `run_id`, every commit also saves the position in the manifest;
+    `checkpoint` (a previously saved one) makes the ingest continue right
+    behind it.
+
+    With prefilter > 0, keys are first looked up in batches of that size
+    and files that are already stored are neither read nor sent; `bloom`
+    (a filter of stored keys) saves lookups of keys that are certainly
+    new. The keys of every committed transaction are added to `bloom`,
+    which is saved into `bloom_file` at the end (<bloom_file>.<worker>
+    with several workers, see merge_bloom()).
+
+    content_addressed stores every unique content once (keyed by its
+    sha256) and makes the bigtable rows point at it; upsert updates the
+    stored keys whose content changed (and implies no prefilter). See
+    writers.ContentWriter; files streamed in chunks are compared by their
+    sha256 too (so they are read twice) and replace whatever was stored.
+
+    `codec` compresses the values that shrink at least to `min_ratio` of
+    their size (see ybload.compression).
+
+    Time spent in the stages (stat, read, execute, commit) is measured by
+    ybload.instrument; every `metrics_interval` seconds a snapshot is
+    appended to `metrics_file` (JSON lines) and written into `prom_file`
+    (Prometheus text format, one file per worker).
+
+    A transaction is committed after `commit_after` bytes (or `commit_rows`
+    files); with `adaptive` these sizes follow the commit latency (aiming
+    below `target_latency` seconds) within [min_commit, max_commit] and
+    [min_rows, max_rows], see CommitBudget. One connection is used for the
+    whole run.
+
+    Transient db errors (see ybload.retry) do not end the run: the
+    transaction is rolled back, its files are sent again and the failed
+    step is repeated, at most `retries` times in a row, after a jittered
+    exponential backoff (starting at `retry_delay` seconds).
+
+    When `location` is a tar or zip archive, its members are ingested
+    instead of the files of a manifest (read in one stream, the readers
+    are not used; the members waiting in the batches of the prefilter hold
+    at most `max_prefetch` bytes); keys are derived from the member paths by
+    `strip_prefix`, `strip_components` and `key_prefix`, see
+    ybload.archives.
+
+    When `location` is a directory, the tree is walked by `crawlers`
+    threads and its files are ingested as they are found (keys are the
+    relative paths, prefixed with `key_prefix`), see ybload.crawl; what
+    can not be read is logged and counted (stats.unreadable).
+
+    With `pack`, files of up to `pack_max` bytes are concatenated into
+    segments of `segment_size` bytes instead of getting a bigtable row
+    each (see ybload.packing); they are neither compressed nor content
+    addressed (ValueError). A key is kept in one place: a packed copy of
+    a key written into the bigtable is deleted. Returns IngestStats"""
+
+    check_options(upsert=upsert, pack=pack, codec=codec, content_addressed=content_addressed)
+    connection = cursor = w = None
+    prefix = workers > 1 and '[worker {}] '.format(worker) or ''
+    stats = IngestStats(worker)
+    checkpoint = checkpoint or {}
+    if checkpoint.get('done'):
+        return stats.finish()
+    position = (checkpoint.get('lineno', 0), checkpoint.get('offset', 0))
+    batch = []
+    size = 0
+    mark = None
+    # bytes of the file being streamed in chunks: [committed, counted in size or committed]
+    current = [0, 0]
+    sent = 0
+    if prom_file and workers > 1:
+        prom_file = '{0}.{2}{1}'.format(*(os.path.splitext(prom_file) + (worker,)))
+    if bloom_file and workers > 1:
+        bloom_file = '{}.{}'.format(bloom_file, worker)
+    metrics = instrument.Instruments(worker, metrics_file, prom_file, metrics_interval, run_id=run_id)
+    stats.instruments = metrics
+    budget = CommitBudget(commit_after, commit_rows, adaptive, target_latency, min_commit, max_commit,
+                          min_rows, max_rows, app.logger, prefix)
+    policy = retry.RetryPolicy(retries, retry_delay)
+    # counters that the writers update (they must not count a replay twice)
+    writer_counters = ('deduplicated', 'unchanged', 'compressed', 'packed')
+    counted = [0] * len(writer_counters)
+
+    def open_writer(cursor):
+        if content_addressed or upsert or codec:
+            w = writers.ContentWriter(cursor, writer, batch_rows, content_addressed, upsert, stats,
+                                      codec=codec, min_ratio=min_ratio)
+        else:
+            w = writers.get_writer(writer, cursor, batch_rows=batch_rows)
+        if pack:
+            return packing.PackWriter(cursor, w, writer, batch_rows, segment_size, pack_max, stats)
+        return w
+
+    def connect():
+        nonlocal connection, cursor, w
+        if connection is None:
+            connection = app._engine.raw_connection()
+            cursor = connection.cursor()
+            w = open_writer(cursor)
+
+    def write(key, path, data, after_chunk=None):
+        """Sends one file; data is None for files streamed in chunks"""
+        nonlocal mark, sent
+        if data is not None:
+            with metrics.stage('execute'):
+                w.add(key, data)
+            return
+        digest = None
+        if upsert:
+            # the file is read twice, but an unchanged value is not sent
+            with opener(path) as input:
+                digest = blobs.checksum(input)
+            found, stored = blobs.stored_digest(cursor, key)
+            if found and stored == digest:
+                stats.unchanged += 1
+                return
+        elif blobs.exists(cursor, key):
+            return
+        with opener(path) as input:
+            mark = time.time()
+            sent = 0
+            blobs.write_chunked(cursor, key, input, chunk_size, after_chunk,
+                                codec=codec, min_ratio=min_ratio, digest=digest, replace=upsert)
+            metrics.timed('execute', time.time() - mark)
+        return True
+
+    def commit(done=False):
+        nonlocal size, batch, counted
+        start = time.time()
+        with metrics.stage('execute'):
+            w.flush()
+            if batch:
+                packing.drop_shadowed(cursor, [b[2] for b in batch])
+        if run_id:
+            save_checkpoint(cursor, run_id, worker, {
+                'lineno': position[0], 'offset': position[1], 'done': done,
+                'files': checkpoint.get('files', 0) + stats.files,
+                'bytes': checkpoint.get('bytes', 0) + stats.bytes + size})
+        t = time.time()
+        connection.commit()
+        metrics.committed(time.time() - t)
+        if bloom is not None:
+            # the keys are stored now; the next runs need not look them up
+            for b in batch:
+                if b[2] not in bloom:
+                    bloom.add(b[2])
+        budget.committed(time.time() - start, size, len(batch))
+        stats.bytes += size
+        stats.commits += 1
+        size = 0
+        batch = []
+        counted = [getattr(stats, f) for f in writer_counters]
+        current[0] = current[1]
+
+    def after_chunk(n):
+        # big files must not make the transaction grow without limits; a
+        # file streamed again (after a retry) counts only the bytes that
+        # were not counted before
+        nonlocal size, mark, sent
+        sent += n
+        if sent > current[1]:
+            size += sent - current[1]
+            current[1] = sent
+        if size > budget.bytes:
+            metrics.timed('execute', time.time() - mark)
+            commit()
+            mark = time.time()
+
+    def recover():
+        # roll back (or drop the broken connection) and send the uncommitted
+        # files again; the bytes of the rolled back files are counted anew
+        nonlocal connection, cursor, w, size, mark
+        if connection is not None:
+            try:
+                cursor.close()
+                connection.rollback()
+                cursor = connection.cursor()
+                w = open_writer(cursor)
+            except Exception:
+                connection.invalidate()
+                connection = None
+        connect()
+        for f, v in zip(writer_counters, counted):
+            setattr(stats, f, v)
+        size = 0
+        mark = None
+        current[1] = current[0]
+        for lineno, path, key, data, n in batch:
+            write(key, path, data)
+            size += n
+
+    def retrying(op):
+        attempt = 0
+        while True:
+            try:
+                if attempt:
+                    recover()
+                return op()
+            except Exception as e:
+                if not policy.should_retry(e, attempt):
+                    raise
+                attempt += 1
+                stats.retries += 1
+                budget.failed()
+                delay = policy.delay(attempt)
+                app.logger.warning('{}Transient error, replaying {} files in {:.2f}s (attempt {}/{}): {}'.format(
+                    prefix, len(batch), delay, attempt, policy.attempts, str(e).strip()))
+                time.sleep(delay)
+
+    hashed = workers > 1 and partition == 'hash'
+    archive = crawler = None
+    if archives.is_archive(location):
+        # the members are read in the stream (and the lines that belong to
+        # other workers skipped right there)
+        archive = archives.Archive(location, strip_components, strip_prefix, key_prefix)
+        opener = archive.open
+        entries = archive.entries(lineno=position[0], ignore=ignore, metrics=metrics,
+                                  select=not hashed and (lambda n: owns(worker, workers, n)) or None)
+    else:
+        opener = lambda path: open(path, 'rb')
+        if os.path.isdir(location):
+            crawler = crawl.Crawler(location, crawlers, key_prefix=key_prefix, logger=app.logger)
+            entries = crawler.entries(lineno=position[0])
+        else:
+            entries = read_manifest(location, offset=position[1], lineno=position[0])
+        if not hashed:
+            entries = (e for e in entries if owns(worker, workers, e[0]))
+    if hashed:
+        entries = HashPartition(app, worker, workers, max_bytes=max_prefetch)(entries)
+    if upsert:
+        prefilter = 0
+    if codec == 'none':
+        codec = None
+    if prefilter:
+        known = Prefilter(app, prefilter, bloom, max_prefetch)
+        entries = known(entries)
+    if archive is not None:
+        # the entries already are (lineno, offset, key, member, size, data)
+        items = (e for e in entries)
+    elif readers:
+        items = Prefetcher(entries, ignore, readers, max_prefetch, metrics)
+    else:
+        items = read_files(entries, ignore, metrics)
+
+    try:
+        for lineno, offset, key, path, s, data in items:
+            retrying(connect)
+
+            if s is None:
+                stats.missing += 1
+            elif s > ignore and not chunk_size:
+                app.logger.warning('Ignoring {} because it is too large'.format(path))
+                print('{}ignoring large file: {}'.format(prefix, path))
+                stats.skipped += 1
+            else:
+                current[:] = [0, 0]
+                if retrying(lambda: write(key, path, data, after_chunk)):
+                    # too large to be held in memory, it was streamed in pieces
+                    # (and maybe committed in part already)
+                    stats.chunked += 1
+                    n = current[1] - current[0]
+                else:
+                    n = s <= ignore and s or 0
+                    size += n
+                batch.append((lineno, path, key, data, n))
+                stats.files += 1
+                metrics.written(1, s)
+            position = (lineno + 1, offset)
+
+            if budget.full(size, len(batch)):
+                print('{}Committing: {} files, size: {}, total: {}'.format(prefix, stats.files, size, stats.bytes + size))
+                retrying(commit)
+                app.logger.info('{}Wrote: {} files, total: {}'.format(prefix, stats.files, stats.bytes))
+
+            if progress:
+                progress(stats.files, stats.bytes + size)
+            metrics.maybe_write()
+
+        if connection is None and run_id:
+            retrying(connect)
+        if connection:
+            retrying(lambda: commit(done=True))
+    except:
+        files = [b[:2] for b in batch]
+        print('{}Failed, size={}, total={}, batch={}'.format(prefix, size, stats.bytes, files))
+        app.logger.error('{}Failed: size={}, total={}, batch={}'.format(prefix, size, stats.bytes, files))
+        raise
+    finally:
+        items.close()
+        if archive is not None:
+            archive.close()
+        if connection is not None:
+            cursor.close()
+            connection.close()
+        if bloom is not None and bloom_file:
+            bloom.save(bloom_file)
+
+    if prefilter:
+        stats.existing = known.existing
+    if crawler is not None:
+        # directories (and files) of the tree that could not be read
+        stats.unreadable = crawler.errors
+    if progress:
+        progress(stats.files, stats.bytes, force=True)
+    metrics.maybe_write(force=True)
+    return stats.finish()
+
+
+def _worker_main(app, queue, kwargs):
+    try:
+        stats = ingest_files(app, **kwargs)
+        queue.put((kwargs['worker'], stats.toJSON(), None))
+    except Exception as e:
+        queue.put((kwargs['worker'], None, '{}: {}'.format(e.__class__.__name__, e)))
+        raise
+
+
+def ingest_parallel(app, location, workers=2, report=0, checkpoints=None, **kwargs):
+    """Splits the manifest between `workers` processes, each one of them
+    holding its own db connection; `checkpoints` are the saved positions
+    of the individual workers (of a resumed run), other arguments are
+    passed to ingest_files(). Returns list of per-worker stats."""
+
+    ctx = multiprocessing.get_context('fork')
+    shared = SharedProgress(ctx, workers)
+    queue = ctx.Queue()
+    reporter = Reporter(app.logger, report)
+
+    # children must not inherit pooled connections (they would share the
+    # sockets with us)
+    app._engine.dispose()
+
+    procs = []
+    for worker in range(workers):
+        wkwargs = dict(kwargs, location=location, worker=worker, workers=workers,
+                       progress=shared.slot(worker), checkpoint=(checkpoints or {}).get(worker))
+        p = ctx.Process(target=_worker_main, args=(app, queue, wkwargs),
+                        name='ybload-ingest-{}'.format(worker))
+        p.start()
+        procs.append(p)
+
+    results = {}
+    errors = []
+    try:
+        while len(results) + len(errors) < workers:
+            try:
+                worker, stats, error = queue.get(timeout=report or 1)
+            except Empty:
+                if not any(p.is_alive() for p in procs) and queue.empty():
+                    errors.append('worker died unexpectedly')
+                    break
+            else:
+                if error:
+                    errors.append('worker {}: {}'.format(worker, error))
+                else:
+                    results[worker] = stats
+            reporter(*shared.totals())
+    finally:
+        for p in procs:
+            p.join()
+
+    if errors:
+        raise RuntimeError('Parallel ingest failed: {}'.format('; '.join(errors)))
+
+    reporter(*shared.totals(), force=True)
+    return [results[w] for w in sorted(results)]
@@ -0,0 +1,198 @@
+"""Live instrumentation of the ingest: time spent in the individual stages
+(stat, read, execute, commit), files/s and MB/s over sliding windows and
+percentiles of the commit latency.
+
+Snapshots are periodically appended to a JSON-lines file and/or written
+into a file in the Prometheus text format (to be picked up by the
+textfile collector of a local node exporter).
+"""
+
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+STAGES = ('stat', 'read', 'execute', 'commit')
+QUANTILES = (50, 95, 99)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of the values (None when there are none)"""
+    if not values:
+        return None
+    v = sorted(values)
+    return v[max(0, int(math.ceil(q / 100.0 * len(v))) - 1)]
+
+
+def latency_percentiles(values):
+    return dict(('p{}'.format(q), percentile(values, q)) for q in QUANTILES)
+
+
+class SlidingWindow(object):
+    """Files and bytes written during the last `seconds` (kept in one
+    second buckets)"""
+
+    def __init__(self, seconds=60):
+        self.seconds = seconds
+        self.start = time.time()
+        self.buckets = deque()
+
+    def add(self, files, nbytes, now=None):
+        second = int(now or time.time())
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += files
+            self.buckets[-1][2] += nbytes
+        else:
+            self.buckets.append([second, files, nbytes])
+
+    def rates(self, now=None):
+        """Returns (files/s, MB/s)"""
+        now = now or time.time()
+        while self.buckets and self.buckets[0][0] <= now - self.seconds:
+            self.buckets.popleft()
+        span = min(self.seconds, max(now - self.start, 1e-6))
+        files = sum(b[1] for b in self.buckets)
+        nbytes = sum(b[2] for b in self.buckets)
+        return files / span, nbytes / span / (1024 * 1024)
+
+
+class Instruments(object):
+    """Collects the measurements of one ingest worker (thread safe: the
+    reader threads report into it as well)"""
+
+    def __init__(self, worker=0, metrics_file=None, prom_file=None, interval=10,
+                 windows=(10, 60), run_id=None):
+        self.worker = worker
+        self.run_id = run_id
+        self.metrics_file = metrics_file
+        self.prom_file = prom_file
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = dict((s, [0, 0.0, 0.0]) for s in STAGES)  # calls, total, max
+        self.latencies = deque(maxlen=10000)
+        self.windows = [SlidingWindow(w) for w in windows]
+        self.files = self.bytes = 0
+        self.start = self.last = time.time()
+
+    def timed(self, stage, seconds):
+        with self.lock:
+            s = self.stages[stage]
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+
+    @contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.timed(name, time.time() - t)
+
+    def committed(self, seconds):
+        self.timed('commit', seconds)
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def written(self, files, nbytes):
+        now = time.time()
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+            for w in self.windows:
+                w.add(files, nbytes, now)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            out = {
+                'time': now,
+                'worker': self.worker,
+                'elapsed': now - self.start,
+                'files': self.files,
+                'bytes': self.bytes,
+                'stages': dict((k, {'calls': v[0], 'seconds': v[1], 'max': v[2]})
+                               for k, v in self.stages.items()),
+                'commit_latency': latency_percentiles(self.latencies),
+            }
+            for w in self.windows:
+                files, mbs = w.rates(now)
+                out['files_per_sec_{}s'.format(w.seconds)] = files
+                out['mb_per_sec_{}s'.format(w.seconds)] = mbs
+        if self.run_id:
+            out['run_id'] = self.run_id
+        return out
+
+    def maybe_write(self, force=False):
+        """Writes the snapshot into the output files once per interval"""
+        if not (self.metrics_file or self.prom_file):
+            return
+        if not force and time.time() - self.last < self.interval:
+            return
+        self.last = time.time()
+        snap = self.snapshot()
+        if self.metrics_file:
+            with open(self.metrics_file, 'a') as fo:
+                fo.write(json.dumps(snap, sort_keys=True) + '\n')
+        if self.prom_file:
+            tmp = '{}.{}.tmp'.format(self.prom_file, os.getpid())
+            with open(tmp, 'w') as fo:
+                fo.write(prometheus(snap, self.windows))
+            os.rename(tmp, self.prom_file)
+
+    def toJSON(self):
+        with self.lock:
+            return {'stages': dict((k, {'calls': v[0], 'seconds': v[1], 'max': v[2]})
+                                   for k, v in self.stages.items()),
+                    'latencies': list(self.latencies)}
+
+
+def merge(results):
+    """Combines the instruments of several workers (as returned by
+    Instruments.toJSON()) into stage totals and commit latency percentiles"""
+    stages = dict((s, {'calls': 0, 'seconds': 0.0, 'max': 0.0}) for s in STAGES)
+    latencies = []
+    for r in results:
+        for k, v in r.get('stages', {}).items():
+            stages[k]['calls'] += v['calls']
+            stages[k]['seconds'] += v['seconds']
+            stages[k]['max'] = max(stages[k]['max'], v['max'])
+        latencies.extend(r.get('latencies', []))
+    return {'stages': stages, 'commit_latency': latency_percentiles(latencies)}
+
+
+def prometheus(snap, windows):
+    """Renders the snapshot in the Prometheus text exposition format"""
+    labels = 'worker="{}"'.format(snap['worker'])
+    if snap.get('run_id'):
+        labels += ',run_id="{}"'.format(snap['run_id'])
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP ybload_ingest_{} {}'.format(name, help))
+        lines.append('# TYPE ybload_ingest_{} {}'.format(name, kind))
+        for extra, value in samples:
+            lbl = extra and '{},{}'.format(labels, extra) or labels
+            lines.append('ybload_ingest_{}{{{}}} {}'.format(name, lbl, value))
+
+    metric('files_total', 'counter', 'Files sent to the db.', [('', snap['files'])])
+    metric('bytes_total', 'counter', 'Bytes sent to the db.', [('', snap['bytes'])])
+    metric('stage_seconds_total', 'counter', 'Time spent in the ingest stages.',
+           [('stage="{}"'.format(k), v['seconds']) for k, v in sorted(snap['stages'].items())])
+    metric('stage_calls_total', 'counter', 'Number of times the ingest stages ran.',
+           [('stage="{}"'.format(k), v['calls']) for k, v in sorted(snap['stages'].items())])
+    metric('files_per_second', 'gauge', 'Files written per second over a sliding window.',
+           [('window="{}s"'.format(w.seconds), snap['files_per_sec_{}s'.format(w.seconds)]) for w in windows])
+    metric('megabytes_per_second', 'gauge', 'MB written per second over a sliding window.',
+           [('window="{}s"'.format(w.seconds), snap['mb_per_sec_{}s'.format(w.seconds)]) for w in windows])
+    commit = snap['stages']['commit']
+    metric('commit_latency_seconds', 'summary', 'Latency of the commits.',
+           [('quantile="{}"'.format(q / 100.0), snap['commit_latency']['p{}'.format(q)] or 0)
+            for q in QUANTILES])
+    lines.append('ybload_ingest_commit_latency_seconds_sum{{{}}} {}'.format(labels, commit['seconds']))
+    lines.append('ybload_ingest_commit_latency_seconds_count{{{}}} {}'.format(labels, commit['calls']))
+    return '\n'.join(lines) + '\n'
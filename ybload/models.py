@@ -5,7 +5,7 @@ from past.builtins import basestring
 from adsputils import get_date
 from datetime import datetime
 from dateutil.tz import tzutc
-from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, Boolean, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, Boolean, DateTime, Index
 from sqlalchemy import types
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import Enum, LargeBinary
@@ -36,9 +36,84 @@ class BigTable(Base):
     __tablename__ = 'bigtable'
     key = Column(String(255), primary_key=True)
     value = Column(LargeBinary)
+    # large values are stored in pieces (BigTableChunk); this row is then
+    # only a manifest: value is NULL and these two say what to expect
+    size = Column(BigInteger)
+    chunks = Column(Integer)
+    # sha256 of the value; in the content-addressed mode the value itself
+    # lives (only once) in BigTableContent and this row points at it
+    digest = Column(String(64))
+    # compression of the value (or of every chunk); NULL when stored as is
+    codec = Column(String(16))
+
+    # which rows point at a content (the purge of orphaned content)
+    __table_args__ = (Index('ix_bigtable_digest', digest, postgresql_where=digest.isnot(None)),)
 
     def toJSON(self):
-        return {'key': self.key, 'value': len(self.value)}
+        """Reports the logical size of the value ('value') and how many
+        bytes it occupies in this row ('stored'; None when the bytes are
+        kept elsewhere in compressed form - chunks or shared content)"""
+        if self.value is not None:
+            stored = len(self.value)
+        elif self.chunks is not None and self.codec is None:
+            stored = self.size
+        else:
+            stored = None
+        out = {'key': self.key, 'value': self.size if self.size is not None else stored, 'stored': stored}
+        if self.chunks is not None:
+            out['chunks'] = self.chunks
+        if self.digest is not None:
+            out['digest'] = self.digest
+        if self.codec is not None:
+            out['codec'] = self.codec
+        return out
+
+
+class BigTableContent(Base):
+    """Unique values of the bigtable, keyed by their sha256"""
+    __tablename__ = 'bigtable_content'
+    digest = Column(String(64), primary_key=True)
+    value = Column(LargeBinary)
+    codec = Column(String(16))
+
+    def toJSON(self):
+        return {'digest': self.digest, 'value': len(self.value), 'codec': self.codec}
+
+
+class BigTableChunk(Base):
+    """Pieces of the values that were too large to be stored in one row"""
+    __tablename__ = 'bigtable_chunks'
+    key = Column(String(255), primary_key=True)
+    chunk_no = Column(Integer, primary_key=True)
+    value = Column(LargeBinary)
+
+    def toJSON(self):
+        return {'key': self.key, 'chunk_no': self.chunk_no, 'value': len(self.value)}
+
+
+class BigTableSegment(Base):
+    """Many small values concatenated into one blob (the packed mode); the
+    index says which key lives where (see ybload.packing)"""
+    __tablename__ = 'bigtable_segments'
+    id = Column(BigInteger, primary_key=True)
+    value = Column(LargeBinary)
+    index = Column(LargeBinary)
+    files = Column(Integer)
+
+    def toJSON(self):
+        return {'id': self.id, 'value': len(self.value), 'files': self.files}
+
+
+class BigTablePacked(Base):
+    """Where the packed values are: segment and the byte range in it"""
+    __tablename__ = 'bigtable_packed'
+    key = Column(String(255), primary_key=True)
+    segment = Column(BigInteger, index=True)
+    start = Column(BigInteger)
+    size = Column(BigInteger)
+
+    def toJSON(self):
+        return {'key': self.key, 'segment': self.segment, 'start': self.start, 'size': self.size}
 
 
 class KeyValue(Base):
@@ -133,6 +208,9 @@ class ChangeLog(Base):
     oldvalue = Column(Text)
     permanent = Column(Boolean, default=False)
 
+    # ordered (not hashed on yugabyte): the purge walks the keys in batches
+    __table_args__ = (Index('ix_change_log_key', key.asc(), id.asc()),)
+
     def toJSON(self):
         return {'id': self.id,
                 'key': self.key,
@@ -0,0 +1,111 @@
+"""Packed mode: small values are not given a bigtable row each - many of
+them are concatenated into one segment (`bigtable_segments`) and a narrow
+lookup row (`bigtable_packed`: key -> segment, start, size) tells where
+each of them is. A value is read with one indexed fetch that returns just
+its byte range of the segment (see blobs.open_value()).
+
+Every segment also carries its own index (keys with their byte ranges),
+so it can be taken apart without the lookup table.
+
+A key lives in one place: when it is stored in the bigtable too (a run
+without --pack after a packed one, or a large value of a packed run), the
+bigtable row takes precedence and the packed copy is deleted as the
+transaction is committed (drop_shadowed()). Packed values are stored as
+they are, --codec and --content_addressed do not go with --pack.
+"""
+
+import struct
+import psycopg2
+from ybload import writers
+from ybload.models import BigTable, BigTableSegment, BigTablePacked
+
+
+_count = struct.Struct('!I')
+_entry = struct.Struct('!IIH')  # start, size, length of the key
+
+
+def encode_index(members):
+    """Compact index of the segment: [(key, start, size)] -> bytes"""
+    out = [_count.pack(len(members))]
+    for key, start, size in members:
+        k = key.encode('utf8')
+        out.append(_entry.pack(start, size, len(k)))
+        out.append(k)
+    return b''.join(out)
+
+
+def decode_index(data):
+    """The opposite of encode_index()"""
+    data = bytes(data)
+    n, = _count.unpack_from(data)
+    pos = _count.size
+    members = []
+    for i in range(n):
+        start, size, length = _entry.unpack_from(data, pos)
+        pos += _entry.size
+        members.append((data[pos:pos + length].decode('utf8'), start, size))
+        pos += length
+    return members
+
+
+def drop_shadowed(cursor, keys):
+    """Deletes the packed copies of the keys that are in the bigtable too"""
+    cursor.execute('DELETE FROM {p} WHERE key = ANY(%s) AND EXISTS (SELECT 1 FROM {b} WHERE {b}.key = {p}.key)'.format(
+        p=BigTablePacked.__tablename__, b=BigTable.__tablename__), (list(keys),))
+
+
+class PackWriter(object):
+    """Collects values of up to `max_size` bytes into segments of about
+    `segment_size` bytes; larger values are passed to the `fallback`
+    writer (which stores them in the usual way). Has the interface of
+    the other writers (add/flush)"""
+
+    def __init__(self, cursor, fallback, writer='row', batch_rows=1000, segment_size=1024*1024*4,
+                 max_size=1024*64, stats=None):
+        self.cursor = cursor
+        self.fallback = fallback
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.stats = stats
+        self.lookup = writers.get_writer(writer, cursor, table=BigTablePacked.__tablename__,
+                                         columns=('key', 'segment', 'start', 'size'),
+                                         batch_rows=batch_rows)
+        self._reset()
+
+    def _reset(self):
+        self.parts = []
+        self.members = []
+        self.keys = set()
+        self.length = 0
+
+    def add(self, key, value):
+        if len(value) > self.max_size:
+            return self.fallback.add(key, value)
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        self.members.append((key, self.length, len(value)))
+        self.parts.append(value)
+        self.length += len(value)
+        if self.length >= self.segment_size:
+            self._write_segment()
+
+    def _write_segment(self):
+        if not self.members:
+            return 0
+        self.cursor.execute('INSERT INTO {} (value, index, files) VALUES (%s, %s, %s) RETURNING id'.format(
+            BigTableSegment.__tablename__), (psycopg2.Binary(b''.join(self.parts)),
+                                             psycopg2.Binary(encode_index(self.members)), len(self.members)))
+        segment, = self.cursor.fetchone()
+        for key, start, size in self.members:
+            self.lookup.add(key, segment, start, size)
+        n = len(self.members)
+        if self.stats is not None:
+            self.stats.packed += n
+        self._reset()
+        return n
+
+    def flush(self):
+        n = self._write_segment()
+        self.lookup.flush()
+        return n + self.fallback.flush()
@@ -0,0 +1,265 @@
+"""Purge of the ybload tables (`run.py --purge_prefix/--purge_keys/--reset`).
+
+Selective purges delete the rows of the chosen tables whose key starts
+with a prefix, or is one of a list of keys. Nothing is done in one big
+statement: every delete takes at most `batch` rows and is committed right
+away (so no lock is held for long and a transient error costs one batch,
+which is retried), and `workers` threads delete concurrently. With a key
+list they take `batch` keys at a time. With a prefix every table is walked
+once in the order of its keys: each batch continues right behind the last
+row the previous one deleted (so it never walks the rows deleted before);
+on yugabyte the tables that are hash sharded by the key are split into
+buckets of yb_hash_code() (one tablet each, see export.hash_ranges()) and
+walked in the hash order. The walk follows an index (the primary key, or
+ix_change_log_key of change_log). Orphaned content and segments are
+deleted the same way, in batches walking their primary keys.
+
+A full reset drops the tables and creates them again from the models
+(which is faster than deleting, or truncating, a big distributed table);
+the bigtable tables come back in the layout of config.py (see sharding).
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from ybload import blobs, export, ingest, retry, sharding
+from ybload.models import Records, ChangeLog, BigTable, BigTableChunk, BigTableContent, BigTableSegment, \
+    BigTablePacked
+
+
+# what the purge can be given: (table, key column) of the rows to delete
+GROUPS = {
+    'bigtable': ((BigTable.__table__, 'key'), (BigTableChunk.__table__, 'key'), (BigTablePacked.__table__, 'key')),
+    'records': ((Records.__table__, 'bibcode'),),
+    'change_log': ((ChangeLog.__table__, 'key'),),
+}
+
+# what a reset drops and creates; shared content and segments belong to the bigtable
+RESET = {
+    'bigtable': (BigTable.__table__, BigTableChunk.__table__, BigTableContent.__table__, BigTableSegment.__table__,
+                 BigTablePacked.__table__),
+    'records': (Records.__table__,),
+    'change_log': (ChangeLog.__table__,),
+}
+
+# values nobody points to anymore (left behind by purged keys); the lookups
+# go through ix_bigtable_digest and ix_bigtable_packed_segment
+_ORPHANS = (
+    (BigTableContent.__table__, 'NOT EXISTS (SELECT 1 FROM {b} WHERE {b}.digest = {c}.digest)'.format(
+        c=BigTableContent.__tablename__, b=BigTable.__tablename__)),
+    (BigTableSegment.__table__, 'NOT EXISTS (SELECT 1 FROM {p} WHERE {p}.segment = {s}.id)'.format(
+        s=BigTableSegment.__tablename__, p=BigTablePacked.__tablename__)),
+)
+
+
+def _check(groups):
+    for g in groups:
+        if g not in GROUPS:
+            raise ValueError('Unknown table: {} (choose from {})'.format(g, ', '.join(sorted(GROUPS))))
+
+
+class Progress(object):
+    """Rows deleted so far (per table), printed at most once every `report`
+    seconds (0 turns it off); thread safe"""
+
+    def __init__(self, logger, report=0):
+        self.logger = logger
+        self.report = report
+        self.deleted = {}
+        self.retries = 0
+        self.lock = threading.Lock()
+        self.start = self.last = time.time()
+
+    def add(self, table, rows):
+        with self.lock:
+            self.deleted[table] = self.deleted.get(table, 0) + rows
+        self()
+
+    def __call__(self, force=False):
+        if not (force or self.report and time.time() - self.last >= self.report):
+            return
+        self.last = time.time()
+        elapsed = self.last - self.start
+        rows = sum(self.deleted.values())
+        msg = 'Purged: {} rows ({}), {:.1f} rows/s, elapsed {:.0f}s'.format(
+            rows, ', '.join('{}={}'.format(k, v) for k, v in sorted(self.deleted.items())),
+            elapsed and rows / elapsed or 0.0, elapsed)
+        print(msg)
+        self.logger.info(msg)
+
+
+class Purger(object):
+    """Deletes rows of the tables of `groups` in batches of at most `batch`
+    rows with `workers` threads (each on its own connection)"""
+
+    def __init__(self, app, groups=('bigtable',), workers=4, batch=1000, report=0, retries=5, retry_delay=0.1):
+        _check(groups)
+        self.app = app
+        self.targets = [t for g in groups for t in GROUPS[g]]
+        self.workers = workers
+        self.batch = batch
+        self.policy = retry.RetryPolicy(retries, retry_delay)
+        self.progress = Progress(app.logger, report)
+
+    def _execute(self, connection, table, sql, params, fetch=False):
+        # one batch, in its own transaction; transient errors are retried.
+        # Returns (rows deleted, the row fetched - its first column is the count)
+        attempt = 0
+        while True:
+            try:
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+                row = None
+                if fetch:
+                    row = cursor.fetchone()
+                    n = row and row[0] or 0
+                else:
+                    n = cursor.rowcount
+                connection.commit()
+                self.progress.add(table.name, n)
+                return n, row
+            except Exception as e:
+                connection.rollback()
+                if not self.policy.should_retry(e, attempt):
+                    raise
+                attempt += 1
+                with self.progress.lock:
+                    self.progress.retries += 1
+                delay = self.policy.delay(attempt)
+                self.app.logger.warning('Transient error, retrying the purge of {} in {:.2f}s (attempt {}/{}): {}'.format(
+                    table.name, delay, attempt, self.policy.attempts, str(e).strip()))
+                time.sleep(delay)
+
+    def _keyset(self, table, column, bucket):
+        # what the batches advance by: the key column (plus the rest of the
+        # primary key when the key is not unique), behind its hash in buckets
+        pk = [c.name for c in table.primary_key.columns]
+        keyset = [column]
+        if not (table.c[column].unique or pk == [column]):
+            keyset += [c for c in pk if c != column]
+        if bucket is not None:
+            keyset.insert(0, ingest.hash_function().format(col=column))
+        return keyset
+
+    def _matching(self, table, column, bucket=None, params=()):
+        where = '{} LIKE %s'.format(column)
+        if bucket is not None:
+            where += ' AND ' + bucket.format(col=column)
+        return self._walk(table, where, self._keyset(table, column, bucket), params)
+
+    def _walk(self, table, where, keyset, params=()):
+        # deletes the rows matching `where` batch after batch (each one right
+        # behind the last row of the previous one, in the keyset order) until
+        # a batch comes out short
+        pk = ', '.join(c.name for c in table.primary_key.columns)
+        order = ', '.join(keyset)
+        sql = ('WITH d AS (DELETE FROM {t} WHERE ({pk}) IN (SELECT {pk} FROM {t} WHERE {where}{{after}} '
+               'ORDER BY {order} LIMIT {n:d}) RETURNING {returning}) '
+               'SELECT count(*) OVER (), {names} FROM d ORDER BY {last} LIMIT 1').format(
+            t=table.name, pk=pk, where=where, order=order, n=self.batch,
+            returning=', '.join('{} AS k{:d}'.format(k, i) for i, k in enumerate(keyset)),
+            names=', '.join('k{:d}'.format(i) for i in range(len(keyset))),
+            last=', '.join('k{:d} DESC'.format(i) for i in range(len(keyset))))
+        following = sql.format(after=' AND ({}) > ({})'.format(order, ', '.join(['%s'] * len(keyset))))
+        sql = sql.format(after='')
+        connection = self.app._engine.raw_connection()
+        total = 0
+        last = None
+        try:
+            while True:
+                n, row = self._execute(connection, table, last is None and sql or following,
+                                       params + (last or ()), fetch=True)
+                total += n
+                if n < self.batch:
+                    return total
+                last = tuple(row[1:])
+        finally:
+            connection.close()
+
+    def _listed(self, table, column, keys):
+        connection = self.app._engine.raw_connection()
+        try:
+            return self._execute(connection, table, 'DELETE FROM {} WHERE {} = ANY(%s)'.format(table.name, column),
+                                 (list(keys),))[0]
+        finally:
+            connection.close()
+
+    def by_prefix(self, prefix, buckets=None):
+        """Deletes the keys starting with the prefix ('' for all of them)"""
+        connection = self.app._engine.raw_connection()
+        try:
+            yb_hash = ingest.has_yb_hash(connection)
+        finally:
+            connection.close()
+        like = blobs.like_prefix(prefix)
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = []
+            for table, column in self.targets:
+                # buckets only where the rows are placed by the hash of the key
+                ranges = [(None, ())]
+                if yb_hash and table.primary_key.columns.values()[0].name == column:
+                    ranges = export.hash_ranges(buckets or self.workers * 4)
+                futures.extend(pool.submit(self._matching, table, column, where, (like,) + params)
+                               for where, params in ranges)
+            for f in futures:
+                f.result()
+        return self.summary()
+
+    def by_keys(self, keys):
+        """Deletes the keys of the iterable (which can be long, only a few
+        batches of it are held at once)"""
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = set()
+            chunk = []
+            for key in keys:
+                chunk.append(key)
+                if len(chunk) == self.batch:
+                    pending = self._submit(pool, pending, chunk)
+                    chunk = []
+            if chunk:
+                pending = self._submit(pool, pending, chunk)
+            for f in pending:
+                f.result()
+        return self.summary()
+
+    def _submit(self, pool, pending, chunk):
+        while len(pending) >= self.workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                f.result()
+        for table, column in self.targets:
+            pending.add(pool.submit(self._listed, table, column, chunk))
+        return pending
+
+    def orphans(self):
+        """Deletes shared content and segments that no key points to
+        anymore (in batches, walking their primary keys); returns {table:
+        rows}"""
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [(table.name, pool.submit(self._walk, table, where,
+                                                [c.name for c in table.primary_key.columns]))
+                       for table, where in _ORPHANS]
+            return dict((name, f.result()) for name, f in futures)
+
+    def summary(self):
+        self.progress(force=True)
+        elapsed = time.time() - self.progress.start
+        rows = sum(self.progress.deleted.values())
+        return {'deleted': dict(self.progress.deleted), 'rows': rows, 'retries': self.progress.retries,
+                'elapsed': elapsed, 'rows_per_sec': elapsed and rows / elapsed or 0.0}
+
+
+def reset(app, groups=('bigtable',)):
+    """Drops the tables of `groups` and creates them again (empty)"""
+    _check(groups)
+    tables = [t for g in groups for t in RESET[g]]
+    with app._engine.begin() as connection:
+        if 'bigtable' in groups:
+            sharding.configure(connection, *sharding.from_config(app.conf))
+        # table by table: drop_all(tables=...) would also drop the types of the other tables
+        for table in tables:
+            table.drop(connection, checkfirst=True)
+        for table in tables:
+            table.create(connection)
+    app.logger.info('Dropped and created tables: %s', ', '.join(t.name for t in tables))
+    return [t.name for t in tables]
@@ -0,0 +1,90 @@
+"""ORM-free reads of Records: only the columns of the load_only projection
+are selected (SQLAlchemy Core) and every row is turned into a dict by a
+converter that is made once per projection (it already knows which of
+the columns are dates and JSON). The dicts are exactly what
+Records.toJSON(load_only=...) makes, without the identity map, without
+the getattr/hasattr of every field and without parsing the dates again
+(they come as naive UTC timestamps and only get their tzinfo).
+"""
+
+import json
+import threading
+from adsputils import utc_zone
+from sqlalchemy import select, type_coerce, TIMESTAMP
+from ybload.models import Records
+
+
+_converters = {}
+_lock = threading.Lock()
+
+
+def fields(load_only=None):
+    """(name, kind) of the fields toJSON() gives for the projection, in
+    the same order"""
+    load_only = load_only and set(load_only) or set()
+    out = []
+    for kind, names in (('text', Records._text_fields), ('date', Records._date_fields),
+                        ('json', Records._json_fields)):
+        for name in names:
+            if not load_only or name in load_only:
+                out.append((name, kind))
+    return out
+
+
+def _converter(load_only):
+    names = []
+    dates = []
+    loads = []
+    for name, kind in fields(load_only):
+        names.append(name)
+        if kind == 'date':
+            dates.append(name)
+        elif kind == 'json':
+            loads.append(name)
+
+    def convert(row):
+        doc = dict(zip(names, row))
+        for name in dates:
+            v = doc[name]
+            if v is not None:
+                doc[name] = v.replace(tzinfo=utc_zone)
+        for name in loads:
+            v = doc[name]
+            if v:
+                doc[name] = json.loads(v)
+        return doc
+    return convert
+
+
+def converter(load_only=None):
+    """Function turning a row of query(load_only) into the toJSON() dict
+    (one per projection)"""
+    key = load_only and frozenset(load_only) or None
+    convert = _converters.get(key)
+    if convert is None:
+        with _lock:
+            convert = _converters.setdefault(key, _converter(load_only))
+    return convert
+
+
+def query(bibcodes, load_only=None):
+    """SELECT of the projection columns of the bibcodes"""
+    table = Records.__table__
+    columns = []
+    for name, kind in fields(load_only):
+        column = table.c[name]
+        if kind == 'date':
+            # the plain timestamp, without the conversions of UTCDateTime
+            column = type_coerce(column, TIMESTAMP).label(name)
+        columns.append(column)
+    return select(columns or [table.c.id]).where(table.c.bibcode.in_(bibcodes))
+
+
+def read(engine, bibcodes, load_only=None):
+    """toJSON() dicts of the records of the bibcodes (the ones that exist)"""
+    convert = converter(load_only)
+    connection = engine.connect()
+    try:
+        return [convert(row) for row in connection.execute(query(bibcodes, load_only))]
+    finally:
+        connection.close()
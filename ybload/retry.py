@@ -0,0 +1,73 @@
+"""Which db errors are worth retrying and how long to wait before the next
+attempt; used by the ingest to replay the uncommitted batch instead of
+giving up on the whole run.
+
+Transient errors are the ones the server reports with a SQLSTATE of the
+serialization/deadlock, connection or shutdown classes, dropped connections
+(no SQLSTATE at all) and the yugabyte specific conditions that come as
+internal errors (XX000) but go away on their own: tablet leader moves, read
+restarts, conflicts, timeouts.
+"""
+
+import random
+import psycopg2
+
+
+RETRYABLE_SQLSTATES = frozenset([
+    '40001',  # serialization_failure (also yugabyte's transaction conflicts)
+    '40P01',  # deadlock_detected
+    '08000', '08001', '08003', '08004', '08006',  # connection exceptions
+    '57P01', '57P02', '57P03',  # admin/crash shutdown, cannot connect now
+    '55P03',  # lock_not_available
+    '53300',  # too_many_connections
+])
+
+# fragments of the messages of transient yugabyte errors (reported as XX000)
+RETRYABLE_MESSAGES = (
+    'restart read required',
+    'leader not ready',
+    'not the leader',
+    'leader is not ready',
+    'try again',
+    'timed out',
+    'network error',
+    'transaction aborted',
+    'expired or aborted by a conflict',
+    'tablet not found',
+    'service unavailable',
+)
+
+
+def retryable(e):
+    """True if the exception (psycopg2 error, or an SQLAlchemy one wrapping
+    it) is transient"""
+    e = getattr(e, 'orig', None) or e
+    if not isinstance(e, psycopg2.Error):
+        return False
+    code = getattr(e, 'pgcode', None)
+    if code in RETRYABLE_SQLSTATES:
+        return True
+    if code is None:
+        # the connection went away before the server could say anything
+        return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    if code == 'XX000':
+        message = str(e).lower()
+        return any(m in message for m in RETRYABLE_MESSAGES)
+    return False
+
+
+class RetryPolicy(object):
+    """Up to `attempts` retries, the n-th one after a random delay between
+    0 and min(cap, base * 2**n) seconds ("full jitter" exponential backoff)"""
+
+    def __init__(self, attempts=5, base=0.1, cap=30.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def should_retry(self, e, attempt):
+        """`attempt` is the number of retries done so far"""
+        return attempt < self.attempts and retryable(e)
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
@@ -0,0 +1,116 @@
+"""Layout of the bigtable tables on yugabyte: with 'hash' the primary keys
+are sharded by their hash (`PRIMARY KEY ((key) HASH)`) and every table is
+pre-split into `tablets` tablets (`SPLIT INTO N TABLETS`), so that a fresh
+table takes the writes of a parallel ingest on all nodes from the start
+instead of on the one tablet that happens to hold the first keys. With
+'range' the keys stay ordered (`key ASC`) - good for scans by prefix, but
+sequential keys then all go to the same tablet.
+
+The layout is picked in config.py (BIGTABLE_SHARDING, BIGTABLE_TABLETS);
+configure() makes the models create the tables that way, rebuild() moves
+an existing table (with its rows) into it. Plain PostgreSQL knows neither,
+there the tables are created as usual.
+"""
+
+from sqlalchemy import MetaData, Table
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.ext.compiler import compiles
+from ybload.models import Base, BigTable, BigTableChunk, BigTableContent, BigTableSegment, BigTablePacked
+
+
+SHARDING = ('hash', 'range')
+
+# primary key of every table: (columns sharded by hash, columns ordered
+# inside of the shard) - the chunks of a value stay together, in order
+TABLES = {
+    BigTable.__tablename__: (('key',), ()),
+    BigTableChunk.__tablename__: (('key',), ('chunk_no',)),
+    BigTableContent.__tablename__: (('digest',), ()),
+    BigTableSegment.__tablename__: (('id',), ()),
+    BigTablePacked.__tablename__: (('key',), ()),
+}
+
+_INFO = 'yugabyte'
+
+
+def from_config(conf):
+    """(sharding, tablets) from the app config"""
+    sharding = conf.get('BIGTABLE_SHARDING', 'hash')
+    if sharding not in SHARDING:
+        raise ValueError('Unknown BIGTABLE_SHARDING: {}'.format(sharding))
+    return sharding, int(conf.get('BIGTABLE_TABLETS', 0) or 0)
+
+
+def is_yugabyte(connection):
+    return '-YB-' in connection.execute('SELECT version()').scalar()
+
+
+def primary_key(name, sharding='hash'):
+    hashed, ordered = TABLES[name]
+    if sharding == 'hash':
+        columns = ['({}) HASH'.format(', '.join(hashed))] + ['{} ASC'.format(c) for c in ordered]
+    else:
+        columns = ['{} ASC'.format(c) for c in hashed + ordered]
+    return 'PRIMARY KEY ({})'.format(', '.join(columns))
+
+
+@compiles(CreateTable, 'postgresql')
+def _create_table(create, compiler, **kw):
+    sql = compiler.visit_create_table(create, **kw)
+    layout = create.element.info.get(_INFO)
+    if not layout:
+        return sql
+    table = create.element
+    plain = 'PRIMARY KEY ({})'.format(', '.join(compiler.preparer.quote(c.name)
+                                                for c in table.primary_key.columns))
+    sql = sql.replace(plain, primary_key(layout['table'], layout['sharding']))
+    # only hash sharded tables can be split into a number of tablets
+    if layout['sharding'] == 'hash' and layout['tablets']:
+        sql = '{} SPLIT INTO {} TABLETS'.format(sql.rstrip(), layout['tablets'])
+    return sql
+
+
+def _set_layout(table, name, sharding, tablets):
+    if sharding:
+        table.info[_INFO] = {'table': name, 'sharding': sharding, 'tablets': tablets}
+    else:
+        table.info.pop(_INFO, None)
+
+
+def configure(connection, sharding='hash', tablets=0, metadata=None):
+    """Model option: the following metadata.create_all() makes the tables
+    in the layout. Only on yugabyte - returns False (and the models create
+    plain tables) anywhere else"""
+    metadata = metadata or Base.metadata
+    yugabyte = is_yugabyte(connection)
+    for name in TABLES:
+        _set_layout(metadata.tables[name], name, yugabyte and sharding, tablets)
+    return yugabyte
+
+
+def rebuild(connection, name, sharding='hash', tablets=0):
+    """Recreates the table `name` in the layout (None: the default of the
+    server) and moves its rows there; used by the migrations"""
+    meta = MetaData()
+    old = Table(name, meta, autoload=True, autoload_with=connection)
+    columns = []
+    for c in old.columns:
+        c = c.copy()
+        # keep the default of the old column (its sequence) rather than a new serial
+        c.autoincrement = False
+        columns.append(c)
+    new = Table('{}_rebuilt'.format(name), meta, *columns)
+    _set_layout(new, name, sharding, tablets)
+    new.create(connection)
+
+    quote = connection.dialect.identifier_preparer.quote
+    names = ', '.join(quote(c.name) for c in old.columns)
+    connection.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(quote(new.name), names, names, quote(name)))
+    for c in old.columns:
+        sequence = connection.execute('SELECT pg_get_serial_sequence(%s, %s)', (name, c.name)).scalar()
+        if sequence:
+            connection.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(sequence, quote(new.name), quote(c.name)))
+    old.drop(connection)
+    connection.execute('ALTER TABLE {} RENAME TO {}'.format(quote(new.name), quote(name)))
+    connection.execute('ALTER TABLE {} RENAME CONSTRAINT {} TO {}'.format(
+        quote(name), quote('{}_pkey'.format(new.name)), quote(old.primary_key.name or '{}_pkey'.format(name))))
@@ -1,4 +1,10 @@
 from ybload import app as app_module
+from celery.signals import worker_process_shutdown
 
 app = app_module.YBLoader('ybloader')
 
+
+@worker_process_shutdown.connect
+def close_marks(**kwargs):
+    # the coalesced mark_processed() requests still waiting for their batch
+    app.close_marks()
@@ -7,9 +7,11 @@ import os
 import sys
 import copy
 import json
+import time
+import threading
 
 import adsputils
-from ybload import app, models
+from ybload import app, models, cache, records
 from ybload.models import Base, MetricsBase
 from adsputils import get_date
 import testing.postgresql
@@ -71,6 +73,221 @@ class TestApp(unittest.TestCase):
         self.assertTrue(r['processed'])
         self.assertEqual(r['status'], 'solr-failed')
 
+    def test_update_storage_bulk(self):
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'hey': 1})
+        self.app.update_storage('xabc', 'bib_data', {'bibcode': 'abc', 'hey': 1})
+        items = [('abc', 'nonbib_data', {'nonbib': 1}), ('def', 'metadata', {'bibcode': 'def'}),
+                 ('abc', 'bib_data', '{"bibcode": "abc", "hey": 2}'), ('ghi', 'fulltext', {'body': 'text'}),
+                 ('def', 'augment', {'affiliations': ['-']}), ('def', 'orcid_claims', {'verified': []}),
+                 ('jkl', 'metrics', {'citations': 3})]
+        results = self.app.update_storage_bulk(items, batch_size=3)
+        expected = [self.app.update_storage('x' + bibcode, type, payload) for bibcode, type, payload in items]
+        self.assertEqual(len(results), len(items))
+
+        dates = set(models.Records._date_fields)
+        for (bibcode, type, payload), r, e in zip(items, results, expected):
+            self.assertEqual(sorted(r.keys()), sorted(e.keys()))
+            for k in r:
+                if k in dates:
+                    # update_storage() serializes new records before they are flushed (no 'created' yet)
+                    self.assertTrue(r[k] is not None or e[k] is None, (bibcode, type, k))
+                elif k not in ('id', 'bibcode'):
+                    self.assertEqual(r[k], e[k], (bibcode, type, k))
+            self.assertEqual(r['bibcode'], bibcode)
+        for bibcode in ('abc', 'def', 'ghi', 'jkl'):
+            r = self.app.get_record(bibcode)
+            self.assertEqual(r, [x for x, (b, _, _) in zip(results, items) if b == bibcode][-1])
+        self.assertEqual(self.app.get_record('abc')['bib_data'], {'bibcode': 'abc', 'hey': 2})
+        self.assertEqual(self.app.get_record('abc')['nonbib_data'], {'nonbib': 1})
+
+        with self.app.session_scope() as session:
+            logs = [(c.key, c.type, c.oldvalue) for c in session.query(models.ChangeLog).order_by(models.ChangeLog.id)]
+        bulk = [l for l in logs if not l[0].startswith('x')]
+        single = [(l[0][1:], l[1], l[2]) for l in logs if l[0].startswith('x')]
+        self.assertEqual(bulk, single)
+        self.assertEqual(bulk[3], ('abc', 'bib_data', '{"bibcode": "abc", "hey": 1}'))
+
+        self.assertRaises(Exception, self.app.update_storage_bulk, [('abc', 'unknown', {})])
+        self.assertEqual(self.app.update_storage_bulk([]), [])
+
+    def test_mark_processed_batches(self):
+        bibcodes = ['bib{}'.format(i) for i in range(25)]
+        self.app.update_storage_bulk([(b, 'bib_data', {'bibcode': b}) for b in bibcodes])
+        self.app.mark_processed(bibcodes + ['bib0', 'missing'], 'metrics',
+                                checksums=['c{}'.format(i) for i in range(25)] + ['last', 'x'],
+                                status='success', batch_size=4)
+        for i, b in enumerate(bibcodes):
+            r = self.app.get_record(b)
+            self.assertEqual(r['metrics_checksum'], i and 'c{}'.format(i) or 'last')
+            self.assertEqual(r['status'], 'success')
+            self.assertTrue(r['metrics_processed'] and r['processed'])
+            self.assertEqual((r['solr_processed'], r['solr_checksum']), (None, None))
+        self.assertEqual(self.app.get_record('missing'), None)
+
+        # without checksums the checksum is cleared (so the next run does not skip the doc)
+        self.app.mark_processed(bibcodes[:3], 'metrics')
+        r = self.app.get_record('bib1')
+        self.assertTrue(r['metrics_processed'])
+        self.assertEqual((r['metrics_checksum'], r['datalinks_checksum'], r['status']), (None, None, 'success'))
+        self.assertEqual(self.app.get_record('bib3')['metrics_checksum'], 'c3')
+        self.app.mark_processed(bibcodes[:3], 'links', checksums=['l0', 'l1', 'l2'], status='links-failed')
+        self.assertEqual(self.app.get_record('bib2')['datalinks_checksum'], 'l2')
+        self.assertEqual(self.app.get_record('bib2')['status'], 'links-failed')
+        self.assertRaises(ValueError, self.app.mark_processed, bibcodes, 'other')
+
+    def test_mark_processed_coalesced(self):
+        bibcodes = ['bib{}'.format(i) for i in range(40)]
+        self.app.update_storage_bulk([(b, 'bib_data', {'bibcode': b}) for b in bibcodes])
+        calls = []
+        mark = self.app.mark_processed
+
+        def mark_processed(bibcodes, type, checksums=None, status=None):
+            calls.append((len(bibcodes), type, status))
+            if 'bad' in bibcodes:
+                raise ValueError('bad bibcode')
+            return mark(bibcodes, type, checksums, status)
+
+        with mock.patch.object(self.app, 'mark_processed', mark_processed), \
+                mock.patch.dict(self.app._config, {'MARK_PROCESSED_BATCH': 10, 'MARK_PROCESSED_DELAY': 0.2}):
+            # 20 threads marking 2 documents each: a few batches of (at least) 10
+            threads = [threading.Thread(target=self.app.mark_processed_coalesced,
+                                        args=(bibcodes[i:i + 2], 'solr', ['s%s' % i, 's%s' % (i + 1)], 'success'))
+                       for i in range(0, 40, 2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(sum(c[0] for c in calls), 40)
+            self.assertTrue(len(calls) <= 4)
+            self.assertEqual(set(c[1:] for c in calls), set([('solr', 'success')]))
+            self.assertEqual(self.app.get_record('bib7')['solr_checksum'], 's7')
+            self.assertEqual(self.app.get_record('bib39')['status'], 'success')
+
+            # by time; a failing request gets its error, the others still go through
+            del calls[:]
+            start = time.time()
+            f1 = self.app.mark_processed_coalesced(['bib1'], 'metrics', wait=False)
+            f2 = self.app.mark_processed_coalesced(['bad'], 'metrics', wait=False)
+            f3 = self.app.mark_processed_coalesced(['bib2'], 'metrics', status='metrics-failed', wait=False)
+            self.assertEqual(f1.result(5), None)
+            self.assertTrue(time.time() - start >= 0.15)
+            self.assertRaises(ValueError, f2.result, 5)
+            self.assertEqual(f3.result(5), None)
+            self.assertEqual(calls, [(2, 'metrics', None), (1, 'metrics', None), (1, 'metrics', None),
+                                     (1, 'metrics', 'metrics-failed')])
+            self.assertTrue(self.app.get_record('bib1')['metrics_processed'])
+            self.assertEqual(self.app.get_record('bib2')['status'], 'metrics-failed')
+            self.assertRaises(ValueError, self.app.mark_processed_coalesced, ['bib1'], 'other')
+
+            # whatever is buffered is sent on shutdown
+            f = self.app.mark_processed_coalesced(['bib3'], 'links', ['l3'], wait=False)
+            aggregator = self.app._marks
+            self.app.close_marks()
+            self.assertTrue(f.done())
+            self.assertFalse(aggregator.thread.is_alive())
+            self.assertEqual(self.app.get_record('bib3')['datalinks_checksum'], 'l3')
+            self.assertEqual((aggregator.stats['requests'], aggregator.stats['failed']), (24, 1))
+
+    def test_iter_records(self):
+        bibcodes = ['bib{}'.format(i) for i in range(50)]
+        self.app.update_storage_bulk([(b, 'bib_data', {'bibcode': b}) for b in bibcodes])
+        expected = dict((b, self.app.get_record(b)) for b in bibcodes)
+        wanted = bibcodes + ['missing']
+
+        for threads in (0, 3):
+            records = self.app.iter_records(iter(wanted), chunk_size=7, threads=threads)
+            self.assertFalse(isinstance(records, list))
+            self.assertEqual(sorted((r['bibcode'], r) for r in records), sorted(expected.items()))
+            records = list(self.app.iter_records(wanted, load_only=['bibcode', 'bib_data'], chunk_size=4,
+                                                 threads=threads))
+            self.assertEqual(sorted(r['bibcode'] for r in records), sorted(bibcodes))
+            self.assertEqual(set(tuple(sorted(r.keys())) for r in records), set([('bib_data', 'bibcode')]))
+        self.assertEqual(list(self.app.iter_records([])), [])
+
+        # the chunks are separate queries
+        with mock.patch.object(self.app, '_get_records', wraps=self.app._get_records) as get:
+            first = next(self.app.iter_records(bibcodes, chunk_size=10))
+            self.assertEqual(get.call_count, 1)
+        self.assertEqual(first['bibcode'][:3], 'bib')
+        self.assertEqual(sorted(r['bibcode'] for r in self.app.get_record(bibcodes)), sorted(bibcodes))
+
+    def test_core_records(self):
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'title': u'\u00e9t\u00e9'})
+        self.app.update_storage('abc', 'fulltext', {'body': 'text'})
+        self.app.mark_processed(['abc'], 'solr', checksums=['x'], status='success')
+        self.app.update_storage('def', 'nonbib_data', {})
+        with self.app.session_scope() as session:
+            session.query(models.Records).filter_by(bibcode='def').update({'augments': ''})
+        bibcodes = ['abc', 'def', 'missing']
+        with self.app.session_scope() as session:
+            orm = dict((r.bibcode, r) for r in session.query(models.Records))
+            for load_only in (None, [], ['bibcode'], ['bib_data', 'processed', 'status'],
+                              ['augments', 'created', 'solr_checksum', 'id', 'unknown'], ['unknown']):
+                expected = dict((b, orm[b].toJSON(load_only=load_only)) for b in ('abc', 'def'))
+                got = records.read(self.app._engine, bibcodes, load_only)
+                self.assertEqual(len(got), 2)
+                for r in got:
+                    b = r.get('bibcode') or ('abc' if r == expected['abc'] else 'def')
+                    self.assertEqual(r, expected[b])
+                    self.assertEqual(list(r.keys()), list(expected[b].keys()))
+                    for k, v in r.items():
+                        self.assertEqual(type(v), type(expected[b][k]))
+                        if k in models.Records._date_fields and v is not None:
+                            self.assertEqual(v.tzinfo, expected[b][k].tzinfo)
+        self.assertEqual(self.app.get_record('def')['processed'], None)
+        self.assertEqual(self.app.get_record('def')['augments'], '')
+
+        # one converter per projection
+        self.assertTrue(records.converter(['bibcode', 'status']) is records.converter(('status', 'bibcode')))
+        self.assertFalse(records.converter(['bibcode']) is records.converter(None))
+        self.assertEqual(records.read(self.app._engine, [], None), [])
+
+    def test_record_cache(self):
+        self.app.record_cache = cache.RecordCache(max_size=3, ttl=0.5)
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'hey': 1})
+        r = self.app.get_record('abc')
+        r['bib_data']['hey'] = 'changed'
+        with mock.patch.object(records, 'read') as read:
+            self.assertEqual(self.app.get_record('abc')['bib_data'], {'bibcode': 'abc', 'hey': 1})
+            self.assertFalse(read.called)
+        self.assertEqual(self.app.get_record('abc', load_only=['bibcode', 'bib_data']),
+                         {'bibcode': 'abc', 'bib_data': {'bibcode': 'abc', 'hey': 1}})
+        self.assertEqual(self.app.get_record('missing'), None)
+        self.assertEqual(self.app.get_record('missing'), None)
+        stats = self.app.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 3, 3))
+
+        # writes invalidate
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'hey': 2})
+        self.assertEqual(self.app.cache_stats()['invalidations'], 2)
+        self.assertEqual(self.app.get_record('abc')['bib_data']['hey'], 2)
+        self.app.mark_processed(['abc'], 'solr', checksums=['x'])
+        self.assertEqual(self.app.get_record('abc')['solr_checksum'], 'x')
+        self.app.update_storage_bulk([('abc', 'nonbib_data', {'a': 1})])
+        self.assertEqual(self.app.get_record('abc')['nonbib_data'], {'a': 1})
+
+        # a value read before an invalidation is not stored
+        generation = self.app.record_cache.generation
+        self.app.record_cache.invalidate(['other'])
+        self.assertFalse(self.app.record_cache.put('other', None, {'bibcode': 'other'}, generation))
+
+        # lists; least recently used entries go first
+        self.app.update_storage('def', 'bib_data', {'bibcode': 'def'})
+        self.app.update_storage('ghi', 'bib_data', {'bibcode': 'ghi'})
+        self.assertEqual(sorted(r['bibcode'] for r in self.app.get_record(['abc', 'def', 'ghi', 'missing', 'abc'])),
+                         ['abc', 'def', 'ghi'])
+        stats = self.app.cache_stats()
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['evictions'], 1)  # abc, the least recently used
+        self.assertEqual(sorted(r['bibcode'] for r in self.app.get_record(['def', 'ghi', 'missing'])), ['def', 'ghi'])
+        self.assertEqual(self.app.cache_stats()['hits'], stats['hits'] + 3)
+
+        time.sleep(0.6)
+        self.assertEqual(self.app.get_record('def')['bibcode'], 'def')
+        self.assertEqual(self.app.cache_stats()['expirations'], 1)
+        self.app.record_cache = None
+        self.assertEqual(self.app.cache_stats(), None)
+
     def test_insert_binary_data(self):
         pass
 
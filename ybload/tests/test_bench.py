@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mock
+import unittest
+import os
+import json
+import tempfile
+import shutil
+
+from ybload.models import Base
+import testing.postgresql
+from sqlalchemy import create_engine
+import bench
+
+
+class TestBench(unittest.TestCase):
+    """
+    Tests the ingest benchmark
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = \
+            testing.postgresql.Postgresql(host='127.0.0.1', port=15678, user='postgres',
+                                          database='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.db_url = 'postgresql://postgres@127.0.0.1:15678/test'
+        self.engine = create_engine(self.db_url)
+        Base.metadata.create_all(self.engine)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        Base.metadata.drop_all(self.engine)
+        self.engine.dispose()
+
+    def test_make_corpus(self):
+        manifest, corpus = bench.make_corpus(os.path.join(self.tmpdir, 'a'), 10, 'huge', seed=7,
+                                             huge=1, huge_size=3000000)
+        _, again = bench.make_corpus(os.path.join(self.tmpdir, 'b'), 10, 'huge', seed=7,
+                                     huge=1, huge_size=3000000)
+        self.assertEqual(corpus, again)
+        self.assertEqual(corpus['largest'], 3000000)
+        with open(manifest) as fi:
+            lines = [l.strip().split('\t') for l in fi]
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(sum(os.path.getsize(p) for k, p in lines), corpus['bytes'])
+
+        _, tiny = bench.make_corpus(os.path.join(self.tmpdir, 'c'), 50, 'tiny')
+        self.assertTrue(tiny['largest'] <= 2000)
+        self.assertRaises(ValueError, bench.make_corpus, self.tmpdir, 1, 'uniform')
+
+    def test_run_grid(self):
+        manifest, corpus = bench.make_corpus(self.tmpdir, 30, 'lognormal', median=1000)
+        results = bench.run_grid(self.db_url, manifest, [10000, 1000000], ['row', 'copy'], self.tmpdir)
+        self.assertEqual(len(results), 4)
+        for r in results:
+            self.assertEqual(r['files'], 30)
+            self.assertEqual(r['bytes'], corpus['bytes'])
+            self.assertTrue(r['peak_rss'] > 0)
+            self.assertTrue(r['commit_latency']['p99'] is not None)
+        json.dumps(results)
+
+        slower = [dict(r, files_per_sec=r['files_per_sec'] / 2) for r in results]
+        self.assertEqual(bench.compare({'results': results}, {'results': results}), [])
+        self.assertEqual(len(bench.compare({'results': results}, {'results': slower})), 4)
+
+    def test_run_grid_dead_cell(self):
+        manifest, corpus = bench.make_corpus(self.tmpdir, 3, 'tiny')
+
+        def dying(*args):
+            os._exit(3)
+
+        with mock.patch.object(bench, '_run_one', dying):
+            results = bench.run_grid(self.db_url, manifest, [1000], ['row'], self.tmpdir)
+        self.assertEqual(len(results), 1)
+        self.assertIn('exit code 3', results[0]['error'])
+        self.assertEqual(bench.compare({'results': results}, {'results': results}), [])
+
+    def test_bench_records(self):
+        results = bench.bench_records(self.db_url, 120, projections=(None, ['bibcode', 'processed']), chunk_size=50)
+        self.assertEqual([(r['rows'], r['projection']) for r in results],
+                         [(120, None), (120, ['bibcode', 'processed'])])
+        for r in results:
+            self.assertTrue(r['orm_seconds'] > 0 and r['core_seconds'] > 0)
+        json.dumps(results)
+
+        output = os.path.join(self.tmpdir, 'records.json')
+        self.assertEqual(bench.main(['--records', '30', '--db_url', self.db_url, '-o', output]), 0)
+        with open(output) as fi:
+            self.assertEqual([r['rows'] for r in json.load(fi)['results']], [30, 30])
+
+
+if __name__ == '__main__':
+    unittest.main()
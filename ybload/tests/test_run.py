@@ -9,14 +9,22 @@ import copy
 import json
 
 import adsputils
-from ybload import app, models
+from ybload import app, models, ingest, writers, retry, archives, crawl, packing, export, sharding, purge, compression
 from ybload.models import Base, MetricsBase
 from adsputils import get_date
 import testing.postgresql
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import MetaData, event
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects import postgresql
 import tempfile
+import shutil
 import run
 import mock
+import psycopg2
+import io
+import tarfile
+import zipfile
 
 class TestRun(unittest.TestCase):
     """
@@ -46,10 +54,12 @@ class TestRun(unittest.TestCase):
             })
         Base.metadata.bind = self.app._session.get_bind()
         Base.metadata.create_all()
+        self.tmpdir = tempfile.mkdtemp()
         
         
     def tearDown(self):
         unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
         Base.metadata.drop_all()
         self.app.close_app()
 
@@ -74,7 +84,937 @@ class TestRun(unittest.TestCase):
                 if fname and os.path.exists(fname):
                     os.remove(fname)
 
+    def _make_corpus(self, tmpdir, n=20):
+        """Writes n small files and a manifest pointing at them"""
+        manifest = os.path.join(tmpdir, 'manifest.txt')
+        with open(manifest, 'w') as fo:
+            for i in range(n):
+                fpath = os.path.join(tmpdir, 'file%s' % i)
+                with open(fpath, 'wb') as f:
+                    f.write(('content of file %s' % i).encode('utf8'))
+                fo.write('key{}\t{}\n'.format(i, fpath))
+        return manifest
 
+    def _bigtable(self):
+        with self.app.session_scope() as s:
+            return dict((r.key, r.value) for r in s.query(models.BigTable).all())
+
+    def test_ingest_binary_workers(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=50), 20)
+            serial = self._bigtable()
+            self.assertEqual(len(serial), 20)
+
+            for partition in ('lines', 'hash'):
+                with self.app.session_scope() as s:
+                    s.execute('truncate table bigtable')
+                n = run.ingest_binary_files(manifest, commit_after=50, workers=3,
+                                            partition=partition, report=1)
+                self.assertEqual(n, 20)
+                self.assertEqual(self._bigtable(), serial)
+
+    def test_hash_partition(self):
+        # the buckets are the ranges of export.hash_ranges()
+        for n in (1, 3, 7, 16):
+            bounds = [params for _, params in export.hash_ranges(n, False)]
+            for code in range(ingest.HASH_SPACE):
+                lo, hi = bounds[ingest.hash_bucket(code, n)]
+                self.assertTrue(lo <= code < hi)
+
+        # keys go by the hash the server computes (hashtext() on PostgreSQL)
+        entries = [(i, i, 'key{}'.format(i), 'path') for i in range(50)]
+        with self.app.session_scope() as s:
+            codes = dict((e[2], s.execute('SELECT hashtext(:k) & 65535', {'k': e[2]}).scalar()) for e in entries)
+        owned = []
+        for worker in range(3):
+            part = list(ingest.HashPartition(self.app, worker, 3, batch=7)(iter(entries)))
+            self.assertEqual([e[2] for e in part],
+                             [e[2] for e in entries if ingest.hash_bucket(codes[e[2]], 3) == worker])
+            owned.extend(part)
+        self.assertEqual(sorted(owned), sorted(entries))
+
+    def test_ingest_binary_writers(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with mock.patch.object(run, 'app', self.app):
+            run.ingest_binary_files(manifest)
+            expected = self._bigtable()
+
+            for writer in ('values', 'copy'):
+                with self.app.session_scope() as s:
+                    s.execute("delete from bigtable where key in ('key1', 'key2', 'key3')")
+                    s.execute("update bigtable set value = 'old' where key = 'key4'")
+                self.assertEqual(run.ingest_binary_files(manifest, commit_after=100, writer=writer,
+                                                         batch_rows=3, prefilter=0), 20)
+                found = self._bigtable()
+                # existing rows are left alone (ON CONFLICT DO NOTHING)
+                self.assertEqual(found.pop('key4'), b'old')
+                self.assertEqual(found, dict((k, v) for k, v in expected.items() if k != 'key4'))
+                with self.app.session_scope() as s:
+                    s.execute("update bigtable set value = :v where key = 'key4'", {'v': expected['key4']})
+
+    def test_copy_writer_types(self):
+        # integers are sent in the size of their column: size is bigint, chunks and chunk_no integer
+        connection = self.app._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            w = writers.get_writer('copy', cursor, columns=('key', 'value', 'size', 'chunks', 'codec'))
+            w.add('manifest', None, 2 ** 40, 3, None)
+            w.add('plain', b'abc', 3, None, 'zlib')
+            w.flush()
+            w = writers.get_writer('copy', cursor, table=models.BigTableChunk.__tablename__,
+                                   columns=('key', 'chunk_no', 'value'))
+            w.add('manifest', 2, b'piece')
+            w.flush()
+            connection.commit()
+        finally:
+            connection.close()
+        with self.app.session_scope() as s:
+            r = s.query(models.BigTable).filter_by(key='manifest').first()
+            self.assertEqual((r.size, r.chunks, r.value), (2 ** 40, 3, None))
+            self.assertEqual(s.query(models.BigTable).filter_by(key='plain').first().codec, 'zlib')
+            self.assertEqual(s.query(models.BigTableChunk).filter_by(key='manifest').first().chunk_no, 2)
+        self.assertEqual(writers.encode_copy_field(7, 23), (b'\x00\x00\x00\x04', b'\x00\x00\x00\x07'))
+        self.assertRaises(ValueError, writers.encode_copy_field, 7, 25)
+
+    def test_ingest_binary_chunked(self):
+        big = os.path.join(self.tmpdir, 'big')
+        payload = os.urandom(1000)
+        with open(big, 'wb') as f:
+            f.write(payload)
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(manifest, 'w') as fo:
+            fo.write('big\t{}\n'.format(big))
+            fo.write('small\t{}\n'.format(self.app.conf.get('TEST_DIR') + '/data/foo.txt'))
+
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=300, ignore=100, chunk_size=0), 1)
+            self.assertEqual(set(self._bigtable()), set(['small']))
+
+            # 'small' is stored already, only the big one goes in
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=300, ignore=100, chunk_size=128), 1)
+            with self.app.session_scope() as s:
+                r = s.query(models.BigTable).filter_by(key='big').first()
+                self.assertEqual(r.toJSON(), {'key': 'big', 'value': 1000, 'stored': 1000, 'chunks': 8})
+                self.assertEqual(s.query(models.BigTableChunk).filter_by(key='big').count(), 8)
+
+        stream = self.app.open_value('big')
+        try:
+            self.assertEqual(stream.read(10), payload[:10])
+            self.assertEqual(stream.read(), payload[10:])
+        finally:
+            stream.close()
+        stream = self.app.open_value('small')
+        self.assertEqual(stream.read(), b'bar baz')
+        stream.close()
+        self.assertEqual(self.app.open_value('missing'), None)
+
+    def test_ingest_binary_prefetch(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with open(manifest, 'a') as fo:
+            fo.write('missing\t{}\n'.format(os.path.join(self.tmpdir, 'does-not-exist')))
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, readers=0), 20)
+            serial = self._bigtable()
+            with self.app.session_scope() as s:
+                s.execute('truncate table bigtable')
+            # the budget is smaller than a single file, readers must still make progress
+            self.assertEqual(run.ingest_binary_files(manifest, readers=3, max_prefetch=10), 20)
+            self.assertEqual(self._bigtable(), serial)
+
+    def test_prefetcher_order(self):
+        self._make_corpus(self.tmpdir)
+        entries = [(i, i * 10, 'key%s' % i, os.path.join(self.tmpdir, 'file%s' % i)) for i in range(20)]
+        items = ingest.Prefetcher(iter(entries), ignore=1024, readers=4, max_bytes=40)
+        try:
+            self.assertEqual([x[:4] for x in items], entries)
+        finally:
+            items.close()
+        self.assertEqual(items.budget.used, 0)
+
+    def test_ingest_binary_resume(self):
+        manifest = self._make_corpus(self.tmpdir)
+        broken = os.path.join(self.tmpdir, 'file10')
+        os.remove(broken)
+        os.mkdir(broken)
+
+        with mock.patch.object(run, 'app', self.app):
+            with self.assertRaises(IOError):
+                run.ingest_binary_files(manifest, commit_after=50, readers=0, run_id='test-run')
+            run_info, checkpoints = ingest.load_run(self.app, 'test-run')
+            self.assertEqual(run_info['workers'], 1)
+            self.assertEqual(checkpoints[0]['lineno'], 9)
+            self.assertEqual(checkpoints[0]['files'], 9)
+            self.assertFalse(checkpoints[0]['done'])
+
+            # files before the checkpoint must not be touched again
+            for i in range(9):
+                os.remove(os.path.join(self.tmpdir, 'file%s' % i))
+            os.rmdir(broken)
+            with open(broken, 'wb') as f:
+                f.write(b'fixed')
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=50, resume='test-run'), 11)
+
+            found = self._bigtable()
+            self.assertEqual(len(found), 20)
+            self.assertEqual(found['key10'], b'fixed')
+            run_info, checkpoints = ingest.load_run(self.app, 'test-run')
+            self.assertTrue(checkpoints[0]['done'])
+            self.assertEqual(checkpoints[0]['files'], 20)
+
+    def test_ingest_binary_prefilter(self):
+        manifest = self._make_corpus(self.tmpdir)
+        bloom = os.path.join(self.tmpdir, 'keys.bloom')
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, bloom=bloom, bloom_capacity=100), 20)
+            self.assertTrue(os.path.exists(bloom))
+            self.assertTrue('key7' in ingest.BloomFilter.load(bloom))
+
+            with self.app.session_scope() as s:
+                s.execute("delete from bigtable where key in ('key3', 'key4')")
+            # stored files are not even opened
+            with mock.patch.object(ingest, '_read', wraps=ingest._read) as reads:
+                self.assertEqual(run.ingest_binary_files(manifest, prefilter=7, bloom=bloom, readers=0), 2)
+                self.assertEqual(sorted(c[0][2] for c in reads.call_args_list), ['key3', 'key4'])
+            self.assertEqual(len(self._bigtable()), 20)
+
+            # the filter gets the committed keys (of every worker), the
+            # manifest is not read again for them
+            with open(manifest, 'a') as fo:
+                for i in range(20, 30):
+                    fo.write('key{}\t{}\n'.format(i, os.path.join(self.tmpdir, 'file1')))
+            with mock.patch.object(ingest, 'read_keys') as read_keys:
+                self.assertEqual(run.ingest_binary_files(manifest, bloom=bloom, workers=2), 10)
+            self.assertFalse(read_keys.called)
+            saved = ingest.BloomFilter.load(bloom)
+            self.assertTrue(all('key{}'.format(i) in saved for i in range(30)))
+            self.assertEqual(len(saved), 30)
+            self.assertFalse(os.path.exists(bloom + '.0') or os.path.exists(bloom + '.1'))
+
+    def test_bloom_filter(self):
+        b = ingest.BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            b.add('key%s' % i)
+        fname = os.path.join(self.tmpdir, 'test.bloom')
+        b.save(fname)
+        b = ingest.BloomFilter.load(fname)
+        self.assertTrue(all('key%s' % i in b for i in range(1000)))
+        false_positives = sum(1 for i in range(1000, 11000) if 'key%s' % i in b)
+        self.assertTrue(false_positives < 300)
+
+    def test_ingest_binary_content_addressed(self):
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(manifest, 'w') as fo:
+            for i in range(10):
+                fo.write('key{}\t{}\n'.format(i, self.app.conf.get('TEST_DIR') + '/data/foo.txt'))
+        with mock.patch.object(run, 'app', self.app):
+            for writer in ('row', 'values', 'copy'):
+                self.assertEqual(run.ingest_binary_files(manifest, writer=writer, batch_rows=4,
+                                                         content_addressed=True), 10)
+                with self.app.session_scope() as s:
+                    self.assertEqual(s.query(models.BigTableContent).count(), 1)
+                    r = s.query(models.BigTable).filter_by(key='key3').first()
+                    self.assertEqual(r.toJSON()['value'], 7)
+                    self.assertEqual(r.value, None)
+                    s.execute('truncate table bigtable, bigtable_content')
+
+            run.ingest_binary_files(manifest, content_addressed=True)
+        stream = self.app.open_value('key5')
+        self.assertEqual(stream.read(), b'bar baz')
+        stream.close()
+
+    def test_ingest_binary_upsert(self):
+        manifest = self._make_corpus(self.tmpdir, n=5)
+        with mock.patch.object(run, 'app', self.app):
+            for content_addressed in (False, True):
+                stats = ingest.ingest_files(self.app, manifest, upsert=True, content_addressed=content_addressed)
+                self.assertEqual(stats.files, 5)
+                with open(os.path.join(self.tmpdir, 'file2'), 'wb') as f:
+                    f.write(('changed %s' % content_addressed).encode('utf8'))
+                stats = ingest.ingest_files(self.app, manifest, upsert=True, content_addressed=content_addressed)
+                self.assertEqual(stats.unchanged, 4)
+                stream = self.app.open_value('key2')
+                self.assertEqual(stream.read(), ('changed %s' % content_addressed).encode('utf8'))
+                stream.close()
+
+    def _chunks(self, key):
+        with self.app.session_scope() as s:
+            return s.query(models.BigTableChunk).filter_by(key=key).count()
+
+    def test_ingest_binary_upsert_chunked(self):
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        path = os.path.join(self.tmpdir, 'big')
+        with open(manifest, 'w') as fo:
+            fo.write('big\t{}\n'.format(path))
+
+        def ingest_value(payload, **kwargs):
+            with open(path, 'wb') as f:
+                f.write(payload)
+            return ingest.ingest_files(self.app, manifest, upsert=True, ignore=5000, chunk_size=2000, **kwargs)
+
+        for content_addressed in (False, True):
+            first = os.urandom(9000)
+            stats = ingest_value(first, content_addressed=content_addressed)
+            self.assertEqual((stats.chunked, self._chunks('big')), (1, 5))
+            self.assertEqual(self.app.open_value('big').read(), first)
+
+            # the same large file is not sent again
+            stats = ingest_value(first, content_addressed=content_addressed)
+            self.assertEqual((stats.chunked, stats.unchanged), (0, 1))
+
+            # a changed large file replaces the stored one (a shorter one drops the extra pieces)
+            second = os.urandom(5500)
+            stats = ingest_value(second, content_addressed=content_addressed)
+            self.assertEqual((stats.chunked, stats.unchanged), (1, 0))
+            self.assertEqual(self.app.open_value('big').read(), second)
+            self.assertEqual(self._chunks('big'), 3)
+
+            # large -> small: the value is inline (or content) and its pieces are gone
+            third = b'small now'
+            stats = ingest_value(third, content_addressed=content_addressed)
+            self.assertEqual((stats.files, stats.unchanged), (1, 0))
+            self.assertEqual(self.app.open_value('big').read(), third)
+            self.assertEqual(self._chunks('big'), 0)
+            self.assertEqual(self.app.value_info('big')['chunks'], None)
+
+            # small -> large
+            stats = ingest_value(first, content_addressed=content_addressed)
+            self.assertEqual(stats.chunked, 1)
+            self.assertEqual(self.app.open_value('big').read(), first)
+            self.assertEqual(self.app.value_info('big')['storage'], 'chunked')
+            purge.reset(self.app, ('bigtable',))
+
+    def test_ingest_binary_codecs(self):
+        text = b'the quick brown fox jumps over the lazy dog\n' * 100
+        noise = os.urandom(4000)
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(manifest, 'w') as fo:
+            for name, payload in (('text', text), ('noise', noise)):
+                with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                    f.write(payload)
+                fo.write('{}\t{}\n'.format(name, os.path.join(self.tmpdir, name)))
+
+        with mock.patch.object(run, 'app', self.app):
+            for codec in ('zlib', 'lzma', 'bz2'):
+                for ignore in (10000, 1000):  # inline and chunked
+                    self.assertEqual(run.ingest_binary_files(manifest, ignore=ignore, chunk_size=1500,
+                                                             codec=codec, writer='copy'), 2)
+                    with self.app.session_scope() as s:
+                        r = s.query(models.BigTable).filter_by(key='text').first().toJSON()
+                        self.assertEqual(r['codec'], codec)
+                        self.assertEqual(r['value'], len(text))
+                        if ignore > len(text):
+                            self.assertTrue(r['stored'] < len(text) / 10)
+                        r = s.query(models.BigTable).filter_by(key='noise').first().toJSON()
+                        self.assertFalse('codec' in r)
+                        self.assertEqual(r['value'], len(noise))
+
+                    for key, payload in (('text', text), ('noise', noise)):
+                        stream = self.app.open_value(key)
+                        self.assertEqual(stream.read(), payload)
+                        stream.close()
+                    run.truncate()
+
+    def test_ingest_binary_metrics(self):
+        manifest = self._make_corpus(self.tmpdir)
+        metrics_file = os.path.join(self.tmpdir, 'metrics.jsonl')
+        prom_file = os.path.join(self.tmpdir, 'ingest.prom')
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=100, metrics_file=metrics_file,
+                                                     prom_file=prom_file, workers=2), 20)
+        with open(metrics_file) as fi:
+            snaps = [json.loads(l) for l in fi]
+        self.assertEqual(sorted(s['worker'] for s in snaps), [0, 1])
+        self.assertEqual(sum(s['files'] for s in snaps), 20)
+        for s in snaps:
+            self.assertEqual(s['stages']['read']['calls'], s['files'])
+            self.assertTrue(s['stages']['commit']['calls'] > 1)
+            self.assertTrue(s['commit_latency']['p99'] >= s['commit_latency']['p50'])
+        for worker in (0, 1):
+            with open(os.path.join(self.tmpdir, 'ingest.{}.prom'.format(worker))) as fi:
+                prom = fi.read()
+            self.assertTrue('ybload_ingest_files_total{{worker="{}",'.format(worker) in prom)
+            self.assertTrue('ybload_ingest_commit_latency_seconds{{worker="{}",'.format(worker) in prom)
+
+        stats = ingest.ingest_files(self.app, manifest, commit_after=100, prefilter=0, readers=0)
+        summary = ingest.summarize([stats.toJSON()], 1.0)
+        self.assertEqual(summary['stages']['read']['calls'], 20)
+        self.assertEqual(summary['stages']['stat']['calls'], 20)
+        self.assertEqual(summary['stages']['commit']['calls'], stats.commits)
+        self.assertTrue(summary['commit_latency']['p50'] is not None)
+
+
+    def test_commit_budget(self):
+        logger = mock.Mock()
+        budget = ingest.CommitBudget(1000, adaptive=True, target=1.0, min_bytes=100, max_bytes=3000,
+                                     min_rows=10, max_rows=40, logger=logger)
+        self.assertEqual((budget.bytes, budget.rows), (1000, 40))
+        self.assertTrue(budget.full(1001, 1))
+        self.assertTrue(budget.full(10, 40))
+        budget.committed(0.1, 500, 5)  # fast, but the budget was not used up
+        self.assertEqual(budget.bytes, 1000)
+        for i in range(5):
+            budget.committed(0.1, budget.bytes + 1, 5)
+        self.assertEqual((budget.bytes, budget.rows), (3000, 40))
+        budget.committed(2.0, 3001, 5)
+        self.assertEqual((budget.bytes, budget.rows), (1500, 20))
+        for i in range(10):
+            budget.failed()
+        self.assertEqual((budget.bytes, budget.rows), (100, 10))
+        self.assertTrue(budget.error_rate() > 0.5)
+        self.assertTrue(logger.info.called)
+
+        fixed = ingest.CommitBudget(1000)
+        fixed.committed(5.0, 1001, 5)
+        self.assertEqual((fixed.bytes, fixed.rows), (1000, None))
+        self.assertFalse(fixed.full(1000, 10**6))
+
+    def test_ingest_binary_adaptive(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with mock.patch.object(self.app._engine, 'raw_connection', wraps=self.app._engine.raw_connection) as rc:
+            stats = ingest.ingest_files(self.app, manifest, commit_rows=3, prefilter=0)
+            self.assertEqual(stats.commits, 7)
+            self.assertEqual(rc.call_count, 1)  # one connection for all the commits
+        self.assertEqual(len(self._bigtable()), 20)
+
+        with self.app.session_scope() as s:
+            s.execute('truncate table bigtable')
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, commit_after=10, adaptive=True, min_commit=20,
+                                                     max_commit=200, target_latency=60), 20)
+        self.assertEqual(len(self._bigtable()), 20)
+
+
+    def test_retryable(self):
+        class Error(psycopg2.OperationalError):
+            pgcode = None
+
+        class Conflict(psycopg2.extensions.TransactionRollbackError):
+            pgcode = '40001'
+
+        class Internal(psycopg2.InternalError):
+            pgcode = 'XX000'
+
+        class Syntax(psycopg2.ProgrammingError):
+            pgcode = '42601'
+
+        self.assertTrue(retry.retryable(Error('server closed the connection unexpectedly')))
+        self.assertTrue(retry.retryable(Conflict('could not serialize access')))
+        self.assertTrue(retry.retryable(Internal('Restart read required at: ...')))
+        self.assertFalse(retry.retryable(Internal('something is broken')))
+        self.assertFalse(retry.retryable(Syntax('syntax error')))
+        self.assertFalse(retry.retryable(ValueError('no db error')))
+        self.assertTrue(retry.retryable(mock.Mock(orig=Conflict('wrapped'))))
+
+        policy = retry.RetryPolicy(attempts=2, base=0.5, cap=1.0)
+        self.assertTrue(policy.should_retry(Conflict(), 1))
+        self.assertFalse(policy.should_retry(Conflict(), 2))
+        for i in range(20):
+            self.assertTrue(0 <= policy.delay(5) <= 1.0)
+
+    def test_ingest_binary_retry(self):
+        manifest = self._make_corpus(self.tmpdir)
+        total = sum(os.path.getsize(os.path.join(self.tmpdir, 'file%s' % i)) for i in range(20))
+        flush = writers.RowWriter.flush
+        calls = []
+
+        def flaky(self):
+            # every third batch fails, the first time it is tried
+            if self.rows:
+                calls.append(len(calls))
+            if self.rows and len(calls) % 3 == 0:
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+            return flush(self)
+
+        for writer in ('values', 'copy'):
+            with mock.patch.object(writers.RowWriter, 'flush', flaky):
+                stats = ingest.ingest_files(self.app, manifest, commit_rows=4, writer=writer, batch_rows=2,
+                                            prefilter=0, run_id='flaky', retry_delay=0.001)
+            self.assertTrue(stats.retries > 0)
+            self.assertEqual(stats.files, 20)
+            self.assertEqual(stats.bytes, total)
+            self.assertEqual(len(self._bigtable()), 20)
+            with self.app.session_scope() as s:
+                s.execute('truncate table bigtable')
+
+        def broken(self):
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+        with mock.patch.object(writers.RowWriter, 'flush', broken):
+            self.assertRaises(psycopg2.OperationalError, ingest.ingest_files, self.app, manifest,
+                              writer='values', prefilter=0, retries=2, retry_delay=0.001)
+
+        with mock.patch.object(run, 'app', self.app):
+            with mock.patch.object(writers.RowWriter, 'flush', flaky):
+                self.assertEqual(run.ingest_binary_files(manifest, commit_after=50, retry_delay=0.001), 20)
+
+        # a retry across a commit in the middle of a large file counts every byte once
+        with self.app.session_scope() as s:
+            s.execute('truncate table bigtable, bigtable_chunks')
+        big = os.urandom(5000)
+        with open(os.path.join(self.tmpdir, 'big'), 'wb') as f:
+            f.write(big)
+        with open(manifest, 'a') as fo:
+            fo.write('big\t{}\n'.format(os.path.join(self.tmpdir, 'big')))
+        compress = compression.compress
+        pieces = []
+
+        def failing(data, codec):
+            # the 4th piece fails once (the 2nd one was committed)
+            pieces.append(len(data))
+            if len(pieces) == 3:
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+            return compress(data, codec)
+
+        with mock.patch.object(compression, 'compress', failing):
+            stats = ingest.ingest_files(self.app, manifest, commit_after=1500, ignore=1000, chunk_size=1000,
+                                        prefilter=0, run_id='flaky-chunks', retry_delay=0.001)
+        self.assertEqual((stats.retries, stats.chunked, stats.files), (1, 1, 21))
+        self.assertEqual(stats.bytes, total + len(big))
+        self.assertEqual(self.app.open_value('big').read(), big)
+        self.assertEqual(ingest.load_run(self.app, 'flaky-chunks')[1][0]['bytes'], total + len(big))
+
+    def _make_archives(self):
+        members = dict(('data/dir{}/file{}'.format(i % 3, i), ('content of member %s' % i).encode('utf8') * (i + 1))
+                       for i in range(12))
+        members['data/big'] = b'0123456789' * 500
+        paths = []
+        for name, mode in (('corpus.tar.gz', 'w:gz'), ('corpus.tar', 'w')):
+            path = os.path.join(self.tmpdir, name)
+            with tarfile.open(path, mode) as tar:
+                info = tarfile.TarInfo('data/dir0')
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)  # not a file, skipped
+                for member, payload in sorted(members.items()):
+                    info = tarfile.TarInfo('./' + member)
+                    info.size = len(payload)
+                    tar.addfile(info, io.BytesIO(payload))
+            paths.append(path)
+        path = os.path.join(self.tmpdir, 'corpus.zip')
+        with zipfile.ZipFile(path, 'w') as z:
+            for member, payload in sorted(members.items()):
+                z.writestr(member, payload)
+        paths.append(path)
+        return members, paths
+
+    def test_ingest_archives(self):
+        members, paths = self._make_archives()
+        self.assertEqual(archives.member_key('./data/a/b', 1, key_prefix='x:'), 'x:a/b')
+        self.assertEqual(archives.member_key('data/a/b', strip_prefix='data/a/'), 'b')
+        self.assertEqual(archives.member_key('data/a', 2), None)
+
+        with mock.patch.object(run, 'app', self.app):
+            for path in paths:
+                for workers in (1, 2):
+                    self.assertEqual(run.ingest_binary_files(path, commit_after=200, ignore=1000, chunk_size=700,
+                                                             workers=workers, strip_components=1,
+                                                             key_prefix='a:'), 13)
+                    found = {}
+                    for key in self._bigtable():
+                        stream = self.app.open_value(key)
+                        found[key] = stream.read()
+                        stream.close()
+                    self.assertEqual(found, dict(('a:' + k[5:], v) for k, v in members.items()))
+                    run.truncate()
+
+            # resumed archive ingest skips the members that were done
+            stats = ingest.ingest_files(self.app, paths[0], checkpoint={'lineno': 10}, strip_prefix='data/')
+            self.assertEqual(stats.files, 3)
+            self.assertEqual(sorted(ingest.read_keys(paths[2], strip_prefix='data/'))[:2], ['big', 'dir0/file0'])
+
+    def test_ingest_archive_no_rewind(self):
+        import gzip
+        path = os.path.join(self.tmpdir, 'many.tar.gz')
+        members = dict(('m{:04d}'.format(i), b'x' * (i % 50)) for i in range(600))
+        members['m0300'] = b'big' * 1000
+        with tarfile.open(path, 'w:gz') as tar:
+            for name, payload in sorted(members.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                tar.addfile(info, io.BytesIO(payload))
+        self.assertEqual(list(ingest.batches([(0, 0, 'a', 'm', 1, b'x')] * 5, 10, max_bytes=2)),
+                         [[(0, 0, 'a', 'm', 1, b'x')] * 2] * 2 + [[(0, 0, 'a', 'm', 1, b'x')]])
+
+        rewind = gzip._GzipReader._rewind
+        rewinds = []
+
+        def counting(reader):
+            rewinds.append(1)
+            return rewind(reader)
+        with mock.patch.object(gzip._GzipReader, '_rewind', counting), mock.patch.object(run, 'app', self.app):
+            # batches of the prefilter and the hash partition buffer the members
+            stats = ingest.ingest_files(self.app, path, prefilter=50, ignore=1000, chunk_size=700,
+                                        commit_after=5000)
+            self.assertEqual((stats.files, stats.chunked), (600, 1))
+            run.truncate()
+            done = [ingest.ingest_files(self.app, path, prefilter=50, ignore=1000, chunk_size=700,
+                                        worker=w, workers=2, partition='hash').files for w in range(2)]
+            self.assertEqual(sum(done), 600)
+        self.assertEqual(rewinds, [])
+        self.assertEqual(self.app.open_value('m0300').read(), members['m0300'])
+        self.assertEqual(self.app.open_value('m0599').read(), members['m0599'])
+
+    def test_ingest_from_dir(self):
+        root = os.path.join(self.tmpdir, 'tree')
+        expected = {}
+        for i in range(30):
+            d = os.path.join(root, 'd{}'.format(i % 4), 'e{}'.format(i % 3))
+            if not os.path.exists(d):
+                os.makedirs(d)
+            with open(os.path.join(d, 'f{}'.format(i)), 'wb') as f:
+                f.write(b'x' * i)
+            expected['t:d{}/e{}/f{}'.format(i % 4, i % 3, i)] = b'x' * i
+        os.makedirs(os.path.join(root, 'empty'))
+
+        crawler = crawl.Crawler(root, threads=4, lookahead=2, key_prefix='t:')
+        entries = list(crawler.entries())
+        self.assertEqual(entries, list(crawl.Crawler(root, threads=0, key_prefix='t:').entries()))
+        self.assertEqual([e[0] for e in entries], list(range(30)))
+        self.assertEqual(dict((e[2], e[4]) for e in entries), dict((k, len(v)) for k, v in expected.items()))
+        self.assertEqual(list(crawler.entries(lineno=28)), entries[28:])
+
+        with mock.patch.object(run, 'app', self.app):
+            with mock.patch.object(ingest, '_stat') as stat:
+                for workers in (1, 2):
+                    self.assertEqual(run.ingest_binary_files(root, commit_after=100, workers=workers,
+                                                             key_prefix='t:', crawlers=2), 30)
+                    self.assertEqual(self._bigtable(), expected)
+                    run.truncate()
+                self.assertEqual(run.ingest_binary_files(root, key_prefix='t:', readers=0), 30)
+                self.assertFalse(stat.called)  # sizes came from the walk
+                run.truncate()
+
+            # an unreadable subtree is logged and counted, the rest goes in
+            scandir = os.scandir
+
+            def failing(path):
+                if path.endswith('d1'):
+                    raise PermissionError(13, 'Permission denied', path)
+                return scandir(path)
+            with mock.patch.object(crawl.os, 'scandir', failing), \
+                    mock.patch.object(self.app.logger, 'error') as error:
+                stats = ingest.ingest_files(self.app, root, key_prefix='t:')
+            self.assertEqual((stats.files, stats.unreadable), (30 - 8, 1))
+            self.assertTrue('d1' in error.call_args[0][0])
+            self.assertEqual(crawl.list_dir(os.path.join(root, 'nothing'))[:2], ([], []))
+
+    def test_ingest_packed(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'file7'), 'wb') as f:
+            f.write(b'large ' * 100)
+        with mock.patch.object(run, 'app', self.app):
+            for writer in ('row', 'copy'):
+                self.assertEqual(run.ingest_binary_files(manifest, commit_after=200, writer=writer, pack=True,
+                                                         segment_size=100, pack_max=100), 20)
+                with self.app.session_scope() as s:
+                    self.assertEqual(s.query(models.BigTablePacked).count(), 19)
+                    self.assertEqual([r.key for r in s.query(models.BigTable).all()], ['key7'])
+                    segments = s.query(models.BigTableSegment).all()
+                    self.assertTrue(1 < len(segments) < 19)
+                    members = []
+                    for segment in segments:
+                        for key, start, size in packing.decode_index(segment.index):
+                            members.append(key)
+                            self.assertEqual(segment.value[start:start + size],
+                                             ('content of file %s' % key[3:]).encode('utf8'))
+                    self.assertEqual(len(members), 19)
+
+                for i in range(20):
+                    stream = self.app.open_value('key%s' % i)
+                    expected = i == 7 and b'large ' * 100 or ('content of file %s' % i).encode('utf8')
+                    self.assertEqual(stream.read(), expected)
+                    stream.close()
+                self.assertEqual(self.app.open_value('key20'), None)
+
+                # packed keys are known to the prefilter
+                stats = ingest.ingest_files(self.app, manifest, pack=True)
+                self.assertEqual((stats.existing, stats.packed), (20, 0))
+                run.truncate()
+
+            # a key is in one place only, the bigtable row wins over the packed copy
+            self.assertEqual(run.ingest_binary_files(manifest, pack=True, pack_max=100), 20)
+            with open(os.path.join(self.tmpdir, 'file3'), 'wb') as f:
+                f.write(b'changed')
+            self.assertEqual(run.ingest_binary_files(manifest, upsert=True), 20)
+            self.assertEqual(self.app.open_value('key3').read(), b'changed')
+            self.assertEqual(len(self._bigtable()), 20)
+            with self.app.session_scope() as s:
+                self.assertEqual(s.query(models.BigTablePacked).count(), 0)
+            self.assertEqual(run.ingest_binary_files(manifest, pack=True, prefilter=0), 20)
+            with self.app.session_scope() as s:
+                self.assertEqual(s.query(models.BigTablePacked).count(), 0)
+            self.assertEqual(self.app.open_value('key3').read(), b'changed')
+            run.truncate()
+
+        self.assertRaises(ValueError, ingest.ingest_files, self.app, manifest, pack=True, upsert=True)
+        self.assertRaises(ValueError, ingest.ingest_files, self.app, manifest, pack=True, codec='zlib')
+        self.assertRaises(ValueError, ingest.ingest_files, self.app, manifest, pack=True, content_addressed=True)
+        # nothing is opened nor saved
+        with self.app.session_scope() as s:
+            saved = s.query(models.KeyValue).count()
+        with mock.patch.object(archives, 'Archive') as archive, mock.patch.object(run, 'app', self.app):
+            self.assertRaises(ValueError, ingest.ingest_files, self.app, self._make_archives()[1][0],
+                              pack=True, upsert=True)
+            self.assertRaises(ValueError, run.ingest_binary_files, self._make_archives()[1][0], pack=True, upsert=True)
+            self.assertFalse(archive.called)
+        with self.app.session_scope() as s:
+            self.assertEqual(s.query(models.KeyValue).count(), saved)
+
+    def test_read_range(self):
+        payloads = {'row': os.urandom(3000), 'content': os.urandom(3000), 'chunked': os.urandom(9000),
+                    'packed': os.urandom(300), 'zlib': b'abcdefghij' * 300, 'zlib-chunked': b'klmnopqrst' * 900}
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        for name, payload in payloads.items():
+            with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                f.write(payload)
+            with open(manifest, 'w') as fo:
+                fo.write('{}\t{}\n'.format(name, os.path.join(self.tmpdir, name)))
+            ingest.ingest_files(self.app, manifest, ignore=5000, chunk_size=2000,
+                                content_addressed=name == 'content', pack=name == 'packed',
+                                codec=name.startswith('zlib') and 'zlib' or None)
+
+        listing = dict((v['key'], v) for v in self.app.list_values())
+        self.assertEqual(dict((k, v['size']) for k, v in listing.items()),
+                         dict((k, len(v)) for k, v in payloads.items()))
+        self.assertEqual(dict((k, v['storage']) for k, v in listing.items()),
+                         {'row': 'row', 'content': 'content', 'chunked': 'chunked', 'packed': 'packed',
+                          'zlib': 'row', 'zlib-chunked': 'chunked'})
+        self.assertEqual([v['key'] for v in self.app.list_values('zlib')], ['zlib', 'zlib-chunked'])
+        self.assertEqual(list(self.app.list_values('z', limit=1))[0]['key'], 'zlib')
+        self.assertEqual(list(self.app.list_values('%')), [])
+        self.assertEqual(self.app.value_info('chunked')['chunks'], 5)
+        self.assertEqual(self.app.value_info('nothing'), None)
+
+        for name, payload in payloads.items():
+            for start, length in ((0, None), (0, 10), (1999, 2), (250, 100), (2990, 50), (10000, 5)):
+                self.assertEqual(self.app.read_range(name, start, length),
+                                 payload[start:length is not None and start + length or None], (name, start))
+            blocks = list(self.app.iter_value(name, block_size=700))
+            self.assertEqual(b''.join(blocks), payload)
+            self.assertTrue(max(len(b) for b in blocks) <= 700)
+            self.assertEqual(b''.join(self.app.iter_value(name, 100, start=50, length=1000)), payload[50:1050])
+        self.assertEqual(self.app.read_range('nothing'), None)
+        self.assertEqual(list(self.app.iter_value('nothing')), [])
+
+        # a chunked value is streamed on one connection: the info, the map of
+        # the chunks and one query per block (4 chunks of 2000 bytes in 3 blocks, 1000 in 2)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(self.app._engine, 'before_cursor_execute', listener)
+        try:
+            with mock.patch.object(self.app._engine, 'connect', wraps=self.app._engine.connect) as connect:
+                self.assertEqual(b''.join(self.app.iter_value('chunked', block_size=700)), payloads['chunked'])
+        finally:
+            event.remove(self.app._engine, 'before_cursor_execute', listener)
+        self.assertEqual((connect.call_count, len(statements)), (1, 16))
+
+        with mock.patch.object(run, 'app', self.app):
+            output = os.path.join(self.tmpdir, 'out')
+            self.assertEqual(run.get_value('chunked', output, offset=10, length=5000, block_size=999), 5000)
+            with open(output, 'rb') as fi:
+                self.assertEqual(fi.read(), payloads['chunked'][10:5010])
+            self.assertEqual(run.get_value('nothing', output), None)
+            self.assertEqual(run.print_sizes('zlib'), 2)
+
+    def test_export(self):
+        payloads = {'a/row': os.urandom(3000), 'a/content': os.urandom(3000), 'b/chunked': os.urandom(9000),
+                    'b/c/packed': os.urandom(300), 'zlib': b'abcdefghij' * 300, '../zlib-chunked': b'klmn' * 2000}
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        for i, (name, payload) in enumerate(payloads.items()):
+            with open(os.path.join(self.tmpdir, 'f%s' % i), 'wb') as f:
+                f.write(payload)
+            with open(manifest, 'w') as fo:
+                fo.write('{}\t{}\n'.format(name, os.path.join(self.tmpdir, 'f%s' % i)))
+            ingest.ingest_files(self.app, manifest, ignore=5000, chunk_size=2000,
+                                content_addressed=name.endswith('content'), pack=name.endswith('packed'),
+                                codec='zlib' in name and 'zlib' or None)
+        expected = dict((export.safe_path(k), v) for k, v in payloads.items())
+        self.assertEqual(export.safe_path('/x/../y'), 'x/y')
+
+        def read_dir(root):
+            out = {}
+            for d, _, files in os.walk(root):
+                for f in files:
+                    with open(os.path.join(d, f), 'rb') as fi:
+                        out[os.path.relpath(os.path.join(d, f), root).replace(os.sep, '/')] = fi.read()
+            return out
+
+        with mock.patch.object(run, 'app', self.app):
+            for partition in export.PARTITIONS:
+                output = os.path.join(self.tmpdir, 'export-' + partition)
+                self.assertEqual(run.export_bigtable(output, workers=3, partition=partition, ranges=5,
+                                                     run_id='e-' + partition, itersize=2), 6)
+                self.assertEqual(read_dir(output), expected)
+
+                output = os.path.join(self.tmpdir, 'export-{}.tar.gz'.format(partition))
+                self.assertEqual(run.export_bigtable(output, workers=2, partition=partition), 6)
+                with tarfile.open(output) as tar:
+                    self.assertEqual(dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers()), expected)
+
+            # everything is done, nothing left to resume
+            summary = export.export(self.app, os.path.join(self.tmpdir, 'again'), resume='e-hash')
+            self.assertEqual((summary['files'], summary['ranges'], summary['skipped_ranges']), (0, 5, 5))
+
+            # a range that did not finish is exported again
+            with self.app.session_scope() as s:
+                s.query(models.KeyValue).filter(models.KeyValue.key.startswith('export:e-range:')).delete(
+                    synchronize_session=False)
+            summary = export.export(self.app, os.path.join(self.tmpdir, 'again'), resume='e-range')
+            self.assertEqual((summary['files'], summary['skipped_ranges']), (6, 0))
+            self.assertEqual(read_dir(os.path.join(self.tmpdir, 'again')), expected)
+            self.assertRaises(ValueError, export.export, self.app, self.tmpdir, resume='nothing')
+
+            # an interrupted tar export continues in a new part, the first one is kept
+            output = os.path.join(self.tmpdir, 'broken.tar')
+            write = export.TarOutput.write
+            calls = []
+
+            def failing(tar_output, key, size, blocks):
+                calls.append(key)
+                if len(calls) == 4:
+                    raise IOError('disk full')
+                return write(tar_output, key, size, blocks)
+
+            with mock.patch.object(export.TarOutput, 'write', failing):
+                self.assertRaises(IOError, export.export, self.app, output, workers=1, ranges=6, run_id='e-tar')
+            _, done = export.load_export(self.app, 'e-tar')
+            self.assertTrue(done)
+            with tarfile.open(output) as tar:
+                first = dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers())
+            self.assertEqual(len(first), 3)
+            self.assertRaises(ValueError, export.export, self.app, '-', resume='e-tar')
+
+            summary = export.export(self.app, output, resume='e-tar')
+            self.assertEqual(summary['output'], os.path.join(self.tmpdir, 'broken.part1.tar'))
+            self.assertEqual(summary['skipped_ranges'], len(done))
+            with tarfile.open(output) as tar:
+                self.assertEqual(len(tar.getmembers()), 3)
+            with tarfile.open(summary['output']) as tar:
+                second = dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers())
+            self.assertEqual(dict(first, **second), expected)
+            with self.app.session_scope() as s:
+                outputs = set(json.loads(kv.value)['output'] for kv in s.query(models.KeyValue).filter(
+                    models.KeyValue.key.startswith('export:e-tar:')))
+            self.assertEqual(outputs, set([output, summary['output']]))
+            self.assertEqual(export.part_path('a/b.tar.gz', 2), 'a/b.part2.tar.gz')
+
+            # values above `inline` are not in the scan, they are streamed (and
+            # held within max_bytes on their way to the tar writer)
+            output = os.path.join(self.tmpdir, 'small.tar')
+            with mock.patch.object(export.blobs, 'iter_value', wraps=export.blobs.iter_value) as streamed:
+                summary = export.export(self.app, output, workers=2, inline=1000, max_bytes=2000)
+            self.assertEqual(sorted(c[0][1] for c in streamed.call_args_list),
+                             ['../zlib-chunked', 'a/content', 'a/row', 'b/chunked', 'zlib'])
+            with tarfile.open(output) as tar:
+                self.assertEqual(dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers()), expected)
+
+            # a key that needs the file of another one as a directory is reported
+            with open(manifest, 'w') as fo:
+                fo.write('b\t{}\n'.format(os.path.join(self.tmpdir, 'f0')))
+            ingest.ingest_files(self.app, manifest)
+            summary = export.export(self.app, os.path.join(self.tmpdir, 'collided'), workers=1, ranges=1)
+            self.assertEqual(summary['files'] + len(summary['collisions']), 7)
+            self.assertTrue(set(summary['collisions']) in ({'b'}, {'b/chunked', 'b/c/packed'}))
+
+    def test_sharding(self):
+        table = models.BigTableChunk.__table__.tometadata(MetaData())
+        table.info['yugabyte'] = {'table': 'bigtable_chunks', 'sharding': 'hash', 'tablets': 12}
+        sql = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        self.assertIn('PRIMARY KEY ((key) HASH, chunk_no ASC)', sql)
+        self.assertTrue(sql.endswith(' SPLIT INTO 12 TABLETS'))
+        table.info['yugabyte'] = {'table': 'bigtable_chunks', 'sharding': 'range', 'tablets': 12}
+        sql = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        self.assertIn('PRIMARY KEY (key ASC, chunk_no ASC)', sql)
+        self.assertNotIn('SPLIT', sql)
+        self.assertEqual(sharding.from_config({}), ('hash', 0))
+        self.assertRaises(ValueError, sharding.from_config, {'BIGTABLE_SHARDING': 'random'})
+
+        # plain PostgreSQL: the models are left alone
+        self.assertFalse(sharding.configure(self.app._engine, 'hash', 16))
+        self.assertNotIn('yugabyte', models.BigTable.__table__.info)
+        self.assertIn('PRIMARY KEY (key)\n', str(CreateTable(models.BigTable.__table__).compile(
+            dialect=postgresql.dialect())))
+
+        # the rows (and the sequence of the ids) survive a rebuild
+        with self.app.session_scope() as s:
+            s.add(models.BigTable(key='a', value=b'x', size=1))
+            s.add(models.BigTableSegment(value=b'abc', files=1))
+            s.commit()
+        with self.app._engine.begin() as connection:
+            for name in sorted(sharding.TABLES):
+                sharding.rebuild(connection, name, None)
+        with self.app._engine.begin() as connection:
+            sharding.rebuild(connection, 'bigtable_segments', None)
+        with self.app.session_scope() as s:
+            s.add(models.BigTableSegment(value=b'def', files=2))
+            s.commit()
+            self.assertEqual([(r.id, r.value) for r in s.query(models.BigTableSegment).order_by('id')],
+                             [(1, b'abc'), (2, b'def')])
+            self.assertEqual([r.toJSON() for r in s.query(models.BigTable).all()],
+                             [{'key': 'a', 'value': 1, 'stored': 1}])
+
+    def test_purge(self):
+        manifest = self._make_corpus(self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'file3'), 'wb') as f:
+            f.write(b'chunked ' * 100)
+        with mock.patch.object(run, 'app', self.app):
+            self.assertEqual(run.ingest_binary_files(manifest, ignore=500, chunk_size=300, pack=True,
+                                                     segment_size=60, pack_max=100), 20)
+            with self.app.session_scope() as s:
+                for i in range(12):
+                    s.add(models.Records(bibcode='bib{}'.format(i)))
+                    s.add(models.ChangeLog(key='bib{}'.format(i), type='test'))
+                s.commit()
+
+            # key1, key10 .. key19 (all of them packed)
+            self.assertEqual(run.purge_keys(['bigtable'], prefix='key1', workers=3, batch=2, orphans=True), 11)
+            keys = [v['key'] for v in self.app.list_values()]
+            self.assertEqual(keys, ['key{}'.format(i) for i in (0, 2, 3, 4, 5, 6, 7, 8, 9)])
+            with open(os.path.join(self.tmpdir, 'purge.txt'), 'w') as fo:
+                fo.write('key3\nkey4\nkey_missing\nbib1\nbib2\n')
+            purger = purge.Purger(self.app, ['bigtable', 'records', 'change_log'], workers=2, batch=2)
+            summary = purger.by_keys(['key3', 'key4', 'key_missing', 'bib1', 'bib2'])
+            self.assertEqual(summary['deleted'], {'bigtable': 1, 'bigtable_chunks': 3, 'bigtable_packed': 1,
+                                                  'records': 2, 'change_log': 2})
+            self.assertEqual(summary['rows'], 9)
+            self.assertEqual(run.purge_keys(['records'], keys=os.path.join(self.tmpdir, 'purge.txt')), 0)
+            self.assertEqual(self.app.read_range('key5'), b'content of file 5')
+            self.assertEqual(self.app.open_value('key3'), None)
+
+            with self.app.session_scope() as s:
+                segments = [packing.decode_index(r.index) for r in s.query(models.BigTableSegment).all()]
+                self.assertTrue(segments)
+                self.assertTrue(all(any(k in keys for k, _, _ in index) for index in segments))
+            # segments that lost all their keys are gone
+            self.assertEqual(purger.orphans()['bigtable_segments'], 0)
+            # orphans are deleted in batches too
+            with self.app.session_scope() as s:
+                for i in range(5):
+                    s.add(models.BigTableContent(digest='orphan{}'.format(i), value=b'x'))
+                    s.add(models.BigTableSegment(id=1000 + i, value=b'x', files=0))
+            purger = purge.Purger(self.app, ['bigtable'], batch=2)
+            with mock.patch.object(purger, '_execute', wraps=purger._execute) as execute:
+                self.assertEqual(purger.orphans(), {'bigtable_content': 5, 'bigtable_segments': 5})
+            self.assertEqual(sorted(c[0][3] for c in execute.call_args_list if c[0][1].name == 'bigtable_content'),
+                             [(), ('orphan1',), ('orphan3',)])
+
+            # every batch continues behind the last row deleted
+            purger = purge.Purger(self.app, ['records'], batch=1)
+            with mock.patch.object(purger, '_execute', wraps=purger._execute) as execute:
+                self.assertEqual(purger.by_prefix('bib1')['rows'], 2)  # bib10, bib11
+            self.assertEqual([c[0][3][1:] for c in execute.call_args_list], [(), ('bib10',), ('bib11',)])
+            with self.app.session_scope() as s:
+                self.assertEqual(s.query(models.Records).count(), 8)
+                self.assertEqual(s.query(models.ChangeLog).count(), 10)
+            self.assertRaises(ValueError, purge.Purger, self.app, ['nothing'])
+
+            with mock.patch.object(run, 'print') as printed:
+                run.truncate(['bigtable', 'change_log'])
+            self.assertTrue('bigtable_segments' in printed.call_args_list[0][0][0])
+            self.assertEqual(list(self.app.list_values()), [])
+            with self.app.session_scope() as s:
+                self.assertEqual(s.query(models.ChangeLog).count(), 0)
+                self.assertEqual(s.query(models.Records).count(), 8)
 
 
 if __name__ == '__main__':
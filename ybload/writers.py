@@ -0,0 +1,269 @@
+"""Write engines used by the ingest; they receive rows one at a time and
+decide how many of them travel to the server in one round trip.
+
+  - row: one INSERT per row (the original behaviour)
+  - values: multi-row INSERT ... VALUES (...),(...) ON CONFLICT DO NOTHING
+  - copy: COPY (binary format) into a temporary staging table which is
+          then merged into the target table with the conflict handling
+
+ContentWriter sits on top of them: it checksums and compresses the values
+and can store each unique content only once and/or update keys whose
+content changed.
+
+The writers never commit; the caller calls flush() before it commits.
+"""
+
+import struct
+import hashlib
+from collections import OrderedDict
+import psycopg2
+from psycopg2.extras import execute_values
+from past.builtins import basestring
+from ybload.models import BigTable, BigTableContent
+from ybload import blobs, compression
+
+
+class RowWriter(object):
+    """Sends every row as a separate INSERT statement."""
+
+    def __init__(self, cursor, table=BigTable.__tablename__, columns=('key', 'value'),
+                 conflict='ON CONFLICT DO NOTHING', batch_rows=1000):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.conflict = conflict
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.statements = 0
+
+    def add(self, *row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Sends the pending rows to the server; returns their number."""
+        rows, self.rows = self.rows, []
+        if rows:
+            self._write(rows)
+        return len(rows)
+
+    def _adapt(self, row):
+        return tuple(isinstance(v, bytes) and psycopg2.Binary(v) or v for v in row)
+
+    def _write(self, rows):
+        sql = 'INSERT INTO {} ({}) VALUES({}) {}'.format(
+            self.table, ', '.join(self.columns), ', '.join(['%s'] * len(self.columns)), self.conflict)
+        for row in rows:
+            self.cursor.execute(sql, self._adapt(row))
+            self.statements += 1
+
+
+class ValuesWriter(RowWriter):
+    """Sends up to `batch_rows` rows in one multi-row INSERT."""
+
+    def _write(self, rows):
+        sql = 'INSERT INTO {} ({}) VALUES %s {}'.format(
+            self.table, ', '.join(self.columns), self.conflict)
+        execute_values(self.cursor, sql, [self._adapt(r) for r in rows], page_size=len(rows))
+        self.statements += 1
+
+
+class CopyWriter(RowWriter):
+    """Streams the rows through COPY ... FROM STDIN (binary) into a temp
+    staging table and merges them into the target with INSERT ... SELECT"""
+
+    def __init__(self, *args, **kwargs):
+        RowWriter.__init__(self, *args, **kwargs)
+        self.stage = '{}_stage'.format(self.table)
+        self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {})'.format(self.stage, self.table))
+        # the binary format depends on the column types (oids) of the stage
+        self.cursor.execute('SELECT {} FROM {} LIMIT 0'.format(', '.join(self.columns), self.stage))
+        self.types = tuple(d[1] for d in self.cursor.description)
+
+    def _write(self, rows):
+        cols = ', '.join(self.columns)
+        self.cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(self.stage, cols),
+                                CopyStream(rows, self.types))
+        self.cursor.execute('INSERT INTO {} ({}) SELECT {} FROM {} {}'.format(
+            self.table, cols, cols, self.stage, self.conflict))
+        self.cursor.execute('TRUNCATE {}'.format(self.stage))
+        self.statements += 3
+
+
+WRITERS = {
+    'row': RowWriter,
+    'values': ValuesWriter,
+    'copy': CopyWriter,
+}
+
+
+def get_writer(name, cursor, **kwargs):
+    if name not in WRITERS:
+        raise ValueError('Unknown writer: %s, must be one of %s' % (name, sorted(WRITERS)))
+    return WRITERS[name](cursor, **kwargs)
+
+
+# replaces the value of a key only when its checksum differs
+UPSERT = ('ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, digest = EXCLUDED.digest, '
+          'size = EXCLUDED.size, codec = EXCLUDED.codec, chunks = NULL '
+          'WHERE {}.digest IS DISTINCT FROM EXCLUDED.digest').format(
+    BigTable.__tablename__)
+
+
+class ContentWriter(object):
+    """Writes bigtable rows together with their metadata: the logical
+    size, the codec and (when needed) the sha256 of the value.
+
+    codec: values are compressed with it, unless that saves too little
+        (see compression.encode)
+    content_addressed: values go into bigtable_content keyed by the digest
+        (once per unique content - digests already stored are looked up in
+        one query per batch and their content is not sent again); the
+        bigtable rows only point at the digest
+    upsert: keys that exist are updated, unless their stored digest says
+        the content is the same (those are not even sent); pieces of
+        values that were chunked before are deleted
+    """
+
+    def __init__(self, cursor, writer='row', batch_rows=1000, content_addressed=True,
+                 upsert=False, stats=None, codec=None, min_ratio=0.9):
+        self.cursor = cursor
+        self.batch_rows = batch_rows
+        self.content_addressed = content_addressed
+        self.upsert = upsert
+        self.codec = codec
+        self.min_ratio = min_ratio
+        self.checksum = content_addressed or upsert
+        self.stats = stats
+        self.pending = []
+        conflict = upsert and UPSERT or 'ON CONFLICT DO NOTHING'
+        if content_addressed:
+            self.keys = get_writer(writer, cursor, columns=('key', 'digest', 'size'), conflict=conflict,
+                                   batch_rows=batch_rows)
+            self.content = get_writer(writer, cursor, table=BigTableContent.__tablename__,
+                                      columns=('digest', 'value', 'codec'), batch_rows=batch_rows)
+        else:
+            self.keys = get_writer(writer, cursor, columns=('key', 'value', 'digest', 'size', 'codec'),
+                                   conflict=conflict, batch_rows=batch_rows)
+            self.content = None
+
+    def add(self, key, value):
+        digest = self.checksum and hashlib.sha256(value).hexdigest() or None
+        self.pending.append((key, digest, value))
+        if len(self.pending) >= self.batch_rows:
+            self.flush()
+
+    def _count(self, name, n):
+        if self.stats is not None and n:
+            setattr(self.stats, name, getattr(self.stats, name) + n)
+
+    def _encode(self, value):
+        stored, codec = compression.encode(value, self.codec, self.min_ratio)
+        if codec:
+            self._count('compressed', 1)
+        return stored, codec
+
+    def _lookup(self, sql, values):
+        self.cursor.execute(sql, (list(values),))
+        return dict(self.cursor.fetchall())
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+
+        if self.upsert:
+            # the same key must not be updated twice in one statement
+            pending = list(OrderedDict((p[0], p) for p in pending).values())
+            self.cursor.execute('SELECT key, digest, chunks FROM {} WHERE key = ANY(%s)'.format(
+                BigTable.__tablename__), (list(set(p[0] for p in pending)),))
+            stored = dict((r[0], r[1:]) for r in self.cursor.fetchall())
+            changed = [p for p in pending if p[0] not in stored or stored[p[0]][0] != p[1]]
+            self._count('unchanged', len(pending) - len(changed))
+            pending = changed
+            chunked = [p[0] for p in pending if p[0] in stored and stored[p[0]][1] is not None]
+            if chunked:
+                blobs.delete_chunks(self.cursor, chunked)
+
+        if self.content_addressed:
+            known = self._lookup('SELECT digest, 1 FROM {} WHERE digest = ANY(%s)'.format(
+                BigTableContent.__tablename__), set(p[1] for p in pending))
+            for key, digest, value in pending:
+                if digest in known:
+                    self._count('deduplicated', 1)
+                else:
+                    known[digest] = 1
+                    self.content.add(digest, *self._encode(value))
+                self.keys.add(key, digest, len(value))
+            self.content.flush()
+        else:
+            for key, digest, value in pending:
+                stored, codec = self._encode(value)
+                self.keys.add(key, stored, digest, len(value), codec)
+        self.keys.flush()
+        return len(pending)
+
+
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_TRAILER = struct.pack('!h', -1)
+
+
+# binary formats of the integer types, by their oid (bigint, integer, smallint)
+_INTEGERS = {20: '!q', 23: '!i', 21: '!h'}
+
+
+def encode_copy_field(v, oid):
+    """Binary COPY representation of a field going into a column of the
+    type `oid` (text/varchar/bytea/boolean/bigint/integer/smallint);
+    returns (header, payload)"""
+    if v is None:
+        return struct.pack('!i', -1), b''
+    if isinstance(v, bool):
+        return struct.pack('!i', 1), struct.pack('!?', v)
+    if isinstance(v, int):
+        if oid not in _INTEGERS:
+            raise ValueError('Can not COPY the integer {} into a column of type oid {}'.format(v, oid))
+        payload = struct.pack(_INTEGERS[oid], v)
+        return struct.pack('!i', len(payload)), payload
+    if isinstance(v, basestring) and not isinstance(v, bytes):
+        v = v.encode('utf8')
+    return struct.pack('!i', len(v)), v
+
+
+class CopyStream(object):
+    """File-like object that produces the binary COPY stream for the rows
+    lazily (so that the payload is not duplicated in memory); `types` are
+    the oids of the columns"""
+
+    def __init__(self, rows, types):
+        self._chunks = self._generate(rows, types)
+        self._chunk = b''
+        self._pos = 0
+
+    def _generate(self, rows, types):
+        yield _COPY_HEADER
+        for row in rows:
+            yield struct.pack('!h', len(row))
+            for v, oid in zip(row, types):
+                header, payload = encode_copy_field(v, oid)
+                yield header
+                yield payload
+        yield _COPY_TRAILER
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                try:
+                    self._chunk, self._pos = next(self._chunks), 0
+                except StopIteration:
+                    break
+                continue
+            end = size < 0 and len(self._chunk) or self._pos + size
+            piece = self._chunk[self._pos:end]
+            self._pos += len(piece)
+            out.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b''.join(out)